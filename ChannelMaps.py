@@ -0,0 +1,231 @@
+"""
+Description: Channel map lookup tables. Each detchannelmaps map is turned into dense numpy arrays once,
+which are cached to disk so later runs don't need to query the C++ map.
+"""
+import detchannelmaps
+
+import os
+import sys
+import atexit
+import hashlib
+import numpy as np
+
+CACHE_VERSION = 1 # bump if the layout of the cache file changes
+UNKNOWN_CHANNEL_ERRORS = (RuntimeError, ValueError, IndexError) # what the detchannelmaps bindings raise for channels not in the map (C++ exceptions translated by pybind11)
+
+
+def CacheDirectory() -> str:
+    """ Directory where channel map tables are cached, can be overridden with RAWDATAANALYSIS_CACHE.
+
+    Returns:
+        str: cache directory
+    """
+    default = os.path.join(os.path.expanduser("~"), ".cache", "RawDataAnalysis")
+    return os.path.join(os.environ.get("RAWDATAANALYSIS_CACHE", default), "channelmaps")
+
+
+def DetChannelMapsIdentity() -> str:
+    """ Hash of the installed detchannelmaps build: the path, size and modification time of its python modules and libraries,
+        and the share directory the map files are read from. Changes whenever detchannelmaps is rebuilt or updated.
+
+    Returns:
+        str: hash
+    """
+    files = sorted({m.__file__ for n, m in list(sys.modules.items()) if n.split(".")[0] == "detchannelmaps" and getattr(m, "__file__", None)})
+    identity = [os.environ.get("DETCHANNELMAPS_SHARE", "")]
+    for f in files:
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        identity.append(f"{f}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(identity).encode()).hexdigest()
+
+
+class ChannelMap:
+    """ Dense lookup tables for a detchannelmaps channel map.
+
+    Attributes:
+        name (str): channel map name e.g. VDColdboxChannelMap
+        identity (str): hash of the detchannelmaps build the tables were made with, see DetChannelMapsIdentity
+        plane (np.ndarray): offline channel -> plane, -1 if unknown
+        element (np.ndarray): offline channel -> index into element_names, -1 if unknown
+        element_names (np.ndarray): element names
+        links (dict): (det, crate, slot, stream) or (crate, slot, fiber) -> offline channel of each channel in the link
+        unsaved (bool): links have been added since the cache file was written, they are saved by Flush
+    """
+    def __init__(self, name : str, n_channels : int = 2**16, cache_dir : str = None):
+        """
+        Args:
+            name (str): channel map name
+            n_channels (int, optional): number of offline channels to tabulate. Defaults to 2**16.
+            cache_dir (str, optional): where to cache the tables. Defaults to CacheDirectory().
+        """
+        self.name = name
+        self.identity = DetChannelMapsIdentity()
+        self.cache_file = os.path.join(cache_dir or CacheDirectory(), f"{name}-{n_channels}-{self.identity[:16]}-v{CACHE_VERSION}.npz") # rebuilt if detchannelmaps changes
+        self._cmap = None
+        self.links = {}
+        self.unsaved = False
+        self._flush_at_exit = False
+
+        if os.path.isfile(self.cache_file):
+            self.Load()
+        else:
+            self.Build(n_channels)
+            self.Save()
+
+
+    @property
+    def cmap(self):
+        """ The underlying detchannelmaps map, only created when a table needs to be filled.
+        """
+        if self._cmap is None:
+            self._cmap = detchannelmaps.make_tpc_map(self.name)
+        return self._cmap
+
+
+    def Build(self, n_channels : int):
+        """ Query the channel map for every offline channel.
+
+        Args:
+            n_channels (int): number of offline channels to tabulate
+        """
+        print(f"building channel map tables for {self.name}")
+        self.plane = np.full(n_channels, -1, dtype=np.int8)
+        self.element = np.full(n_channels, -1, dtype=np.int32)
+        names = {}
+        for c in range(n_channels):
+            try:
+                self.plane[c] = self.cmap.get_plane_from_offline_channel(c)
+                name = self.cmap.get_element_name_from_offline_channel(c)
+            except UNKNOWN_CHANNEL_ERRORS:
+                continue
+            self.element[c] = names.setdefault(name, len(names))
+        self.element_names = np.array(list(names), dtype=str)
+
+
+    def Load(self):
+        """ Load tables from the cache file.
+        """
+        with np.load(self.cache_file) as cache:
+            self.plane = cache["plane"]
+            self.element = cache["element"]
+            self.element_names = cache["element_names"]
+            self.links = {tuple(int(i) for i in k if i >= 0) : v for k, v in zip(cache["link_keys"], cache["link_channels"])} # strip the padding
+
+
+    def Save(self):
+        """ Write tables to the cache file, written to a temporary file first so a reader never sees a partial file.
+        """
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        width = max([len(k) for k in self.links], default=0)
+        depth = max([len(v) for v in self.links.values()], default=0)
+        link_keys = np.full((len(self.links), width), -1, dtype=np.int64)
+        link_channels = np.full((len(self.links), depth), -1, dtype=np.int64)
+        for i, (k, v) in enumerate(self.links.items()):
+            link_keys[i, :len(k)] = k
+            link_channels[i, :len(v)] = v
+
+        tmp = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, plane = self.plane, element = self.element, element_names = self.element_names, link_keys = link_keys, link_channels = link_channels)
+        os.replace(tmp, self.cache_file)
+
+
+    def Flush(self):
+        """ Write the cache file if links have been added since it was last written.
+        """
+        if self.unsaved:
+            self.Save()
+            self.unsaved = False
+
+
+    def _AddLink(self, key : tuple, channels : list):
+        """ Add the offline channels of a link, the cache file is written once by Flush rather than for every link.
+        """
+        self.links[key] = np.array(channels, dtype=np.int64)
+        self.unsaved = True
+        if not self._flush_at_exit:
+            atexit.register(self.Flush) # in case the map isn't flushed by whatever is using it
+            self._flush_at_exit = True
+
+
+    def _Lookup(self, table : np.ndarray, channels : np.ndarray) -> np.ndarray:
+        channels = np.asarray(channels, dtype=np.int64)
+        valid = (channels >= 0) & (channels < len(table))
+        return np.where(valid, table[np.where(valid, channels, 0)], -1).astype(table.dtype)
+
+
+    def Planes(self, channels : np.ndarray) -> np.ndarray:
+        """ Get the plane of each offline channel.
+
+        Args:
+            channels (np.ndarray): offline channel numbers
+
+        Returns:
+            np.ndarray: planes, -1 if the channel is unknown
+        """
+        return self._Lookup(self.plane, channels)
+
+
+    def Elements(self, channels : np.ndarray) -> np.ndarray:
+        """ Get the element name index of each offline channel.
+
+        Args:
+            channels (np.ndarray): offline channel numbers
+
+        Returns:
+            np.ndarray: index into element_names, -1 if the channel is unknown
+        """
+        return self._Lookup(self.element, channels)
+
+
+    def ElementNames(self, channels : np.ndarray) -> np.ndarray:
+        """ Get the element name of each offline channel.
+
+        Args:
+            channels (np.ndarray): offline channel numbers
+
+        Returns:
+            np.ndarray: element names, empty string if the channel is unknown
+        """
+        names = np.append(self.element_names, "")
+        return names[self.Elements(channels)]
+
+
+    def OfflineChannels(self, det : int, crate : int, slot : int, stream : int, n_channels : int = 64) -> np.ndarray:
+        """ Offline channel numbers of every channel in a WIBEth stream.
+
+        Args:
+            det (int): detector id
+            crate (int): crate id
+            slot (int): slot id
+            stream (int): stream id
+            n_channels (int, optional): channels per stream. Defaults to 64.
+
+        Returns:
+            np.ndarray: offline channels
+        """
+        key = (int(det), int(crate), int(slot), int(stream))
+        if key not in self.links:
+            self._AddLink(key, [self.cmap.get_offline_channel_from_det_crate_slot_stream_chan(*key, c) for c in range(n_channels)])
+        return self.links[key][:n_channels]
+
+
+    def OfflineChannelsFromFiber(self, crate : int, slot : int, fiber : int, n_channels : int = 256) -> np.ndarray:
+        """ Offline channel numbers of every channel in a (pre ethernet) WIB link.
+
+        Args:
+            crate (int): crate number
+            slot (int): slot number
+            fiber (int): fiber/link number
+            n_channels (int, optional): channels per link. Defaults to 256.
+
+        Returns:
+            np.ndarray: offline channels
+        """
+        key = (int(crate), int(slot), int(fiber))
+        if key not in self.links:
+            self._AddLink(key, [self.cmap.get_offline_channel_from_crate_slot_fiber_chan(*key, c) for c in range(n_channels)])
+        return self.links[key][:n_channels]
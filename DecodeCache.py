@@ -0,0 +1,206 @@
+"""
+Description: On disk cache of decoded fragments, so rerunning a script on the same records skips reading and decoding them.
+Each entry holds the decoded columns of one fragment as uncompressed numpy arrays, in a file named by the hash of what it was decoded from
+(file identity, record, source id, decoder and its version, channel map and detchannelmaps build). The least recently used entries are removed once the cache
+is bigger than its size limit. Entries are written to a temporary file and renamed, so several processes can share the cache.
+"""
+import Decoders
+from ChannelMaps import CacheDirectory
+from RecordIndex import FileKey
+
+import os
+import fcntl
+import hashlib
+import numpy as np
+
+CACHE_VERSION = 1 # bump if the layout of the cache files changes
+
+_cache = None # cache of this process, reused for each record
+
+
+def DecodeCacheDirectory() -> str:
+    """ Directory of the decoded fragment cache, next to the channel map cache.
+
+    Returns:
+        str: cache directory
+    """
+    return os.path.join(os.path.dirname(CacheDirectory()), "decoded")
+
+
+class DecodeCache:
+    """ Decoded fragments on disk, looked up by what they were decoded from.
+
+    Attributes:
+        directory (str): where the entries are stored
+        max_bytes (int): size limit, the least recently used entries are removed above it
+        refresh (bool): don't use existing entries, decode again and replace them
+        metrics (Metrics.Metrics): counts hits and misses, None to not count
+    """
+    def __init__(self, directory : str = None, max_bytes : int = 4 * 2**30, refresh : bool = False, metrics = None):
+        """
+        Args:
+            directory (str, optional): cache directory. Defaults to None (DecodeCacheDirectory()).
+            max_bytes (int, optional): size limit. Defaults to 4 GiB.
+            refresh (bool, optional): decode everything again, replacing the cached entries. Defaults to False.
+            metrics (Metrics.Metrics, optional): where to count hits and misses. Defaults to None.
+        """
+        self.directory = directory or DecodeCacheDirectory()
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.metrics = metrics
+        self._file_keys = {} # file name -> identity, so the file is only stat'd once
+        self._written = 0 # bytes written since the size of the cache was last checked
+
+
+    def Key(self, reader, rid, entry : np.ndarray, decoder : str) -> str:
+        """ Name of the cache entry of a fragment.
+
+        Args:
+            reader (Utilities.RawDataFile): open file
+            rid (tuple): record id
+            entry (np.ndarray): record index entry of the fragment
+            decoder (str): what the fragment is decoded with, e.g. tp or wibeth (and which columns, if only some are decoded)
+
+        Returns:
+            str: hash of everything the decoded columns depend on
+        """
+        if reader.filename not in self._file_keys:
+            self._file_keys[reader.filename] = "/".join(FileKey(reader.filename))
+        identity = [self._file_keys[reader.filename], str(rid[0]), str(rid[1]), str(entry["path"]), str(int(entry["element_id"])),
+                    decoder, str(Decoders.DECODER_VERSION), str(Decoders.TPVersion()), str(reader.cmap.name), reader.cmap.identity, str(CACHE_VERSION)]
+        return hashlib.sha1("\n".join(identity).encode()).hexdigest()
+
+
+    def _Path(self, key : str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+
+    def _Count(self, name : str):
+        if self.metrics is not None:
+            self.metrics.Count(name)
+
+
+    def Get(self, key : str) -> dict:
+        """ Read a cache entry.
+
+        Args:
+            key (str): entry name, made with Key
+
+        Returns:
+            dict: decoded columns, None if they aren't cached
+        """
+        if self.refresh:
+            self._Count("cache_misses")
+            return None
+        path = self._Path(key)
+        try:
+            with open(path, "rb") as f:
+                names = np.load(f)
+                columns = {str(n) : np.load(f) for n in names}
+                os.utime(f.fileno()) # the modification time is when the entry was last used
+        except FileNotFoundError:
+            self._Count("cache_misses")
+            return None
+        except (ValueError, EOFError, OSError):
+            #* damaged entry (e.g. the disk filled up while it was written), decode again
+            self._Remove(path)
+            self._Count("cache_misses")
+            return None
+        self._Count("cache_hits")
+        return columns
+
+
+    def Put(self, key : str, columns : dict):
+        """ Add a cache entry, replacing it if it exists.
+
+        Args:
+            key (str): entry name, made with Key
+            columns (dict): decoded columns, numpy arrays or numbers
+        """
+        path = self._Path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.save(f, np.array(list(columns), dtype=str))
+                for value in columns.values():
+                    np.save(f, np.asarray(value), allow_pickle=False)
+                size = f.tell()
+            os.replace(tmp, path)
+        except OSError:
+            self._Remove(tmp) # e.g. the disk is full, carry on without caching this fragment
+            return
+        self._written += size
+        if self._written > self.max_bytes // 16:
+            self.Evict()
+
+
+    def Evict(self):
+        """ Remove the least recently used entries until the cache is within its size limit.
+            Only one process evicts at a time, the others carry on if it is busy.
+        """
+        self._written = 0
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "evict.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            for subdirectory in os.scandir(self.directory):
+                if not subdirectory.is_dir():
+                    continue
+                for f in os.scandir(subdirectory.path):
+                    if not f.name.endswith(".npy"):
+                        continue # being written by another process
+                    try:
+                        stat = f.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, f.path))
+            total = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._Remove(path)
+                total -= size
+
+
+    def _Remove(self, path : str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # another process got there first
+
+
+def AddArguments(parser):
+    """ Add the decode cache options to a command line parser.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+    """
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="don't read or write the cache of decoded fragments")
+    parser.add_argument("--refresh-cache", dest="refresh_cache", action="store_true", help="decode every fragment again and replace its cache entry")
+    parser.add_argument("--cache-size", dest="cache_size", type=float, default=4, help="size limit of the cache of decoded fragments (GiB), the least recently used fragments are removed above it")
+
+
+def FromArguments(args, metrics = None) -> DecodeCache:
+    """ The cache of this process, with the command line options added with AddArguments.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+        metrics (Metrics.Metrics, optional): where to count hits and misses. Defaults to None.
+
+    Returns:
+        DecodeCache: cache, None if --no-cache
+    """
+    global _cache
+    if args.no_cache:
+        return None
+    max_bytes = int(args.cache_size * 2**30)
+    if _cache is None or (_cache.max_bytes, _cache.refresh) != (max_bytes, args.refresh_cache):
+        _cache = DecodeCache(max_bytes = max_bytes, refresh = args.refresh_cache)
+        if not os.path.isdir(_cache.directory):
+            print(f"caching decoded fragments in {_cache.directory}, up to {args.cache_size:g} GiB (--cache-size to change, --no-cache to turn off)")
+    _cache.metrics = metrics
+    return _cache
@@ -0,0 +1,435 @@
+"""
+Description: Bulk decoders which turn fragment payloads into columnar numpy arrays.
+"""
+import daqdataformats
+import fddetdataformats
+import trgdataformats
+
+import warnings
+import numpy as np
+
+DECODER_VERSION = 2 # bump if the decoded columns change, so cached decodes (DecodeCache.py) aren't used
+
+TICKS_PER_SAMPLE = 32 # 62.5 MHz timestamp clock, 512 ns between ADC samples
+
+#* daqdataformats FragmentHeader (version 5), the first bytes of every fragment dataset
+FRAGMENT_HEADER_MARKER = 0x11112222
+FRAGMENT_HEADER_DTYPE = np.dtype([
+    ("fragment_header_marker", "<u4"),
+    ("version", "<u4"),
+    ("size", "<u8"),
+    ("trigger_number", "<u8"),
+    ("trigger_timestamp", "<u8"),
+    ("window_begin", "<u8"),
+    ("window_end", "<u8"),
+    ("run_number", "<u4"),
+    ("error_bits", "<u4"),
+    ("fragment_type", "<u4"),
+    ("sequence_number", "<u2"),
+    ("detector_id", "<u2"),
+    ("source_id_version", "<u2"),
+    ("subsystem", "<u2"),
+    ("element_id", "<u4"),
+])
+
+#* TriggerPrimitive layouts, keyed by format version.
+# version 1 (dunedaq v4) is a plain struct, version 2 (dunedaq v5) packs everything into three 64 bit words.
+TP_DTYPES = {
+    1 : np.dtype([
+        ("time_start", "<u8"),
+        ("time_peak", "<u8"),
+        ("time_over_threshold", "<u8"),
+        ("channel", "<i4"),
+        ("adc_integral", "<u4"),
+        ("adc_peak", "<u2"),
+        ("detid", "<u2"),
+        ("type", "<i4"),
+        ("algorithm", "<i4"),
+        ("version", "<u2"),
+        ("flag", "<u2"),
+    ]),
+    2 : np.dtype([
+        ("word0", "<u8"), # version : 8, flag : 8, detid : 8, channel : 24, samples_over_threshold : 16
+        ("time_start", "<u8"),
+        ("word2", "<u8"), # samples_to_peak : 16, adc_integral : 32, adc_peak : 16
+    ]),
+}
+
+#* fields of trgdataformats.TriggerPrimitive for each format version
+TP_ATTRIBUTES = {
+    1 : ["version", "time_start", "time_peak", "time_over_threshold", "channel", "adc_integral", "adc_peak", "detid", "type", "algorithm", "flag"],
+    2 : ["version", "flag", "detid", "channel", "samples_over_threshold", "time_start", "samples_to_peak", "adc_integral", "adc_peak"],
+}
+
+
+def TPColumns() -> list:
+    """ Names of the columns returned by the TP decoders, same as the TP store table (minus record, source_id and plane).
+
+    Returns:
+        list: column names
+    """
+    return ["time_start", "time_peak", "time_over_threshold", "channel", "adc_integral", "adc_peak", "det_id"]
+
+
+def ParseFragmentHeaders(buffer : np.ndarray) -> np.ndarray:
+    """ Read fragment headers from raw bytes.
+
+    Args:
+        buffer (np.ndarray): bytes of one or more headers, back to back
+
+    Returns:
+        np.ndarray: headers as a structured array, None if the bytes don't look like fragment headers
+    """
+    buffer = np.ascontiguousarray(buffer).view(np.uint8) # hdf5 stores fragments as (signed) chars
+    n = len(buffer) // FRAGMENT_HEADER_DTYPE.itemsize
+    headers = buffer[:n * FRAGMENT_HEADER_DTYPE.itemsize].view(FRAGMENT_HEADER_DTYPE)
+    if n == 0 or np.any(headers["fragment_header_marker"] != FRAGMENT_HEADER_MARKER):
+        return None
+    return headers
+
+
+def ItemSizes() -> dict:
+    """ Size of the objects (TPs, WIB frames) which make up the payload of each fragment type.
+
+    Returns:
+        dict: fragment type code -> size in bytes
+    """
+    sizes = {
+        "kTriggerPrimitive" : trgdataformats.TriggerPrimitive,
+        "kProtoWIB" : fddetdataformats.WIBFrame,
+        "kWIB" : fddetdataformats.WIB2Frame,
+        "kWIBEth" : fddetdataformats.WIBEthFrame,
+    }
+    codes = {}
+    for name, cls in sizes.items():
+        if hasattr(daqdataformats.FragmentType, name):
+            codes[int(getattr(daqdataformats.FragmentType, name))] = cls.sizeof()
+    return codes
+
+
+def FragmentPayload(fragment) -> np.ndarray:
+    """ Get the fragment payload (everything after the header) as a uint8 array.
+
+    Args:
+        fragment (daqdataformats.fragment): fragment
+
+    Returns:
+        np.ndarray: payload bytes, None if the bindings can't expose the buffer
+    """
+    n_bytes = fragment.get_size() - fragment.get_header().sizeof()
+    try:
+        buffer = fragment.get_data_bytes()
+    except (AttributeError, TypeError):
+        return None
+    payload = np.frombuffer(buffer, dtype=np.uint8)
+    if len(payload) < n_bytes:
+        return None
+    return payload[:n_bytes]
+
+
+def TPVersion() -> int:
+    """ Work out which TP format the installed trgdataformats uses, based on the size of the TP struct.
+
+    Returns:
+        int: TP format version, None if no known layout matches
+    """
+    tp_size = trgdataformats.TriggerPrimitive.sizeof()
+    version = getattr(trgdataformats.TriggerPrimitive, "s_trigger_primitive_version", None)
+    if version in TP_DTYPES and TP_DTYPES[version].itemsize == tp_size:
+        return version
+    for v, dtype in TP_DTYPES.items():
+        if dtype.itemsize == tp_size:
+            return v
+    return None
+
+
+def TPTimesInSamples(tps : dict, version : int) -> dict:
+    """ Put the TP times in the units of TP format v2: time_peak is the samples from time_start to the peak and
+        time_over_threshold is in samples. Version 1 TPs have an absolute time_peak and count time over threshold in timestamp ticks.
+
+    Args:
+        tps (dict): TP columns
+        version (int): TP format version the columns were decoded with, e.g. from TPVersion
+
+    Returns:
+        dict: TP columns, the same ones unless version is 1
+    """
+    if version != 1:
+        return tps
+    tps = dict(tps)
+    if "time_peak" in tps:
+        tps["time_peak"] = (tps["time_peak"].astype(np.int64) - tps["time_start"].astype(np.int64)) // TICKS_PER_SAMPLE
+    if "time_over_threshold" in tps:
+        tps["time_over_threshold"] = tps["time_over_threshold"].astype(np.int64) // TICKS_PER_SAMPLE
+    return tps
+
+
+def UnpackTPs(payload : np.ndarray, version : int) -> dict:
+    """ Unpack a TP payload into columns.
+
+    Args:
+        payload (np.ndarray): fragment payload bytes
+        version (int): TP format version
+
+    Returns:
+        dict: column name -> numpy array, None if the payload does not look like TPs of this version
+    """
+    dtype = TP_DTYPES[version]
+    n_tps = len(payload) // dtype.itemsize
+    tps = payload[:n_tps * dtype.itemsize].view(dtype)
+
+    if version == 1:
+        if n_tps > 0 and np.any(tps["version"] != 1):
+            return None
+        return {
+            "time_start" : tps["time_start"],
+            "time_peak" : tps["time_peak"],
+            "time_over_threshold" : tps["time_over_threshold"],
+            "channel" : tps["channel"],
+            "adc_integral" : tps["adc_integral"],
+            "adc_peak" : tps["adc_peak"],
+            "det_id" : tps["detid"],
+        }
+
+    word0 = tps["word0"]
+    word2 = tps["word2"]
+    if n_tps > 0 and np.any((word0 & 0xFF) != 2):
+        return None
+    return {
+        "time_start" : tps["time_start"],
+        "time_peak" : (word2 & 0xFFFF).astype(np.uint16),
+        "time_over_threshold" : ((word0 >> 48) & 0xFFFF).astype(np.uint16),
+        "channel" : ((word0 >> 24) & 0xFFFFFF).astype(np.uint32),
+        "adc_integral" : ((word2 >> 16) & 0xFFFFFFFF).astype(np.uint32),
+        "adc_peak" : ((word2 >> 48) & 0xFFFF).astype(np.uint16),
+        "det_id" : ((word0 >> 16) & 0xFF).astype(np.uint8),
+    }
+
+
+def DecodeTPPayload(payload : np.ndarray) -> dict:
+    """ Decode all TPs in a fragment payload, the columns are views of the payload where possible.
+
+    Args:
+        payload (np.ndarray): fragment payload bytes, e.g. from Utilities.RawDataFile.Payloads
+
+    Returns:
+        dict: column name -> numpy array, None if the layout can't be verified
+    """
+    version = TPVersion()
+    if version is None:
+        return None
+    return UnpackTPs(payload, version)
+
+
+def TPChannels(payload : np.ndarray) -> np.ndarray:
+    """ Get only the channel of each TP in a fragment payload, without unpacking the other fields.
+
+    Args:
+        payload (np.ndarray): fragment payload bytes
+
+    Returns:
+        np.ndarray: channels, None if the layout can't be verified
+    """
+    version = TPVersion()
+    if version is None:
+        return None
+    dtype = TP_DTYPES[version]
+    tps = payload[:len(payload) // dtype.itemsize * dtype.itemsize].view(dtype)
+    if version == 1:
+        if len(tps) > 0 and np.any(tps["version"] != 1):
+            return None
+        return tps["channel"]
+    word0 = tps["word0"]
+    if len(tps) > 0 and np.any((word0 & 0xFF) != 2):
+        return None
+    return ((word0 >> 24) & 0xFFFFFF).astype(np.uint32) # same type as UnpackTPs
+
+
+def DecodeTPsPerObject(fragment) -> dict:
+    """ Decode TPs one at a time using the trgdataformats bindings, slow but always valid.
+
+    Args:
+        fragment (daqdataformats.fragment): fragment
+
+    Returns:
+        dict: column name -> numpy array
+    """
+    tp_size = trgdataformats.TriggerPrimitive.sizeof() # get size of TP packet in bytes
+    n_tps = (fragment.get_size()-fragment.get_header().sizeof())//tp_size # number of TP packets is the  fragment data size / tp size
+
+    peak, over_threshold = ("time_peak", "time_over_threshold") if TPVersion() == 1 else ("samples_to_peak", "samples_over_threshold") # names of the fields in the bindings
+
+    columns = {c : [] for c in TPColumns()}
+    for i in range(n_tps):
+        tp = trgdataformats.TriggerPrimitive(fragment.get_data(i*tp_size)) # get TP data from pointer in fragment
+        columns["time_start"].append(tp.time_start)
+        columns["time_peak"].append(getattr(tp, peak))
+        columns["time_over_threshold"].append(getattr(tp, over_threshold))
+        columns["channel"].append(tp.channel)
+        columns["adc_integral"].append(tp.adc_integral)
+        columns["adc_peak"].append(tp.adc_peak)
+        columns["det_id"].append(tp.detid)
+    return {k : np.array(v) for k, v in columns.items()}
+
+
+def DecodeTPs(fragment) -> dict:
+    """ Decode all TPs in a fragment in one go. Falls back to the per object decoder if the
+        payload can't be accessed directly or the layout can't be verified.
+
+    Args:
+        fragment (daqdataformats.fragment): fragment
+
+    Returns:
+        dict: column name -> numpy array
+    """
+    payload = FragmentPayload(fragment)
+    columns = DecodeTPPayload(payload) if payload is not None else None
+    if columns is None:
+        return DecodeTPsPerObject(fragment)
+    return columns
+
+
+#* bits of the first header word of each WIB frame which are the same for every frame from a link
+WIB_LINK_MASKS = {
+    "proto_wib" : 0x00FFFFFF, # sof : 8, version : 5, fiber_no : 3, crate_no : 5, slot_no : 3
+    "wib" : 0x03FFFFFF, # start_frame : 8, crate : 8, frame_version : 4, slot : 3, link : 3
+}
+
+
+def _WIBFrameChannelTable() -> tuple:
+    """ Where the 12 bit samples of each channel live in a (proto) WIBFrame.
+
+    The frame is a 4 word WIB header followed by 4 COLDATA blocks, each a 4 word header and 8 segments of 3 words.
+    A segment holds channels 0-3 of a pair of ADCs, each sample split across two bit fields:
+    low part (word, shift, bits) and high part (word, shift, bits).
+
+    Returns:
+        tuple: arrays of length 256 with the low word, shift, mask, high word, shift, mask and how far the high part is shifted up
+    """
+    #* (low word, shift, bits), (high word, shift, bits) within a segment, for [adc parity][channel]
+    segment = [
+        [((0, 0, 8), (0, 16, 4)), ((0, 20, 4), (1, 0, 8)), ((1, 16, 8), (2, 0, 4)), ((2, 4, 4), (2, 16, 8))],
+        [((0, 8, 8), (0, 24, 4)), ((0, 28, 4), (1, 8, 8)), ((1, 24, 8), (2, 8, 4)), ((2, 12, 4), (2, 24, 8))],
+    ]
+    table = np.zeros((7, 256), dtype=np.uint32)
+    for ch in range(256):
+        block, adc, c = ch // 64, (ch % 64) // 8, ch % 8
+        first_word = 4 + block * 28 + 4 + ((adc // 2) * 2 + c // 4) * 3 # wib header + previous blocks + coldata header + previous segments
+        (lw, ls, lb), (hw, hs, hb) = segment[adc % 2][c % 4]
+        table[:, ch] = [first_word + lw, ls, (1 << lb) - 1, first_word + hw, hs, (1 << hb) - 1, lb]
+    return tuple(table)
+
+
+def UnpackWIBFrames(payload : np.ndarray) -> tuple:
+    """ Unpack (proto) WIBFrames, 256 channels of 12 bit ADCs per frame.
+
+    Args:
+        payload (np.ndarray): fragment payload bytes
+
+    Returns:
+        tuple: ADCs (frames x 256), timestamps
+    """
+    frame_size = 464
+    n_frames = len(payload) // frame_size
+    words = np.ascontiguousarray(payload[:n_frames * frame_size]).view("<u4").reshape(n_frames, frame_size // 4)
+
+    low_word, low_shift, low_mask, high_word, high_shift, high_mask, high_offset = _WIBFrameChannelTable()
+    adc = ((words[:, low_word] >> low_shift) & low_mask) | (((words[:, high_word] >> high_shift) & high_mask) << high_offset)
+
+    #* timestamp_1 : 32, timestamp_2 : 16, wib_counter_1 : 15, z : 1, the counter is the top of the timestamp unless z is set
+    timestamps = words[:, 2].astype(np.uint64) | ((words[:, 3] & 0xFFFF).astype(np.uint64) << np.uint64(32))
+    counter = ((words[:, 3] >> 16) & 0x7FFF).astype(np.uint64)
+    z = (words[:, 3] >> 31) & 1
+    timestamps = np.where(z == 0, timestamps | (counter << np.uint64(48)), timestamps)
+    return adc.astype(np.uint16), timestamps
+
+
+def UnpackWIB2Frames(payload : np.ndarray) -> tuple:
+    """ Unpack WIB2Frames, 256 channels of 14 bit ADCs per frame packed back to back after a 4 word header.
+
+    Args:
+        payload (np.ndarray): fragment payload bytes
+
+    Returns:
+        tuple: ADCs (frames x 256), timestamps
+    """
+    frame_size = 472
+    n_frames = len(payload) // frame_size
+    frames = np.ascontiguousarray(payload[:n_frames * frame_size]).reshape(n_frames, frame_size)
+
+    #* each sample spans at most 3 bytes, so read 3 bytes from where it starts and shift the sample down
+    adc_bytes = frames[:, 16:16 + 448]
+    adc_bytes = np.concatenate([adc_bytes, np.zeros((n_frames, 2), dtype=np.uint8)], axis=1)
+    bit = 14 * np.arange(256)
+    first = bit // 8
+    packed = adc_bytes[:, first].astype(np.uint32) | (adc_bytes[:, first + 1].astype(np.uint32) << 8) | (adc_bytes[:, first + 2].astype(np.uint32) << 16)
+    adc = (packed >> (bit % 8).astype(np.uint32)) & 0x3FFF
+
+    words = frames[:, :16].view("<u4")
+    timestamps = words[:, 2].astype(np.uint64) | (words[:, 3].astype(np.uint64) << np.uint64(32))
+    return adc.astype(np.uint16), timestamps
+
+
+def DecodeWIBFramesPerObject(fragment, frontend : str) -> tuple:
+    """ Decode WIB frames one at a time using the fddetdataformats bindings, slow but always valid.
+
+    Args:
+        fragment (daqdataformats.fragment): fragment
+        frontend (str): proto_wib or wib
+
+    Returns:
+        tuple: ADCs (frames x 256), timestamps
+    """
+    wibFrame = fddetdataformats.WIBFrame if frontend == "proto_wib" else fddetdataformats.WIB2Frame
+    wibFrameSize = wibFrame.sizeof()
+    n_frames = (fragment.get_size()-fragment.get_header().sizeof())//wibFrameSize
+
+    adc = np.zeros((n_frames, 256), dtype=np.uint16)
+    timestamps = np.zeros(n_frames, dtype=np.uint64)
+    for i in range(n_frames):
+        wib = wibFrame(fragment.get_data(i*wibFrameSize))
+        timestamps[i] = wib.get_timestamp()
+        if frontend == "proto_wib":
+            adc[i] = [wib.get_channel(c) for c in range(256)]
+        else:
+            adc[i] = [wib.get_adc(c) for c in range(256)]
+    return adc, timestamps
+
+
+def DecodeWIBFrames(fragment, frontend : str) -> tuple:
+    """ Decode all pre ethernet WIB frames in a fragment in one go. The first and last frames are checked against the
+        fddetdataformats accessors, and every frame is checked to have the same link in its header and a later timestamp
+        than the one before. If any check fails the per object decoder is used instead.
+
+    Args:
+        fragment (daqdataformats.fragment): fragment
+        frontend (str): proto_wib or wib
+
+    Returns:
+        tuple: ADCs (frames x 256), timestamps
+    """
+    if frontend == "proto_wib":
+        wibFrame, unpack = fddetdataformats.WIBFrame, UnpackWIBFrames
+    elif frontend == "wib":
+        wibFrame, unpack = fddetdataformats.WIB2Frame, UnpackWIB2Frames
+    else:
+        raise Exception("front end type must be wib or proto_wib")
+
+    payload = FragmentPayload(fragment)
+    if payload is None or wibFrame.sizeof() != {"proto_wib" : 464, "wib" : 472}[frontend]:
+        return DecodeWIBFramesPerObject(fragment, frontend)
+
+    adc, timestamps = unpack(payload)
+    for i in (sorted({0, len(adc) - 1}) if len(adc) else []):
+        wib = wibFrame(fragment.get_data(i*wibFrame.sizeof()))
+        expected = [wib.get_channel(c) if frontend == "proto_wib" else wib.get_adc(c) for c in range(256)]
+        if timestamps[i] != wib.get_timestamp() or not np.array_equal(adc[i], expected):
+            warnings.warn("WIB frame layout doesn't match fddetdataformats, decoding frames one at a time")
+            return DecodeWIBFramesPerObject(fragment, frontend)
+
+    #* frames in the middle aren't compared with the bindings, but a corrupt or misaligned frame breaks the header or timestamp sequence
+    header = np.ascontiguousarray(payload[:len(adc) * wibFrame.sizeof()]).view("<u4").reshape(len(adc), -1)[:, 0] & WIB_LINK_MASKS[frontend]
+    if np.any(header != header[:1]) or np.any(timestamps[1:] <= timestamps[:-1]):
+        warnings.warn("WIB frames have inconsistent headers or timestamps, decoding frames one at a time")
+        return DecodeWIBFramesPerObject(fragment, frontend)
+    return adc, timestamps
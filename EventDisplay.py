@@ -0,0 +1,163 @@
+"""
+Description: Event displays of ADC arrays, drawn straight from numpy with imshow. One figure and colorbar is reused for every record,
+and records can be rendered in background processes while the next ones are decoded.
+"""
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+
+from concurrent.futures import ProcessPoolExecutor
+
+_display = None # display of this process, reused for each record
+
+
+def Pool(adc : np.ndarray, time : int = 1, channel : int = 1, mode : str = "max") -> np.ndarray:
+    """ Downsample a (time x channel) array by combining blocks of time x channel samples.
+        Samples left over at the end of an axis are dropped.
+
+    Args:
+        adc (np.ndarray): ADCs, (time x channel)
+        time (int, optional): samples to combine along time. Defaults to 1.
+        channel (int, optional): samples to combine along channel. Defaults to 1.
+        mode (str, optional): max keeps the sample furthest from zero (so negative induction lobes survive), mean averages. Defaults to "max".
+
+    Returns:
+        np.ndarray: pooled array, (time / time x channel / channel)
+    """
+    if time <= 1 and channel <= 1:
+        return adc
+    nt, nc = adc.shape[0] // time, adc.shape[1] // channel
+    blocks = adc[:nt * time, :nc * channel].reshape(nt, time, nc, channel).transpose(0, 2, 1, 3).reshape(nt, nc, time * channel)
+    if mode == "mean":
+        return blocks.mean(axis=2)
+    elif mode == "max":
+        i = np.abs(blocks).argmax(axis=2)
+        return np.take_along_axis(blocks, i[..., np.newaxis], axis=2)[..., 0]
+    else:
+        raise Exception("pooling mode must be max or mean")
+
+
+class EventDisplay:
+    """ Pedestal subtracted ADC map of a record, the figure, image and colorbar are created once and updated for each record.
+
+    Attributes:
+        pool (tuple): samples to combine along time and channel
+        mode (str): pooling mode, max or mean
+        dpi (int): resolution of the saved images
+        cmap (str): colour map
+    """
+    def __init__(self, pool : tuple = (1, 1), mode : str = "max", dpi : int = 150, cmap : str = "seismic"):
+        self.pool = pool
+        self.mode = mode
+        self.dpi = dpi
+        self.cmap = cmap
+        self.fig = None
+
+
+    def _Create(self):
+        self.fig, self.ax = plt.subplots()
+        self.image = self.ax.imshow(np.zeros((1, 1)), aspect="auto", origin="lower", interpolation="none", cmap=self.cmap)
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax, label="ADC - pedestal")
+        self.ax.set_xlabel("channel index")
+        self.ax.set_ylabel("time sample")
+
+
+    def Draw(self, adc : np.ndarray, title : str = None):
+        """ Draw a record.
+
+        Args:
+            adc (np.ndarray): ADCs, (time x channel)
+            title (str, optional): plot title. Defaults to None.
+        """
+        if self.fig is None:
+            self._Create()
+        adc = np.asarray(adc, dtype=np.float32)
+        adc = adc - adc.mean(axis=0) # pedestal of each channel
+        image = Pool(adc, *self.pool, self.mode)
+        limit = float(np.abs(image).max()) or 1
+        self.image.set_data(image)
+        self.image.set_extent((-0.5, adc.shape[1] - 0.5, -0.5, adc.shape[0] - 0.5)) # axes stay in samples and channels when pooled
+        self.image.set_clim(-limit, limit) # centre the colour map on the pedestal
+        self.ax.set_title(title or "")
+
+
+    def Save(self, filename : str):
+        """ Save the current display.
+
+        Args:
+            filename (str): image file
+        """
+        self.fig.savefig(filename, dpi=self.dpi)
+
+
+    def Close(self):
+        if self.fig is not None:
+            plt.close(self.fig)
+            self.fig = None
+
+
+def Render(adc : np.ndarray, filename : str, title : str = None, pool : tuple = (1, 1), mode : str = "max", dpi : int = 150) -> str:
+    """ Draw and save a record with the display of this process.
+
+    Args:
+        adc (np.ndarray): ADCs, (time x channel)
+        filename (str): image file
+        title (str, optional): plot title. Defaults to None.
+        pool (tuple, optional): samples to combine along time and channel. Defaults to (1, 1).
+        mode (str, optional): pooling mode. Defaults to "max".
+        dpi (int, optional): image resolution. Defaults to 150.
+
+    Returns:
+        str: image file
+    """
+    global _display
+    if _display is None or (_display.pool, _display.mode, _display.dpi) != (tuple(pool), mode, dpi):
+        if _display is not None: _display.Close()
+        _display = EventDisplay(tuple(pool), mode, dpi)
+    _display.Draw(adc, title)
+    _display.Save(filename)
+    return filename
+
+
+def _InitWorker():
+    matplotlib.use("Agg")
+
+
+class BackgroundRenderer:
+    """ Render event displays in worker processes, so drawing overlaps with decoding. Use as a context manager,
+        leaving it waits for every display to be written.
+    """
+    def __init__(self, workers : int, max_pending : int = None):
+        """
+        Args:
+            workers (int): number of worker processes
+            max_pending (int, optional): wait for the oldest display once this many are queued, bounds the memory held by queued records. Defaults to 2 x workers.
+        """
+        self.pool = ProcessPoolExecutor(workers, initializer = _InitWorker)
+        self.max_pending = max_pending or 2 * workers
+        self.pending = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def Submit(self, adc : np.ndarray, filename : str, title : str = None, pool : tuple = (1, 1), mode : str = "max", dpi : int = 150):
+        """ Queue a display, arguments are the same as Render.
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.pool.submit(Render, adc, filename, title, pool, mode, dpi))
+
+
+    def Close(self):
+        """ Wait for the queued displays and stop the workers.
+        """
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.pool.shutdown()
@@ -0,0 +1,482 @@
+"""
+Description: Fixed binning histograms which are filled as data is decoded. Histograms with the same binning can be merged,
+so results from different files or workers can be combined. Histograms of each time slice can be animated, drawing frames in parallel.
+Run as a script to merge saved histograms and plot them.
+"""
+import os
+import argparse
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+
+from concurrent.futures import ProcessPoolExecutor
+
+TP_LABELS = {"time_start" : "time since the first TP (ticks)", "time_peak" : "peak time (samples)", "time_over_threshold" : "time over threshold (samples)"}
+
+
+class Histogram1D:
+    """ Histogram with integer bin edges low + i * width.
+
+    Attributes:
+        low (int): lower edge of the first bin
+        width (int): bin width
+        counts (np.ndarray): entries in each bin
+        underflow (int): entries below the first bin
+        overflow (int): entries above the last bin
+        growable (bool): extend the range to fit the data instead of counting under/overflow
+    """
+    def __init__(self, low : int, width : int, bins : int, growable : bool = False):
+        self.low = int(low)
+        self.width = int(width)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.growable = growable
+
+
+    @property
+    def edges(self) -> np.ndarray:
+        return self.low + self.width * np.arange(len(self.counts) + 1)
+
+
+    def _Extend(self, first : int, last : int):
+        """ Grow the histogram so bins first to last (relative to the current low edge) exist.
+        """
+        if len(self.counts) == 0 and first <= last:
+            self.low += first * self.width
+            self.counts = np.zeros(last - first + 1, dtype=np.int64)
+            return
+        before = max(0, -first)
+        after = max(0, last - len(self.counts) + 1)
+        if before or after:
+            self.counts = np.concatenate([np.zeros(before, np.int64), self.counts, np.zeros(after, np.int64)])
+            self.low -= before * self.width
+
+
+    def Fill(self, values : np.ndarray):
+        """ Add values to the histogram.
+
+        Args:
+            values (np.ndarray): integer values
+        """
+        values = np.asarray(values).astype(np.int64)
+        if len(values) == 0:
+            return
+        index = (values - self.low) // self.width
+        if self.growable:
+            self._Extend(int(index.min()), int(index.max()))
+            index = (values - self.low) // self.width
+        inside = (index >= 0) & (index < len(self.counts))
+        self.underflow += int(np.count_nonzero(index < 0))
+        self.overflow += int(np.count_nonzero(index >= len(self.counts)))
+        self.counts += np.bincount(index[inside], minlength=len(self.counts))
+
+
+    def Merge(self, other : "Histogram1D"):
+        """ Add the contents of another histogram with the same binning.
+
+        Args:
+            other (Histogram1D): histogram to add
+        """
+        if self.width != other.width or (self.low - other.low) % self.width != 0:
+            raise Exception("can't merge histograms with different binning")
+        if len(other.counts) == 0:
+            pass
+        elif self.growable or len(self.counts) == 0:
+            offset = (other.low - self.low) // self.width
+            self._Extend(offset, offset + len(other.counts) - 1)
+        elif self.low != other.low or len(self.counts) != len(other.counts):
+            raise Exception("can't merge histograms with different binning")
+        offset = (other.low - self.low) // self.width
+        self.counts[offset:offset + len(other.counts)] += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+
+    def ToDict(self, prefix : str) -> dict:
+        return {
+            f"{prefix}/axes" : np.array([[self.low, self.width, len(self.counts)]]),
+            f"{prefix}/counts" : self.counts,
+            f"{prefix}/outside" : np.array([self.underflow, self.overflow, int(self.growable)]),
+        }
+
+
+    @classmethod
+    def FromDict(cls, data, prefix : str) -> "Histogram1D":
+        low, width, bins = data[f"{prefix}/axes"][0]
+        h = cls(low, width, bins, bool(data[f"{prefix}/outside"][2]))
+        h.counts = data[f"{prefix}/counts"].astype(np.int64)
+        h.underflow, h.overflow = [int(i) for i in data[f"{prefix}/outside"][:2]]
+        return h
+
+
+class Histogram2D:
+    """ 2D histogram with integer bin edges, entries outside the range are counted but not binned.
+
+    Attributes:
+        x (tuple): low, width, bins of the x axis
+        y (tuple): low, width, bins of the y axis
+        counts (np.ndarray): entries in each bin, shape (x bins, y bins)
+        outside (int): entries outside the histogram
+    """
+    def __init__(self, x : tuple, y : tuple):
+        self.x = tuple(int(i) for i in x)
+        self.y = tuple(int(i) for i in y)
+        self.counts = np.zeros((self.x[2], self.y[2]), dtype=np.int64)
+        self.outside = 0
+
+
+    @property
+    def xedges(self) -> np.ndarray:
+        return self.x[0] + self.x[1] * np.arange(self.x[2] + 1)
+
+
+    @property
+    def yedges(self) -> np.ndarray:
+        return self.y[0] + self.y[1] * np.arange(self.y[2] + 1)
+
+
+    def Fill(self, x : np.ndarray, y : np.ndarray):
+        """ Add entries to the histogram.
+
+        Args:
+            x (np.ndarray): integer x values
+            y (np.ndarray): integer y values
+        """
+        i = (np.asarray(x).astype(np.int64) - self.x[0]) // self.x[1]
+        j = (np.asarray(y).astype(np.int64) - self.y[0]) // self.y[1]
+        inside = (i >= 0) & (i < self.x[2]) & (j >= 0) & (j < self.y[2])
+        self.outside += int(np.count_nonzero(~inside))
+        self.counts += np.bincount(i[inside] * self.y[2] + j[inside], minlength=self.counts.size).reshape(self.counts.shape)
+
+
+    def Merge(self, other : "Histogram2D"):
+        """ Add the contents of another histogram with the same binning.
+
+        Args:
+            other (Histogram2D): histogram to add
+        """
+        if self.x != other.x or self.y != other.y:
+            raise Exception("can't merge histograms with different binning")
+        self.counts += other.counts
+        self.outside += other.outside
+
+
+    def ToDict(self, prefix : str) -> dict:
+        return {
+            f"{prefix}/axes" : np.array([self.x, self.y]),
+            f"{prefix}/counts" : self.counts,
+            f"{prefix}/outside" : np.array([self.outside]),
+        }
+
+
+    @classmethod
+    def FromDict(cls, data, prefix : str) -> "Histogram2D":
+        x, y = data[f"{prefix}/axes"]
+        h = cls(x, y)
+        h.counts = data[f"{prefix}/counts"].astype(np.int64)
+        h.outside = int(data[f"{prefix}/outside"][0])
+        return h
+
+
+class SliceHistograms:
+    """ One 2D histogram per time slice, all with the same bin edges, stored as a (slice x x bins x y bins) count cube.
+        Slices are added as the data is decoded, so only the counts are kept.
+
+    Attributes:
+        x (tuple): low, width, bins of the x axis
+        y (tuple): low, width, bins of the y axis
+        counts (np.ndarray): entries in each bin of each slice, (slice x x bins x y bins)
+        titles (list): title of each slice
+    """
+    def __init__(self, x : tuple, y : tuple):
+        self.x = tuple(int(i) for i in x)
+        self.y = tuple(int(i) for i in y)
+        self.counts = np.zeros((0, self.x[2], self.y[2]), dtype=np.uint32)
+        self.titles = []
+
+
+    def __len__(self):
+        return len(self.titles)
+
+
+    @property
+    def xedges(self) -> np.ndarray:
+        return self.x[0] + self.x[1] * np.arange(self.x[2] + 1)
+
+
+    @property
+    def yedges(self) -> np.ndarray:
+        return self.y[0] + self.y[1] * np.arange(self.y[2] + 1)
+
+
+    def AddSlices(self, titles : list):
+        """ Add empty slices.
+
+        Args:
+            titles (list): title of each new slice
+        """
+        n = len(self.titles) + len(titles)
+        if n > len(self.counts):
+            #* grow the cube geometrically so adding slices one at a time doesn't copy it every time
+            grown = np.zeros((max(n, 2 * len(self.counts)), self.x[2], self.y[2]), dtype=self.counts.dtype)
+            grown[:len(self.titles)] = self.counts[:len(self.titles)]
+            self.counts = grown
+        self.titles.extend(titles)
+
+
+    def Fill(self, slices : np.ndarray, x : np.ndarray, y : np.ndarray):
+        """ Add entries to any number of slices in one pass, entries outside the histograms are dropped.
+
+        Args:
+            slices (int or np.ndarray): slice of each entry
+            x (np.ndarray): integer x values
+            y (np.ndarray): integer y values
+        """
+        i = (np.asarray(x).astype(np.int64) - self.x[0]) // self.x[1]
+        j = (np.asarray(y).astype(np.int64) - self.y[0]) // self.y[1]
+        s = np.broadcast_to(np.asarray(slices, dtype=np.int64), i.shape)
+        inside = (i >= 0) & (i < self.x[2]) & (j >= 0) & (j < self.y[2])
+        flat = (s[inside] * self.x[2] + i[inside]) * self.y[2] + j[inside]
+        if len(flat) == 0:
+            return
+        first = int(flat.min()) // (self.x[2] * self.y[2])
+        last = int(flat.max()) // (self.x[2] * self.y[2]) + 1
+        offset = first * self.x[2] * self.y[2]
+        #* only count over the slices which were filled, the rest of the cube can be much bigger
+        self.counts[first:last] += np.bincount(flat - offset, minlength=(last - first) * self.x[2] * self.y[2]).reshape(last - first, self.x[2], self.y[2]).astype(self.counts.dtype)
+
+
+    def Cube(self) -> np.ndarray:
+        """ Counts of the slices added so far.
+
+        Returns:
+            np.ndarray: (slice x x bins x y bins)
+        """
+        return self.counts[:len(self.titles)]
+
+
+class HistogramSet(dict):
+    """ Named collection of histograms, which can be saved, loaded and merged as one.
+    """
+    def Merge(self, other : "HistogramSet"):
+        """ Merge another set into this one, histograms only in other are copied over.
+
+        Args:
+            other (HistogramSet): histograms to add
+        """
+        for name, h in other.items():
+            if name in self:
+                self[name].Merge(h)
+            else:
+                self[name] = h
+
+
+    def Save(self, filename : str):
+        """ Write histograms to a npz file.
+
+        Args:
+            filename (str): output file
+        """
+        data = {}
+        for name, h in self.items():
+            data.update(h.ToDict(name))
+        data["names"] = np.array(list(self.keys()))
+        data["kinds"] = np.array([type(h).__name__ for h in self.values()])
+        np.savez_compressed(filename, **data)
+
+
+    @classmethod
+    def Load(cls, filename : str) -> "HistogramSet":
+        """ Read histograms written with Save.
+
+        Args:
+            filename (str): npz file
+
+        Returns:
+            HistogramSet: histograms
+        """
+        kinds = {"Histogram1D" : Histogram1D, "Histogram2D" : Histogram2D}
+        hists = cls()
+        with np.load(filename) as data:
+            for name, kind in zip(data["names"], data["kinds"]):
+                hists[str(name)] = kinds[str(kind)].FromDict(data, str(name))
+        return hists
+
+
+def TPHistograms(cmap) -> HistogramSet:
+    """ Histograms for TP validation plots: one per TP field and channel vs peak time for each plane.
+        Times are in the units of TP format v2 (see FillTPHistograms), with time_start relative to the start of the file.
+
+    Args:
+        cmap (ChannelMaps.ChannelMap): channel map, used to set the channel range
+
+    Returns:
+        HistogramSet: empty histograms
+    """
+    known = np.flatnonzero(cmap.plane >= 0)
+    n_channels = int(known.max()) + 1 if len(known) else len(cmap.plane)
+    hists = HistogramSet({
+        "time_start" : Histogram1D(0, 2**20, 0, growable = True), # ticks since the first TP of the file, ~17 ms bins so different files line up
+        "time_peak" : Histogram1D(0, 1, 256), # samples after time_start
+        "time_over_threshold" : Histogram1D(0, 1, 512), # samples
+        "channel" : Histogram1D(0, 1, n_channels),
+        "adc_integral" : Histogram1D(0, 500, 200),
+        "adc_peak" : Histogram1D(0, 64, 256), # 14 bit ADC
+        "det_id" : Histogram1D(0, 1, 32),
+        "plane" : Histogram1D(-1, 1, 4),
+    })
+    for p, name in enumerate(["u", "v", "z"]):
+        channels = np.flatnonzero(cmap.plane == p)
+        low, high = (int(channels.min()), int(channels.max()) + 1) if len(channels) else (0, n_channels)
+        hists[f"channel_time_peak_{name}"] = Histogram2D((low, 1, high - low), (0, 1, 256))
+    return hists
+
+
+def TPSliceHistograms(cmap, bins : tuple = (100, 100)) -> SliceHistograms:
+    """ Channel vs peak time of each time slice, for the TP animation. Uses the same ranges as the TPHistograms.
+
+    Args:
+        cmap (ChannelMaps.ChannelMap): channel map, used to set the channel range
+        bins (tuple, optional): about how many channel and peak time bins, bins are a whole number of channels/ticks wide. Defaults to (100, 100).
+
+    Returns:
+        SliceHistograms: empty histograms
+    """
+    known = np.flatnonzero(cmap.plane >= 0)
+    n_channels = int(known.max()) + 1 if len(known) else len(cmap.plane)
+    axes = []
+    for n, b in [(n_channels, bins[0]), (256, bins[1])]:
+        width = -(-n // max(int(b), 1))
+        axes.append((0, width, -(-n // width)))
+    return SliceHistograms(*axes)
+
+
+def FillTPHistograms(hists : HistogramSet, tps : dict, time_origin : int = 0):
+    """ Fill TP validation histograms.
+
+    Args:
+        hists (HistogramSet): histograms made with TPHistograms
+        tps (dict): TP columns (including plane), with time_peak and time_over_threshold in samples (Decoders.TPTimesInSamples)
+        time_origin (int, optional): subtracted from time_start, e.g. the first timestamp of the file. Defaults to 0.
+    """
+    tps = {**tps, "time_start" : tps["time_start"].astype(np.int64) - time_origin}
+    for name, h in hists.items():
+        if isinstance(h, Histogram1D):
+            h.Fill(tps[name])
+    for p, name in enumerate(["u", "v", "z"]):
+        mask = tps["plane"] == p
+        hists[f"channel_time_peak_{name}"].Fill(tps["channel"][mask], tps["time_peak"][mask])
+
+
+def PlotHistograms(hists : HistogramSet, outdir : str):
+    """ Plot each histogram to a png.
+
+    Args:
+        hists (HistogramSet): histograms
+        outdir (str): output directory
+    """
+    os.makedirs(outdir, exist_ok=True)
+    for key, h in hists.items():
+        print(f"Plotting {key}")
+        plt.figure()
+        if isinstance(h, Histogram1D):
+            filled = np.flatnonzero(h.counts)
+            if len(filled):
+                counts = h.counts[filled[0]:filled[-1]+1]
+                plt.stairs(counts, h.edges[filled[0]:filled[-1]+2])
+            plt.xlabel(TP_LABELS.get(key, key))
+            plt.yscale("log")
+        else:
+            plt.pcolormesh(h.xedges, h.yedges, h.counts.T, norm=matplotlib.colors.LogNorm() if h.counts.any() else None)
+            plt.colorbar()
+            plt.xlabel("channel")
+            plt.ylabel("peak time")
+            plt.title(f"Plane : {key.split('_')[-1]}")
+        plt.tight_layout()
+        plt.savefig(f"{outdir}/{key}.png")
+        plt.close()
+
+
+def RenderSlices(counts : np.ndarray, titles : list, xedges : np.ndarray, yedges : np.ndarray, vmax : int, labels : tuple = ("x", "y"), dpi : int = 100) -> list:
+    """ Draw slices of a SliceHistograms cube. The figure is made once and the image is updated for each slice.
+
+    Args:
+        counts (np.ndarray): (slice x x bins x y bins)
+        titles (list): title of each slice
+        xedges (np.ndarray): x bin edges
+        yedges (np.ndarray): y bin edges
+        vmax (int): top of the colour scale, the same for every slice
+        labels (tuple, optional): x and y axis labels. Defaults to ("x", "y").
+        dpi (int, optional): resolution of the frames. Defaults to 100.
+
+    Returns:
+        list: frames, as palette images ready to be written to a gif
+    """
+    from PIL import Image # matplotlib depends on pillow, so it is always there
+    fig, ax = plt.subplots(dpi=dpi)
+    image = ax.imshow(np.zeros((len(yedges) - 1, len(xedges) - 1)), aspect="auto", origin="lower", interpolation="none",
+                      extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]), norm=matplotlib.colors.LogNorm(1, max(vmax, 1)))
+    fig.colorbar(image, ax=ax)
+    ax.set_xlabel(labels[0])
+    ax.set_ylabel(labels[1])
+
+    #* the axes are drawn once, then only the image and title are redrawn on top of them for each frame
+    image.set_animated(True)
+    ax.title.set_animated(True)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    frames = []
+    for c, title in zip(counts, titles):
+        fig.canvas.restore_region(background)
+        image.set_data(np.ma.masked_equal(c.T, 0))
+        ax.set_title(title)
+        ax.draw_artist(image)
+        ax.draw_artist(ax.title)
+        frames.append(Image.fromarray(np.asarray(fig.canvas.buffer_rgba())[..., :3]).quantize(method=Image.Quantize.FASTOCTREE)) # a palette image is a third of the size
+    plt.close(fig)
+    return frames
+
+
+def SaveAnimation(hists : SliceHistograms, filename : str, labels : tuple = ("x", "y"), workers : int = 1, interval : int = 200, dpi : int = 100):
+    """ Write each slice of a SliceHistograms as a frame of a gif.
+
+    Args:
+        hists (SliceHistograms): histograms
+        filename (str): gif file
+        labels (tuple, optional): x and y axis labels. Defaults to ("x", "y").
+        workers (int, optional): processes drawing frames, split into blocks of consecutive slices. Defaults to 1.
+        interval (int, optional): time between frames (ms). Defaults to 200.
+        dpi (int, optional): resolution of the frames. Defaults to 100.
+    """
+    cube = hists.Cube()
+    if len(cube) == 0:
+        raise Exception("there are no slices to animate")
+    vmax = int(cube.max())
+    blocks = np.array_split(np.arange(len(cube)), min(max(workers, 1), len(cube)))
+    jobs = [(cube[b], hists.titles[b[0]:b[-1] + 1], hists.xedges, hists.yedges, vmax, labels, dpi) for b in blocks]
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_InitWorker) as pool:
+            frames = [f for block in pool.map(RenderSlices, *zip(*jobs)) for f in block]
+    else:
+        frames = RenderSlices(*jobs[0])
+    frames[0].save(filename, save_all=True, append_images=frames[1:], duration=interval, loop=0)
+
+
+def _InitWorker():
+    matplotlib.use("Agg")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge saved histograms and plot them")
+    parser.add_argument(dest="files", type=str, nargs="+", help="histogram files to merge.")
+    parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory to store plots")
+    parser.add_argument("-s", "--save", dest="save", type=str, default=None, help="write the merged histograms to this file")
+    args = parser.parse_args()
+
+    merged = HistogramSet()
+    for f in args.files:
+        merged.Merge(HistogramSet.Load(f))
+    if args.save:
+        merged.Save(args.save)
+    PlotHistograms(merged, args.outdir)
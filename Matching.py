@@ -0,0 +1,272 @@
+"""
+Description: Pair TPs from a TP stream file with the raw ADCs written by writeRawData, on the same channel and time, to validate TP generation.
+Both sides are sorted together by (channel, timestamp) and joined in one pass. The waveforms are read a few records at a time,
+and only the TPs in their time window are decoded (using the TP index), so memory is bounded however long the run is.
+"""
+import Utilities
+import Decoders
+import TPIndex
+import TPFinder
+import Metrics
+
+import os
+import argparse
+import h5py
+import numpy as np
+import pandas as pd
+
+#* one row per matched TP: the TP, where it was found in the waveforms and what the waveforms give for the same quantities
+MATCH_DTYPE = np.dtype([
+    ("record", "<i8"), # record number in the waveform file
+    ("channel", "<u4"),
+    ("plane", "i1"),
+    ("time_start", "<u8"),
+    ("sample", "<i8"), # sample of time_start in the record
+    ("adc_peak", "<u2"),
+    ("adc_integral", "<u4"),
+    ("time_over_threshold", "<u4"), # samples
+    ("wave_peak", "<i4"),
+    ("wave_integral", "<i8"),
+    ("wave_time_over_threshold", "<u4"),
+    ("peak_residual", "<i4"),
+    ("integral_residual", "<i8"),
+    ("time_over_threshold_residual", "<i4"),
+    ("truncated", "?"), # snippet went past the end of the record
+])
+
+
+def MatchSegments(tp_channel : np.ndarray, tp_time : np.ndarray, seg_channel : np.ndarray, seg_begin : np.ndarray, seg_end : np.ndarray) -> np.ndarray:
+    """ Find the waveform segment (channel, first and last timestamp) containing each TP.
+        TPs and segments are sorted together by (channel, timestamp), segments before TPs at the same time,
+        so the segment a TP falls in is the last one before it, found in one pass with a running maximum.
+
+    Args:
+        tp_channel (np.ndarray): channel of each TP
+        tp_time (np.ndarray): time_start of each TP
+        seg_channel (np.ndarray): channel of each segment
+        seg_begin (np.ndarray): first timestamp of each segment
+        seg_end (np.ndarray): last timestamp of each segment
+
+    Returns:
+        np.ndarray: index of the segment of each TP, -1 if there isn't one
+    """
+    n_segments = len(seg_channel)
+    channel = np.concatenate([np.asarray(seg_channel, dtype=np.int64), np.asarray(tp_channel, dtype=np.int64)])
+    time = np.concatenate([np.asarray(seg_begin, dtype=np.uint64), np.asarray(tp_time, dtype=np.uint64)])
+    is_tp = np.arange(len(channel)) >= n_segments
+    order = np.lexsort((is_tp, time, channel))
+
+    tps = is_tp[order]
+    last = np.maximum.accumulate(np.where(tps, -1, np.arange(len(order)))) # position of the most recent segment in the merged order
+    segment = np.full(len(tp_channel), -1, dtype=np.int64)
+    segment[order[tps] - n_segments] = np.where(last[tps] >= 0, order[last[tps]], -1)
+
+    #* the previous segment could be on another channel, or end before the TP
+    found = segment >= 0
+    s = segment[found]
+    found[found] = (np.asarray(seg_channel)[s] == np.asarray(tp_channel)[found]) & (np.asarray(seg_end, dtype=np.uint64)[s] >= np.asarray(tp_time, dtype=np.uint64)[found])
+    segment[~found] = -1
+    return segment
+
+
+def Snippets(adc : np.ndarray, column : np.ndarray, sample : np.ndarray, pre : int, length : int) -> tuple:
+    """ ADCs around each TP, gathered for all TPs at once.
+
+    Args:
+        adc (np.ndarray): pedestal subtracted ADCs, (time x channel)
+        column (np.ndarray): column of each TP
+        sample (np.ndarray): sample of each TP's time_start
+        pre (int): samples before time_start
+        length (int): samples in each snippet
+
+    Returns:
+        tuple: snippets (TP x length, 0 outside the record), whether each snippet was cut off by the ends of the record
+    """
+    samples = sample[:, np.newaxis] - pre + np.arange(length)
+    inside = (samples >= 0) & (samples < len(adc))
+    snippets = np.where(inside, adc[np.clip(samples, 0, len(adc) - 1), column[:, np.newaxis]], 0)
+    return snippets, ~inside.all(axis=1)
+
+
+def WaveformQuantities(snippets : np.ndarray, pre : int, time_over_threshold : np.ndarray, threshold : int) -> tuple:
+    """ Peak, integral and time over threshold measured from the waveform, over the samples each TP covers.
+
+    Args:
+        snippets (np.ndarray): pedestal subtracted snippets (TP x length)
+        pre (int): samples before time_start in the snippets
+        time_over_threshold (np.ndarray): samples covered by each TP
+        threshold (int): threshold above pedestal
+
+    Returns:
+        tuple: peak, integral and consecutive samples over threshold from time_start
+    """
+    after = snippets[:, pre:]
+    covered = np.arange(after.shape[1]) < np.asarray(time_over_threshold, dtype=np.int64)[:, np.newaxis]
+    peak = np.where(covered, after, np.iinfo(np.int32).min).max(axis=1, initial=np.iinfo(np.int32).min)
+    integral = np.where(covered, after, 0).sum(axis=1, dtype=np.int64)
+    over = after > threshold
+    tot = np.where(over.all(axis=1), after.shape[1], np.argmin(over, axis=1)) # first sample back under threshold
+    return peak, integral, tot
+
+
+class MatchWriter:
+    """ Matched TPs and their snippets, appended to an hdf5 file as they are made.
+
+    Datasets:
+        matches (TP): MATCH_DTYPE table
+        snippets (TP, length): pedestal subtracted ADCs around each TP
+    """
+    def __init__(self, filename : str, length : int, pre : int):
+        self.file = h5py.File(filename, "w")
+        self.file.attrs["pre"] = pre
+        self.file.create_dataset("matches", shape = (0,), maxshape = (None,), chunks = (4096,), dtype = MATCH_DTYPE, compression = "gzip", shuffle = True)
+        self.file.create_dataset("snippets", shape = (0, length), maxshape = (None, length), chunks = (max(1, 2**16 // length), length), dtype = np.int16, compression = "gzip", shuffle = True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    def Append(self, matches : np.ndarray, snippets : np.ndarray):
+        n = len(self.file["matches"])
+        for name, data in [("matches", matches), ("snippets", snippets)]:
+            self.file[name].resize(n + len(data), axis = 0)
+            self.file[name][n:] = data
+
+
+def MatchRecords(waveforms : h5py.File, reader : Utilities.RawDataFile, tp_index : TPIndex.TPIndex, batch : int = 4, pre : int = 8, length : int = 64, threshold : int = 60):
+    """ Match TPs to the waveforms a batch of records at a time.
+
+    Args:
+        waveforms (h5py.File): file written by writeRawData (Writers.WaveformWriter)
+        reader (Utilities.RawDataFile): TP stream file, records in reader.toStudy are searched
+        tp_index (TPIndex.TPIndex): TP index of the TP stream file
+        batch (int, optional): waveform records read at once. Defaults to 4.
+        pre (int, optional): samples before time_start in each snippet. Defaults to 8.
+        length (int, optional): samples in each snippet. Defaults to 64.
+        threshold (int, optional): threshold above pedestal used for the waveform time over threshold. Defaults to 60.
+
+    Yields:
+        tuple: matches (MATCH_DTYPE), snippets (TP x length), number of TPs in the time window of the batch which didn't match
+    """
+    metrics = reader.metrics
+    tot_in_ticks = Decoders.TPVersion() == 1 # version 1 TPs count time over threshold in timestamp ticks, not samples
+    n_records = len(waveforms["record"])
+    for first in range(0, n_records, batch):
+        with metrics.Timer("read"):
+            n_samples = waveforms["n_samples"][first:first + batch]
+            timestamps = waveforms["timestamps"][first:first + batch]
+            channels = waveforms["channel"][first:first + batch]
+            planes = waveforms["plane"][first:first + batch]
+            records = waveforms["record"][first:first + batch]
+            adc = waveforms["adc"][first:first + batch]
+
+        #* one segment per (record, column)
+        n_channels = channels.shape[1]
+        seg_record = np.repeat(np.arange(len(records)), n_channels)
+        seg_column = np.tile(np.arange(n_channels), len(records))
+        seg_begin = timestamps[:, 0].astype(np.uint64)[seg_record]
+        seg_end = timestamps[np.arange(len(records)), n_samples - 1].astype(np.uint64)[seg_record]
+        time_range = (int(seg_begin.min()), int(seg_end.max()))
+        channel_range = (int(channels.min()), int(channels.max()))
+
+        parts = [tps for rid in reader.toStudy for _, _, tps in tp_index.Select(reader, rid, time_range, channel_range)]
+        if len(parts) == 0:
+            continue
+        tps = {k : np.concatenate([p[k] for p in parts]) for k in ["time_start", "time_over_threshold", "channel", "adc_integral", "adc_peak"]}
+        metrics.Count("tps", len(tps["channel"]))
+
+        with metrics.Timer("match"):
+            segment = MatchSegments(tps["channel"], tps["time_start"], channels.ravel(), seg_begin, seg_end)
+        matched = segment >= 0
+        tps = {k : v[matched] for k, v in tps.items()}
+        segment = segment[matched]
+
+        matches = np.zeros(len(segment), dtype=MATCH_DTYPE)
+        snippets = np.zeros((len(segment), length), dtype=np.int16)
+        with metrics.Timer("snippets"):
+            for r in np.unique(seg_record[segment]):
+                rows = np.flatnonzero(seg_record[segment] == r)
+                record_adc = adc[r, :n_samples[r]].astype(np.int32)
+                record_adc -= TPFinder.Pedestals(record_adc)
+                record_timestamps = timestamps[r, :n_samples[r]]
+                column = seg_column[segment[rows]]
+                time_start = tps["time_start"][rows]
+                sample = np.searchsorted(record_timestamps, time_start, side="right") - 1
+                tot = tps["time_over_threshold"][rows].astype(np.int64)
+                if tot_in_ticks and n_samples[r] > 1:
+                    tot = tot // max(1, int(np.median(np.diff(record_timestamps))))
+
+                s, truncated = Snippets(record_adc, column, sample, pre, length)
+                peak, integral, wave_tot = WaveformQuantities(s, pre, tot, threshold)
+                for name, value in [("record", records[r]), ("channel", tps["channel"][rows]), ("plane", planes[r, column]), ("time_start", time_start), ("sample", sample),
+                                    ("adc_peak", tps["adc_peak"][rows]), ("adc_integral", tps["adc_integral"][rows]), ("time_over_threshold", tot),
+                                    ("wave_peak", peak), ("wave_integral", integral), ("wave_time_over_threshold", wave_tot), ("truncated", truncated)]:
+                    matches[name][rows] = value
+                snippets[rows] = np.clip(s, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+        matches["peak_residual"] = matches["adc_peak"].astype(np.int64) - matches["wave_peak"]
+        matches["integral_residual"] = matches["adc_integral"].astype(np.int64) - matches["wave_integral"]
+        matches["time_over_threshold_residual"] = matches["time_over_threshold"].astype(np.int64) - matches["wave_time_over_threshold"]
+        metrics.Count("matched", len(matches))
+        metrics.Progress()
+        yield matches, snippets, int(np.count_nonzero(~matched))
+
+
+def Summary(matches : pd.DataFrame) -> pd.DataFrame:
+    """ Mean and spread of the residuals on each plane.
+
+    Args:
+        matches (pd.DataFrame): matched TPs
+
+    Returns:
+        pd.DataFrame: residual statistics by plane
+    """
+    residuals = ["peak_residual", "integral_residual", "time_over_threshold_residual"]
+    return matches.groupby("plane")[residuals].agg(["count", "mean", "std", "median"])
+
+
+def main(args):
+    metrics = Metrics.FromArguments(args)
+    os.makedirs(args.outdir, exist_ok=True)
+    outfile = f"{args.outdir}/tp_waveform_matches.hdf5"
+    unmatched = 0
+    with Utilities.OpenFile(args.tp_file, args.records, args.channelMap, metrics, Utilities.FragmentFilter(fragmentTypes = "TriggerPrimitive")) as reader, h5py.File(args.waveform_file, "r") as waveforms, MatchWriter(outfile, args.length, args.pre) as writer:
+        with metrics.Timer("tp_index"):
+            tp_index = TPIndex.TPIndex(reader)
+        for matches, snippets, n_unmatched in MatchRecords(waveforms, reader, tp_index, args.batch, args.pre, args.length, args.threshold):
+            with metrics.Timer("write"):
+                writer.Append(matches, snippets)
+            unmatched += n_unmatched
+
+    with h5py.File(outfile, "r") as f:
+        matches = pd.DataFrame(f["matches"].fields(["plane", "peak_residual", "integral_residual", "time_over_threshold_residual"])[:])
+    print(f"{len(matches)} TPs matched to waveforms, {unmatched} TPs in the waveform time windows had no waveform on their channel")
+    print(Summary(matches))
+    print(f"matches and snippets written to {outfile}")
+    metrics.Report(args.metrics, args.metrics_format)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match TPs to the raw waveforms on the same channel and time")
+    parser.add_argument(dest="tp_file", type=str, help="TP stream file.")
+    parser.add_argument(dest="waveform_file", type=str, help="waveform file written by writeRawData.")
+    parser.add_argument("-r", "--records", dest="records", type=str, default="all", help="records of the TP stream file to search (see Utilities.ParseRecordMap)")
+    parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory")
+    parser.add_argument("-c", "--channel-map", dest="channelMap", choices=["VDColdboxChannelMap", "ProtoDUNESP1ChannelMap", "PD2HDChannelMap", "HDColdboxChannelMap", "PD2VDTPCChannelMap"], help="channel maps for ProtoDUNE")
+    parser.add_argument("--batch", dest="batch", type=int, default=4, help="waveform records read at once, sets the memory used")
+    parser.add_argument("--pre", dest="pre", type=int, default=8, help="samples before time_start in each snippet")
+    parser.add_argument("--length", dest="length", type=int, default=64, help="samples in each snippet")
+    parser.add_argument("--threshold", dest="threshold", type=int, default=60, help="threshold above pedestal (ADC) for the time over threshold measured from the waveforms")
+    Metrics.AddArguments(parser)
+    args = parser.parse_args()
+    main(args)
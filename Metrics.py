@@ -0,0 +1,159 @@
+"""
+Description: Per stage timers and counters for the readers, enabled with --metrics. When disabled every call returns straight away,
+so the instrumentation can stay in the hot loops.
+"""
+import sys
+import json
+import time
+import contextlib
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics : "Metrics", name : str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        timer = self.metrics.timers.setdefault(self.name, [0.0, 0])
+        timer[0] += time.perf_counter() - self.start
+        timer[1] += 1
+
+
+class Metrics:
+    """ Collects how long each stage takes and how much data went through it.
+
+    Attributes:
+        enabled (bool): collect metrics
+        progress (float): seconds between progress lines, 0 for none
+        timers (dict): stage -> [total seconds, calls]
+        counters (dict): name -> count e.g. records, fragments, bytes_read, tps, frames, unknown_channels
+    """
+    def __init__(self, enabled : bool = False, progress : float = 0):
+        self.enabled = enabled
+        self.progress = progress
+        self.timers = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._last_progress = self._start
+
+
+    def Timer(self, name : str):
+        """ Time a block of code, use as `with metrics.Timer("decode"):`.
+
+        Args:
+            name (str): stage name
+
+        Returns:
+            context manager
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+
+    def Count(self, name : str, n : int = 1):
+        """ Add to a counter.
+
+        Args:
+            name (str): counter name
+            n (int, optional): amount to add. Defaults to 1.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+
+    def Progress(self):
+        """ Print a progress line if it has been long enough since the last one.
+        """
+        if not (self.enabled and self.progress):
+            return
+        now = time.perf_counter()
+        if now - self._last_progress < self.progress:
+            return
+        self._last_progress = now
+        elapsed = now - self._start
+        rates = [f"{name} {n} ({n / elapsed:.1f}/s)" for name, n in self.counters.items() if name != "bytes_read"]
+        if "bytes_read" in self.counters:
+            rates.append(f"{self.counters['bytes_read'] / 1E6:.1f} MB ({self.counters['bytes_read'] / 1E6 / elapsed:.1f} MB/s)")
+        print(f"[{elapsed:.1f} s] " + ", ".join(rates), file=sys.stderr)
+
+
+    def Summary(self) -> dict:
+        """ Everything collected so far.
+
+        Returns:
+            dict: wall time, counters and timers
+        """
+        return {
+            "wall_time_s" : time.perf_counter() - self._start,
+            "counters" : dict(self.counters),
+            "timers" : {name : {"seconds" : t, "calls" : n} for name, (t, n) in self.timers.items()},
+        }
+
+
+    def Prometheus(self) -> str:
+        """ Summary in the Prometheus text exposition format.
+
+        Returns:
+            str: metrics
+        """
+        summary = self.Summary()
+        lines = [
+            "# TYPE rawdataanalysis_wall_time_seconds gauge",
+            f"rawdataanalysis_wall_time_seconds {summary['wall_time_s']}",
+        ]
+        for name, n in summary["counters"].items():
+            lines += [f"# TYPE rawdataanalysis_{name}_total counter", f"rawdataanalysis_{name}_total {n}"]
+        lines.append("# TYPE rawdataanalysis_stage_seconds_total counter")
+        lines += [f'rawdataanalysis_stage_seconds_total{{stage="{name}"}} {t["seconds"]}' for name, t in summary["timers"].items()]
+        lines.append("# TYPE rawdataanalysis_stage_calls_total counter")
+        lines += [f'rawdataanalysis_stage_calls_total{{stage="{name}"}} {t["calls"]}' for name, t in summary["timers"].items()]
+        return "\n".join(lines) + "\n"
+
+
+    def Report(self, destination : str = "-", format : str = "json"):
+        """ Write the summary.
+
+        Args:
+            destination (str, optional): output file, "-" for stdout. Defaults to "-".
+            format (str, optional): json or prometheus. Defaults to "json".
+        """
+        if not self.enabled:
+            return
+        text = self.Prometheus() if format == "prometheus" else json.dumps(self.Summary(), indent=2) + "\n"
+        if destination == "-":
+            sys.stdout.write(text)
+        else:
+            with open(destination, "w") as f:
+                f.write(text)
+
+
+def AddArguments(parser):
+    """ Add the --metrics options to a command line parser.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+    """
+    parser.add_argument("--metrics", dest="metrics", type=str, nargs="?", const="-", default=None, help="report time spent and data processed in each stage at exit, to a file if given otherwise stdout")
+    parser.add_argument("--metrics-format", dest="metrics_format", choices=["json", "prometheus"], default="json", help="format of the metrics report")
+    parser.add_argument("--progress", dest="progress", type=float, default=0, help="print a progress line every this many seconds (needs --metrics)")
+
+
+def FromArguments(args) -> Metrics:
+    """ Create metrics from the command line options added with AddArguments.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        Metrics: metrics, disabled unless --metrics was given
+    """
+    return Metrics(args.metrics is not None, args.progress)
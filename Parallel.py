@@ -0,0 +1,79 @@
+"""
+Description: Process records in parallel, each worker process opens its own handle to the file.
+"""
+import Utilities
+
+import traceback
+import itertools
+from collections import deque
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+
+_reader = None # file handle of the worker process
+_extra_args = () # arguments made by the setup function in the worker process
+
+
+def _InitWorker(filename : str, recordsToStudy : str, channelMap : str, fragmentFilter : dict, setup, process_args : tuple):
+    global _reader, _extra_args
+    _reader = Utilities.RawDataFile(filename, recordsToStudy, channelMap, verbose = False, fragmentFilter = fragmentFilter)
+    Finalize(_reader, _reader.Close, exitpriority = 0) # workers don't run atexit, close the file (and save any new channel map links) when they exit
+    if setup is not None:
+        _extra_args = tuple(setup(_reader, *process_args))
+
+
+def _RunWorker(task : tuple) -> tuple:
+    process, rid, process_args = task
+    return RunRecord(process, _reader, rid, *process_args, *_extra_args)
+
+
+def RunRecord(process, reader : Utilities.RawDataFile, rid, *process_args) -> tuple:
+    """ Run process on a record, catching any errors so one bad record doesn't stop the run.
+
+    Args:
+        process (function): called as process(reader, rid, *process_args), must be defined at module level
+        reader (Utilities.RawDataFile): open file
+        rid (tuple): record id
+
+    Returns:
+        tuple: record id, result of process (None if it failed), error message (None if it succeeded)
+    """
+    try:
+        return rid, process(reader, rid, *process_args), None
+    except Exception:
+        return rid, None, traceback.format_exc()
+
+
+def MapRecords(process, reader : Utilities.RawDataFile, workers : int = 1, *process_args, setup = None):
+    """ Run process on each selected record, results are returned in the same order as the records.
+        With more than one worker, at most 2 x workers records are processed ahead of the one being consumed.
+
+    Args:
+        process (function): called as process(reader, rid, *process_args, *extra_args), must be defined at module level so it can be sent to the workers
+        reader (Utilities.RawDataFile): open file
+        workers (int, optional): number of worker processes, 1 runs everything in this process. Defaults to 1.
+        setup (function, optional): called as setup(reader, *process_args) once in each process which runs records (this one, or each worker),
+            returns extra_args, e.g. caches which should only be made once per process. Must be defined at module level. Defaults to None.
+
+    Yields:
+        tuple: record id, result of process (None if it failed), error message (None if it succeeded)
+    """
+    if workers <= 1:
+        extra_args = tuple(setup(reader, *process_args)) if setup is not None else ()
+        for rid in reader.toStudy:
+            yield RunRecord(process, reader, rid, *process_args, *extra_args)
+        return
+
+    #* keep a few records in flight per worker, rather than submitting the whole run, so results (e.g. full ADC arrays)
+    #* don't pile up in memory when they are consumed slower than they are made
+    tasks = iter(reader.toStudy)
+    pending = deque()
+    initargs = (reader.filename, reader.recordsToStudy, reader.cmap.name, reader.fragmentFilter, setup, process_args)
+    with ProcessPoolExecutor(workers, initializer = _InitWorker, initargs = initargs) as pool:
+        for rid in itertools.islice(tasks, 2 * workers):
+            pending.append(pool.submit(_RunWorker, (process, rid, process_args)))
+        while pending:
+            result = pending.popleft().result()
+            rid = next(tasks, None)
+            if rid is not None:
+                pending.append(pool.submit(_RunWorker, (process, rid, process_args)))
+            yield result
@@ -0,0 +1,232 @@
+"""
+Description: Per channel pedestal and noise, updated one block of ADCs at a time so whole runs can be processed without keeping them in memory.
+Estimates from different files or workers can be merged. Run as a script to merge saved estimates, print them and plot them by plane.
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+ROBUST_WINDOW = 512 # ADC counts either side of the pedestal kept for the median/MAD
+
+
+class PedestalEstimator:
+    """ Running mean and RMS of each channel (combined with the parallel form of Welford's algorithm),
+        and optionally the median and MAD from a histogram of ADC values around the pedestal.
+
+    Attributes:
+        channel (np.ndarray): offline channels, in the order they were first seen
+        plane (np.ndarray): plane of each channel
+        n (np.ndarray): number of samples
+        mean (np.ndarray): mean ADC
+        m2 (np.ndarray): sum of squared differences from the mean
+        robust (bool): keep histograms for the median and MAD
+        low (np.ndarray): lower edge of each channel's histogram
+        counts (np.ndarray): histogram of ADC values, (channel x 2 * ROBUST_WINDOW)
+        outside (np.ndarray): samples below and above each histogram, (channel x 2)
+    """
+    def __init__(self, robust : bool = False):
+        self.robust = robust
+        self.channel = np.zeros(0, dtype=np.int64)
+        self.plane = np.zeros(0, dtype=np.int8)
+        self.n = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0, dtype=np.float64)
+        self.m2 = np.zeros(0, dtype=np.float64)
+        self.low = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, 2 * ROBUST_WINDOW if robust else 0), dtype=np.uint32)
+        self.outside = np.zeros((0, 2), dtype=np.int64)
+        self._rows = {}
+
+
+    def _Rows(self, channels : np.ndarray, planes : np.ndarray, pedestals : np.ndarray) -> np.ndarray:
+        """ Rows of each channel, adding any we haven't seen before.
+        """
+        new = [i for i, c in enumerate(channels) if int(c) not in self._rows]
+        if new:
+            for i in new:
+                self._rows[int(channels[i])] = len(self.channel) + new.index(i)
+            self.channel = np.append(self.channel, channels[new])
+            self.plane = np.append(self.plane, np.asarray(planes)[new].astype(np.int8))
+            self.n = np.append(self.n, np.zeros(len(new), np.int64))
+            self.mean = np.append(self.mean, np.zeros(len(new)))
+            self.m2 = np.append(self.m2, np.zeros(len(new)))
+            self.low = np.append(self.low, np.round(pedestals[new]).astype(np.int64) - ROBUST_WINDOW)
+            self.counts = np.concatenate([self.counts, np.zeros((len(new), self.counts.shape[1]), np.uint32)])
+            self.outside = np.concatenate([self.outside, np.zeros((len(new), 2), np.int64)])
+        return np.array([self._rows[int(c)] for c in channels], dtype=np.int64)
+
+
+    def _Combine(self, rows : np.ndarray, n : np.ndarray, mean : np.ndarray, m2 : np.ndarray):
+        """ Add the statistics of another set of samples to rows.
+        """
+        total = self.n[rows] + n
+        delta = mean - self.mean[rows]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean[rows] = np.where(total > 0, self.mean[rows] + delta * n / total, 0)
+            self.m2[rows] = np.where(total > 0, self.m2[rows] + m2 + delta**2 * self.n[rows] * n / total, 0)
+        self.n[rows] = total
+
+
+    def Update(self, adc : np.ndarray, channels : np.ndarray, planes : np.ndarray):
+        """ Add a block of ADCs.
+
+        Args:
+            adc (np.ndarray): ADCs, (time x channel)
+            channels (np.ndarray): offline channel of each column
+            planes (np.ndarray): plane of each column
+        """
+        adc = np.asarray(adc)
+        if len(adc) == 0:
+            return
+        mean = adc.mean(axis=0, dtype=np.float64)
+        m2 = ((adc - mean)**2).sum(axis=0)
+        rows = self._Rows(np.asarray(channels, dtype=np.int64), planes, mean)
+        self._Combine(rows, np.full(len(rows), len(adc), np.int64), mean, m2)
+
+        if self.robust:
+            index = adc.astype(np.int64) - self.low[rows]
+            below, above = index < 0, index >= self.counts.shape[1]
+            self.outside[rows, 0] += below.sum(axis=0)
+            self.outside[rows, 1] += above.sum(axis=0)
+            inside = ~(below | above)
+            flat = (np.arange(len(rows)) * self.counts.shape[1] + index)[inside]
+            self.counts[rows] += np.bincount(flat, minlength=len(rows) * self.counts.shape[1]).reshape(len(rows), -1).astype(np.uint32)
+
+
+    def Merge(self, other : "PedestalEstimator"):
+        """ Add the contents of another estimator, e.g. from a different file or worker.
+
+        Args:
+            other (PedestalEstimator): estimates to add
+        """
+        if len(other.channel) == 0:
+            return
+        rows = self._Rows(other.channel, other.plane, other.low + ROBUST_WINDOW)
+        self._Combine(rows, other.n, other.mean, other.m2)
+        if self.robust and other.robust:
+            self.outside[rows] += other.outside
+            for r, low, counts in zip(rows, other.low, other.counts):
+                #* histograms can start at different ADCs, shift the other one onto ours
+                shift = int(low - self.low[r])
+                width = self.counts.shape[1]
+                first, last = max(0, shift), min(width, shift + width)
+                if first < last:
+                    self.counts[r, first:last] += counts[first - shift:last - shift]
+                self.outside[r, 0] += int(counts[:max(0, -shift)].sum())
+                self.outside[r, 1] += int(counts[max(0, width - shift):].sum())
+        elif self.robust:
+            self.robust = False # can't keep the median/MAD if some of the samples weren't histogrammed
+            self.counts = np.zeros((len(self.channel), 0), np.uint32)
+
+
+    def _Median(self) -> tuple:
+        """ Median and median absolute deviation of each channel from the histograms, NaN if they fall outside the histogram.
+        """
+        width = self.counts.shape[1]
+        n = self.counts.sum(axis=1, dtype=np.int64) + self.outside.sum(axis=1)
+        cumulative = self.outside[:, :1] + np.cumsum(self.counts, axis=1, dtype=np.int64)
+        half = (n + 1) // 2 # samples at or below the median
+        i = (cumulative < half[:, np.newaxis]).sum(axis=1)
+        median = np.where((i < width) & (n > 0) & (self.outside[:, 0] < half), self.low + i, np.nan)
+
+        #* MAD: smallest d such that at least half the samples are within median +/- d, found with a bisection for all channels at once
+        padded = np.concatenate([np.zeros((len(n), 1), np.int64), cumulative - self.outside[:, :1]], axis=1) # samples inside, below bin j
+        centre = np.where(np.isnan(median), 0, median - self.low).astype(np.int64)
+        rows = np.arange(len(n))
+        lo, hi = np.zeros(len(n), np.int64), np.full(len(n), width, np.int64)
+        while np.any(lo < hi):
+            d = (lo + hi) // 2
+            within = padded[rows, np.clip(centre + d + 1, 0, width)] - padded[rows, np.clip(centre - d, 0, width)]
+            enough = within >= half
+            hi = np.where(enough, d, hi)
+            lo = np.where(enough | (lo >= hi), lo, d + 1)
+        j = lo
+        mad = np.where(~np.isnan(median) & (j < width), j, np.nan)
+        return median, mad
+
+
+    def Results(self) -> pd.DataFrame:
+        """ Estimates of each channel, sorted by channel.
+
+        Returns:
+            pd.DataFrame: channel, plane, number of samples, pedestal (mean), rms and, if kept, median and MAD
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rms = np.sqrt(np.where(self.n > 1, self.m2 / (self.n - 1), np.nan))
+        results = {"channel" : self.channel, "plane" : self.plane, "n" : self.n, "pedestal" : self.mean, "rms" : rms}
+        if self.robust:
+            results["median"], results["mad"] = self._Median()
+        return pd.DataFrame(results).sort_values("channel", ignore_index=True)
+
+
+    def Save(self, filename : str):
+        """ Write the estimator to a npz file.
+
+        Args:
+            filename (str): output file
+        """
+        np.savez_compressed(filename, channel = self.channel, plane = self.plane, n = self.n, mean = self.mean, m2 = self.m2,
+                            robust = np.array([self.robust]), low = self.low, counts = self.counts, outside = self.outside)
+
+
+    @classmethod
+    def Load(cls, filename : str) -> "PedestalEstimator":
+        """ Read an estimator written with Save.
+
+        Args:
+            filename (str): npz file
+
+        Returns:
+            PedestalEstimator: estimator
+        """
+        with np.load(filename) as data:
+            p = cls(bool(data["robust"][0]))
+            for name in ["channel", "plane", "n", "mean", "m2", "low", "counts", "outside"]:
+                setattr(p, name, data[name])
+        p._rows = {int(c) : i for i, c in enumerate(p.channel)}
+        return p
+
+
+def PlotPedestals(results : pd.DataFrame, outdir : str):
+    """ Plot pedestal and noise against channel for each plane.
+
+    Args:
+        results (pd.DataFrame): output of PedestalEstimator.Results
+        outdir (str): output directory
+    """
+    os.makedirs(outdir, exist_ok=True)
+    quantities = [q for q in ["pedestal", "rms", "median", "mad"] if q in results]
+    for p, name in enumerate(["u", "v", "z"]):
+        plane = results[results["plane"] == p]
+        if len(plane) == 0:
+            continue
+        fig, axes = plt.subplots(len(quantities), 1, sharex=True, figsize=(6.4, 2.4 * len(quantities)))
+        for ax, q in zip(np.atleast_1d(axes), quantities):
+            ax.plot(plane["channel"], plane[q], ".", markersize=2)
+            ax.set_ylabel(q)
+        np.atleast_1d(axes)[-1].set_xlabel("channel")
+        fig.suptitle(f"Plane : {name}")
+        fig.tight_layout()
+        fig.savefig(f"{outdir}/pedestals_{name}.png")
+        plt.close(fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge saved pedestal estimates, print and plot them")
+    parser.add_argument(dest="files", type=str, nargs="+", help="pedestal files to merge.")
+    parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory to store plots")
+    parser.add_argument("-s", "--save", dest="save", type=str, default=None, help="write the merged estimates to this file")
+    parser.add_argument("--csv", dest="csv", type=str, default=None, help="write the per channel results to this csv file")
+    args = parser.parse_args()
+
+    merged = PedestalEstimator.Load(args.files[0])
+    for f in args.files[1:]:
+        merged.Merge(PedestalEstimator.Load(f))
+    if args.save:
+        merged.Save(args.save)
+    results = merged.Results()
+    print(results)
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+    PlotPedestals(results, args.outdir)
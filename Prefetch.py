@@ -0,0 +1,135 @@
+"""
+Description: Read the next records in background threads while the current one is processed, so the disk and the CPU are busy at the same time.
+The payloads (or fragments) of each record are read in the order the records are studied, and handed to RawDataFile.Payloads/Fragments when the record is reached.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Prefetcher:
+    """ Keeps up to depth records ahead of the one being processed loaded in memory.
+
+    Attributes:
+        reader (Utilities.RawDataFile): open file
+        depth (int): maximum number of records read ahead
+        max_bytes (int): maximum size of the records read ahead, at least one record is always read ahead even if it is bigger
+        fragments (bool): read fragments with hdf5libs instead of payloads
+        per_record (int): only read ahead the first per_record fragments of each record, None for all of them
+        queue (collections.OrderedDict): record id -> (future, bytes), in the order the records will be processed
+    """
+    def __init__(self, reader, depth : int = 2, max_bytes : int = 512 * 2**20, workers : int = 1, fragments : bool = False, per_record : int = None):
+        """
+        Args:
+            reader (Utilities.RawDataFile): open file
+            depth (int, optional): records to read ahead. Defaults to 2.
+            max_bytes (int, optional): memory limit of the records read ahead. Defaults to 512 MiB.
+            workers (int, optional): reading threads, more than one only helps if the storage is faster with concurrent reads. Defaults to 1.
+            fragments (bool, optional): read fragments (for Fragments) instead of payloads (for Payloads). Defaults to False.
+            per_record (int, optional): fragments of each record to read ahead. Defaults to None (all).
+        """
+        self.reader = reader
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.fragments = fragments
+        self.per_record = per_record
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix = "prefetch")
+        self.queue = collections.OrderedDict()
+        self.queued_bytes = 0
+        self._position = {rid : i for i, rid in enumerate(reader.toStudy)}
+        self._next = 0 # position in reader.toStudy of the next record to queue
+        self._Fill()
+
+
+    def _Fill(self):
+        """ Queue records until the depth or memory limit is reached.
+        """
+        records = self.reader.toStudy
+        while self._next < len(records) and len(self.queue) < self.depth:
+            rid = records[self._next]
+            entries = self.reader.Entries(rid)[:self.per_record]
+            size = int(entries["payload_size"].sum())
+            if self.queue and self.queued_bytes + size > self.max_bytes:
+                break
+            self.queue[rid] = (self.pool.submit(self._Load, entries), size)
+            self.queued_bytes += size
+            self._next += 1
+
+
+    def _Load(self, entries : np.ndarray) -> list:
+        """ Read a record, runs in a worker thread.
+        """
+        if self.fragments:
+            return [(str(e["path"]), e, self.reader._ReadFragment(str(e["path"]))) for e in entries]
+        return [(str(e["path"]), e, self.reader._ReadPayload(e)) for e in entries]
+
+
+    def _Drop(self, rid):
+        future, size = self.queue.pop(rid)
+        future.cancel()
+        self.queued_bytes -= size
+
+
+    def Get(self, rid, fragments : bool = False) -> list:
+        """ Take a record which was read ahead, waiting for it if it is still being read.
+            Records queued before it are dropped, since they were skipped.
+
+        Args:
+            rid (tuple): record id
+            fragments (bool, optional): fragments are wanted rather than payloads. Defaults to False.
+
+        Returns:
+            list: (fragment path, record index entry, payload or fragment) of each fragment read ahead, None if the record wasn't read ahead
+        """
+        if fragments != self.fragments:
+            return None
+        if rid not in self.queue:
+            if self._position.get(rid, -1) >= self._next:
+                #* jumped past the records read ahead, start again after this one
+                for queued in list(self.queue):
+                    self._Drop(queued)
+                self._next = self._position[rid] + 1
+                self._Fill()
+            return None
+
+        for queued in list(self.queue):
+            if queued == rid: break
+            self._Drop(queued)
+        future, size = self.queue.pop(rid)
+        self.queued_bytes -= size
+        self._Fill() # start on the next records before waiting for this one
+        with self.reader.metrics.Timer("prefetch_wait"):
+            return future.result()
+
+
+    def Close(self):
+        """ Stop reading ahead and wait for any reads in progress.
+        """
+        for rid in list(self.queue):
+            self._Drop(rid)
+        self.pool.shutdown(wait = True)
+
+
+def AddArguments(parser):
+    """ Add the --prefetch options to a command line parser.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+    """
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=0, help="read this many records ahead in a background thread while the current one is processed, 0 to turn off")
+    parser.add_argument("--prefetch-memory", dest="prefetch_memory", type=float, default=512, help="memory limit of the records read ahead (MiB)")
+    parser.add_argument("--prefetch-threads", dest="prefetch_threads", type=int, default=1, help="number of threads reading ahead")
+
+
+def FromArguments(reader, args, fragments : bool = False, per_record : int = None):
+    """ Start reading ahead with the command line options added with AddArguments.
+
+    Args:
+        reader (Utilities.RawDataFile): open file
+        args (argparse.Namespace): command line arguments
+        fragments (bool, optional): the script reads fragments rather than payloads. Defaults to False.
+        per_record (int, optional): fragments of each record the script reads. Defaults to None (all).
+    """
+    if args.prefetch > 0:
+        reader.Prefetch(args.prefetch, int(args.prefetch_memory * 2**20), args.prefetch_threads, fragments, per_record)
@@ -0,0 +1,204 @@
+"""
+Description: Index of the records and fragments in a file, built once from the fragment headers and stored in a sidecar file,
+so reopening a file doesn't need to scan the hdf5 metadata again.
+"""
+import Decoders
+from ChannelMaps import CacheDirectory
+
+from hdf5libs import HDF5RawDataFile
+
+import os
+import hashlib
+import h5py
+import numpy as np
+
+INDEX_VERSION = 2 # bump if the layout of the index changes
+
+
+def SidecarPath(filename : str, kind : str = "index") -> str:
+    """ Where the index of a file is stored, next to the file if we can write there, otherwise in the cache directory.
+
+    Args:
+        filename (str): hdf5 file
+        kind (str, optional): which index. Defaults to "index".
+
+    Returns:
+        str: index file path
+    """
+    filename = os.path.abspath(filename)
+    if os.access(os.path.dirname(filename), os.W_OK):
+        return f"{filename}.{kind}.npz"
+    name = hashlib.sha1(filename.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(CacheDirectory()), "index", f"{os.path.basename(filename)}-{name}.{kind}.npz")
+
+
+def FileKey(filename : str) -> np.ndarray:
+    """ Identity of a file, the index is rebuilt if this changes.
+
+    Args:
+        filename (str): hdf5 file
+
+    Returns:
+        np.ndarray: path, size, modification time and index version
+    """
+    stat = os.stat(filename)
+    return np.array([os.path.abspath(filename), str(stat.st_size), str(stat.st_mtime_ns), str(INDEX_VERSION)])
+
+
+class RecordIndex:
+    """ Table of every fragment in a file.
+
+    Attributes:
+        filename (str): hdf5 file
+        fragments (np.ndarray): structured array, one row per fragment with the record and sequence number, dataset path,
+            subsystem, element (source) id, fragment type, payload size, trigger timestamp, window begin/end, number of TPs/frames in the payload
+            and where the fragment is stored in the file
+        records (np.ndarray): record and sequence number of each record
+        offsets (np.ndarray): rows of fragments which belong to record i are offsets[i]:offsets[i+1]
+    """
+    def __init__(self, filename : str, h5_file = None):
+        """
+        Args:
+            filename (str): hdf5 file
+            h5_file (HDF5RawDataFile, optional): open file, used to list the records if the index needs to be built. Defaults to None.
+        """
+        self.filename = filename
+        self.sidecar = SidecarPath(filename)
+        if not self.Load():
+            if h5_file is None:
+                h5_file = HDF5RawDataFile(filename)
+            self.Build(h5_file)
+            self.Save()
+        self._Group()
+
+
+    def Load(self) -> bool:
+        """ Load the index from the sidecar file.
+
+        Returns:
+            bool: True if the index was loaded, False if it doesn't exist or is out of date
+        """
+        if not os.path.isfile(self.sidecar):
+            return False
+        try:
+            with np.load(self.sidecar) as index:
+                if not np.array_equal(index["key"], FileKey(self.filename)):
+                    return False
+                self.fragments = index["fragments"]
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+
+    def Save(self):
+        """ Write the index to the sidecar file.
+        """
+        os.makedirs(os.path.dirname(self.sidecar), exist_ok=True)
+        tmp = f"{self.sidecar}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, key = FileKey(self.filename), fragments = self.fragments)
+        os.replace(tmp, self.sidecar)
+
+
+    def Build(self, h5_file):
+        """ Build the index, only the fragment headers are read.
+
+        Args:
+            h5_file (HDF5RawDataFile): open file
+        """
+        print(f"indexing {self.filename}")
+        item_sizes = Decoders.ItemSizes()
+        header_size = Decoders.FRAGMENT_HEADER_DTYPE.itemsize
+
+        rows = []
+        with h5py.File(self.filename, "r") as f:
+            for rid in h5_file.get_all_record_ids():
+                for fp in h5_file.get_fragment_dataset_paths(rid):
+                    dataset = f[fp]
+                    offset = dataset.id.get_offset() # None unless the dataset is stored contiguously (no chunking/compression)
+                    headers = Decoders.ParseFragmentHeaders(dataset[:header_size])
+                    if headers is not None:
+                        h = headers[0]
+                        row = [h["size"], h["trigger_timestamp"], h["window_begin"], h["window_end"], h["fragment_type"], h["subsystem"], h["element_id"]]
+                    else:
+                        #* header layout not recognised, let daqdataformats decode it
+                        h = h5_file.get_frag(fp).get_header()
+                        row = [h.size, h.trigger_timestamp, h.window_begin, h.window_end, h.fragment_type, h.element_id.subsystem, h.element_id.id]
+                    row = [int(r) for r in row]
+                    payload_size = row[0] - header_size
+                    item_size = item_sizes.get(row[4], 0)
+                    rows.append((rid[0], rid[1], fp, row[5], row[6], row[4], payload_size, *row[1:4], payload_size // item_size if item_size else -1, -1 if offset is None else offset))
+
+        path_length = max([len(r[2]) for r in rows], default=1)
+        dtype = np.dtype([
+            ("record", "<u8"),
+            ("sequence", "<u8"),
+            ("path", f"<U{path_length}"),
+            ("subsystem", "<u2"),
+            ("element_id", "<u4"),
+            ("fragment_type", "<u4"),
+            ("payload_size", "<u8"),
+            ("trigger_timestamp", "<u8"),
+            ("window_begin", "<u8"),
+            ("window_end", "<u8"),
+            ("n_items", "<i8"), # number of TPs or frames, -1 if the fragment type is not known
+            ("offset", "<i8"), # byte offset of the fragment in the file, -1 if it isn't stored contiguously
+        ])
+        self.fragments = np.array(rows, dtype=dtype)
+
+
+    def _Group(self):
+        keys = np.stack([self.fragments["record"], self.fragments["sequence"]], axis=1)
+        self.records, starts = np.unique(keys, axis=0, return_index=True)
+        order = np.argsort(starts) # keep records in the order they appear in the file
+        self.records = self.records[order]
+        starts = starts[order]
+        self.offsets = np.append(starts, len(self.fragments))
+        self._rows = {(int(r), int(s)) : i for i, (r, s) in enumerate(self.records)}
+
+
+    def RecordIDs(self) -> list:
+        """ Record ids in the file.
+
+        Returns:
+            list: (record number, sequence number) of each record
+        """
+        return [(int(r), int(s)) for r, s in self.records]
+
+
+    def Fragments(self, rid) -> np.ndarray:
+        """ Index entries of the fragments in a record.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            np.ndarray: rows of the fragment table
+        """
+        i = self._rows[(int(rid[0]), int(rid[1]))]
+        return self.fragments[self.offsets[i]:self.offsets[i+1]]
+
+
+    def FragmentRows(self, rid) -> range:
+        """ Rows of the fragment table which belong to a record.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            range: rows
+        """
+        i = self._rows[(int(rid[0]), int(rid[1]))]
+        return range(self.offsets[i], self.offsets[i+1])
+
+
+    def FragmentPaths(self, rid) -> list:
+        """ Paths to the fragments in a record.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            list: fragment dataset paths
+        """
+        return [str(p) for p in self.Fragments(rid)["path"]]
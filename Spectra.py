@@ -0,0 +1,313 @@
+"""
+Description: Noise spectra of each channel, updated one record of ADCs at a time. Records are cut into fixed length segments (Welch's method)
+and the FFTs of every channel are done at once, so the memory used doesn't depend on the record length or the number of records.
+Coherent noise is measured with the spectrum of the average waveform of each plane and the correlation between channels.
+Estimates from different files or workers can be merged. Run as a script to merge saved spectra, print a summary and plot them.
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib
+import matplotlib.pyplot as plt
+
+SAMPLE_PERIOD = 512e-9 # s, WIBEth sampling period (32 ticks of the 62.5 MHz timestamp clock)
+PLANES = ["u", "v", "z"]
+
+
+class NoiseSpectrum:
+    """ Running sum of the power spectrum of each channel, the power spectrum of the average waveform of each plane
+        and the correlation matrix of the channels.
+
+    Attributes:
+        n_fft (int): samples in each segment, sets the frequency resolution
+        sample_period (float): time between samples (s)
+        channel (np.ndarray): offline channels, in the order they were first seen
+        plane (np.ndarray): plane of each channel
+        segments (np.ndarray): number of segments added to each channel
+        power (np.ndarray): sum of |FFT|^2 of each channel, (channel x frequency)
+        coherent (np.ndarray): sum of |FFT|^2 of the average waveform of each plane, (plane x frequency)
+        coherent_segments (np.ndarray): segments added to each plane
+        coherent_channels (np.ndarray): sum over segments of the number of channels averaged, for each plane
+        products (np.ndarray): sum of the products of the pedestal subtracted samples of each pair of channels, (channel x channel)
+    """
+    def __init__(self, n_fft : int = 1024, sample_period : float = SAMPLE_PERIOD):
+        self.n_fft = int(n_fft)
+        self.sample_period = float(sample_period)
+        n_frequencies = self.n_fft // 2 + 1
+        self.window = np.hanning(self.n_fft).astype(np.float32)
+        self.channel = np.zeros(0, dtype=np.int64)
+        self.plane = np.zeros(0, dtype=np.int8)
+        self.segments = np.zeros(0, dtype=np.int64)
+        self.power = np.zeros((0, n_frequencies), dtype=np.float64)
+        self.coherent = np.zeros((len(PLANES), n_frequencies), dtype=np.float64)
+        self.coherent_segments = np.zeros(len(PLANES), dtype=np.int64)
+        self.coherent_channels = np.zeros(len(PLANES), dtype=np.int64)
+        self.products = np.zeros((0, 0), dtype=np.float64)
+        self._rows = {}
+
+
+    @property
+    def frequency(self) -> np.ndarray:
+        return np.fft.rfftfreq(self.n_fft, self.sample_period)
+
+
+    def _Rows(self, channels : np.ndarray, planes : np.ndarray) -> np.ndarray:
+        """ Rows of each channel, adding any we haven't seen before.
+        """
+        new = [i for i, c in enumerate(channels) if int(c) not in self._rows]
+        if new:
+            for i in new:
+                self._rows[int(channels[i])] = len(self.channel) + new.index(i)
+            self.channel = np.append(self.channel, channels[new])
+            self.plane = np.append(self.plane, np.asarray(planes)[new].astype(np.int8))
+            self.segments = np.append(self.segments, np.zeros(len(new), np.int64))
+            self.power = np.concatenate([self.power, np.zeros((len(new), self.power.shape[1]))])
+            products = np.zeros((len(self.channel), len(self.channel)))
+            products[:len(self.products), :len(self.products)] = self.products
+            self.products = products
+        return np.array([self._rows[int(c)] for c in channels], dtype=np.int64)
+
+
+    def Update(self, adc : np.ndarray, channels : np.ndarray, planes : np.ndarray):
+        """ Add a record of ADCs, samples after the last whole segment are dropped.
+
+        Args:
+            adc (np.ndarray): ADCs, (time x channel)
+            channels (np.ndarray): offline channel of each column
+            planes (np.ndarray): plane of each column
+        """
+        adc = np.asarray(adc)
+        n_segments = len(adc) // self.n_fft
+        if n_segments == 0:
+            return
+        rows = self._Rows(np.asarray(channels, dtype=np.int64), planes)
+        planes = np.asarray(planes)
+
+        #* (channel x segment x sample), with the pedestal of each segment subtracted
+        segments = np.ascontiguousarray(adc[:n_segments * self.n_fft].T, dtype=np.float32).reshape(len(rows), n_segments, self.n_fft)
+        segments -= segments.mean(axis=2, keepdims=True)
+
+        spectrum = np.fft.rfft(segments * self.window, axis=2)
+        self.power[rows] += (spectrum.real**2 + spectrum.imag**2).sum(axis=1, dtype=np.float64)
+        self.segments[rows] += n_segments
+
+        for p in range(len(PLANES)):
+            mask = planes == p
+            if not np.any(mask):
+                continue
+            #* the FFT is linear, so the spectrum of the average waveform is the average of the spectra
+            average = spectrum[mask].mean(axis=0)
+            self.coherent[p] += (average.real**2 + average.imag**2).sum(axis=0, dtype=np.float64)
+            self.coherent_segments[p] += n_segments
+            self.coherent_channels[p] += n_segments * int(np.count_nonzero(mask))
+
+        samples = segments.reshape(len(rows), -1).astype(np.float64)
+        self.products[np.ix_(rows, rows)] += samples @ samples.T
+
+
+    def Merge(self, other : "NoiseSpectrum"):
+        """ Add the contents of another estimate with the same segment length, e.g. from a different file or worker.
+
+        Args:
+            other (NoiseSpectrum): spectra to add
+        """
+        if (self.n_fft, self.sample_period) != (other.n_fft, other.sample_period):
+            raise Exception("can't merge spectra with different segment lengths or sample periods")
+        rows = self._Rows(other.channel, other.plane)
+        self.power[rows] += other.power
+        self.segments[rows] += other.segments
+        self.products[np.ix_(rows, rows)] += other.products
+        self.coherent += other.coherent
+        self.coherent_segments += other.coherent_segments
+        self.coherent_channels += other.coherent_channels
+
+
+    def _Density(self, power : np.ndarray, segments : np.ndarray) -> np.ndarray:
+        """ One sided power spectral density (ADC^2/Hz) from sums of |FFT|^2.
+        """
+        scale = np.full(power.shape[-1], 2.0)
+        scale[0] = 1
+        if self.n_fft % 2 == 0:
+            scale[-1] = 1 # the Nyquist frequency isn't doubled either
+        scale *= self.sample_period / float((self.window.astype(np.float64)**2).sum())
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return power * scale / np.asarray(segments, dtype=np.float64)[..., np.newaxis]
+
+
+    def Results(self) -> dict:
+        """ Spectra and correlations, channels sorted by channel number.
+
+        Returns:
+            dict: frequency (Hz), channel, plane, psd (channel x frequency, ADC^2/Hz), rms of each channel from its spectrum,
+                plane_psd (average psd of the channels in each plane), coherent_psd (psd of the average waveform of each plane),
+                coherent_fraction (coherent_psd / plane_psd, 1 / plane_channels for incoherent noise, 1 for fully coherent noise),
+                plane_channels, correlation (channel x channel)
+        """
+        order = np.argsort(self.channel, kind="stable")
+        psd = self._Density(self.power[order], self.segments[order])
+        df = 1 / (self.n_fft * self.sample_period)
+        plane_psd = np.full((len(PLANES), psd.shape[1]), np.nan)
+        for p in range(len(PLANES)):
+            mask = (self.plane[order] == p) & (self.segments[order] > 0)
+            if np.any(mask):
+                plane_psd[p] = psd[mask].mean(axis=0)
+        coherent_psd = self._Density(self.coherent, self.coherent_segments)
+
+        products = self.products[np.ix_(order, order)]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            norm = np.sqrt(np.diag(products))
+            correlation = products / norm[:, np.newaxis] / norm[np.newaxis, :]
+            coherent_fraction = coherent_psd / plane_psd
+        return {
+            "frequency" : self.frequency,
+            "channel" : self.channel[order],
+            "plane" : self.plane[order],
+            "psd" : psd,
+            "rms" : np.sqrt(psd[:, 1:].sum(axis=1) * df), # without the DC bin, which the pedestal subtraction removes
+            "plane_psd" : plane_psd,
+            "coherent_psd" : coherent_psd,
+            "coherent_fraction" : coherent_fraction,
+            "plane_channels" : self.coherent_channels / np.maximum(self.coherent_segments, 1), # average number of channels in the average waveform
+            "correlation" : correlation,
+        }
+
+
+    def Save(self, filename : str):
+        """ Write the estimate to a npz file.
+
+        Args:
+            filename (str): output file
+        """
+        np.savez_compressed(filename, n_fft = np.array([self.n_fft]), sample_period = np.array([self.sample_period]), channel = self.channel, plane = self.plane,
+                            segments = self.segments, power = self.power, coherent = self.coherent, coherent_segments = self.coherent_segments,
+                            coherent_channels = self.coherent_channels, products = self.products)
+
+
+    @classmethod
+    def Load(cls, filename : str) -> "NoiseSpectrum":
+        """ Read an estimate written with Save.
+
+        Args:
+            filename (str): npz file
+
+        Returns:
+            NoiseSpectrum: estimate
+        """
+        with np.load(filename) as data:
+            s = cls(int(data["n_fft"][0]), float(data["sample_period"][0]))
+            for name in ["channel", "plane", "segments", "power", "coherent", "coherent_segments", "coherent_channels", "products"]:
+                setattr(s, name, data[name])
+        s._rows = {int(c) : i for i, c in enumerate(s.channel)}
+        return s
+
+
+def Summary(results : dict) -> pd.DataFrame:
+    """ Noise and coherence of each plane.
+
+    Args:
+        results (dict): output of NoiseSpectrum.Results
+
+    Returns:
+        pd.DataFrame: one row per plane with the number of channels, mean rms, mean correlation between different channels and between neighbouring channels,
+            and the frequency where the coherent fraction is largest
+    """
+    rows = []
+    for p, name in enumerate(PLANES):
+        mask = results["plane"] == p
+        if not np.any(mask):
+            continue
+        correlation = results["correlation"][np.ix_(mask, mask)]
+        n = len(correlation)
+        off_diagonal = correlation[~np.eye(n, dtype=bool)]
+        fraction = results["coherent_fraction"][p]
+        peak = np.nanargmax(fraction[1:]) + 1 if np.any(np.isfinite(fraction[1:])) else 0
+        rows.append({
+            "plane" : name,
+            "n_channels" : n,
+            "rms" : np.nanmean(results["rms"][mask]),
+            "correlation" : np.nanmean(off_diagonal) if len(off_diagonal) else np.nan,
+            "neighbour_correlation" : np.nanmean(np.diagonal(correlation, 1)) if n > 1 else np.nan,
+            "peak_coherent_frequency" : results["frequency"][peak],
+            "peak_coherent_fraction" : fraction[peak],
+            "incoherent_fraction" : 1 / results["plane_channels"][p], # coherent fraction if there was no coherent noise
+        })
+    return pd.DataFrame(rows)
+
+
+def PlotSpectra(results : dict, outdir : str):
+    """ Plot the spectra of each plane (average of the channels and of the average waveform), the spectrum of every channel and the channel correlations.
+
+    Args:
+        results (dict): output of NoiseSpectrum.Results
+        outdir (str): output directory
+    """
+    os.makedirs(outdir, exist_ok=True)
+    frequency = results["frequency"] / 1e3 # kHz
+    for p, name in enumerate(PLANES):
+        mask = results["plane"] == p
+        if not np.any(mask):
+            continue
+        fig, ax = plt.subplots()
+        ax.plot(frequency[1:], results["plane_psd"][p][1:], label="average of channels")
+        ax.plot(frequency[1:], results["coherent_psd"][p][1:], label="average waveform (coherent)")
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("frequency (kHz)")
+        ax.set_ylabel("power spectral density (ADC$^{2}$/Hz)")
+        ax.set_title(f"Plane : {name}")
+        ax.legend()
+        fig.tight_layout()
+        fig.savefig(f"{outdir}/spectrum_{name}.png")
+        plt.close(fig)
+
+        psd = results["psd"][mask]
+        fig, ax = plt.subplots()
+        image = ax.imshow(psd.T, aspect="auto", origin="lower", interpolation="none", extent=(-0.5, len(psd) - 0.5, frequency[0], frequency[-1]),
+                          norm=matplotlib.colors.LogNorm() if np.any(psd > 0) else None)
+        fig.colorbar(image, ax=ax, label="power spectral density (ADC$^{2}$/Hz)")
+        ax.set_xlabel("channel index")
+        ax.set_ylabel("frequency (kHz)")
+        ax.set_title(f"Plane : {name}")
+        fig.tight_layout()
+        fig.savefig(f"{outdir}/spectrum_channels_{name}.png")
+        plt.close(fig)
+
+    fig, ax = plt.subplots()
+    image = ax.imshow(results["correlation"], origin="lower", interpolation="none", cmap="seismic", vmin=-1, vmax=1)
+    fig.colorbar(image, ax=ax, label="correlation")
+    ax.set_xlabel("channel index")
+    ax.set_ylabel("channel index")
+    fig.tight_layout()
+    fig.savefig(f"{outdir}/correlation.png")
+    plt.close(fig)
+
+
+def SaveResults(results : dict, filename : str):
+    """ Write the spectra and correlations to a npz file.
+
+    Args:
+        results (dict): output of NoiseSpectrum.Results
+        filename (str): output file
+    """
+    np.savez_compressed(filename, **results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge saved noise spectra, print a summary and plot them")
+    parser.add_argument(dest="files", type=str, nargs="+", help="spectrum files to merge.")
+    parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory to store plots")
+    parser.add_argument("-s", "--save", dest="save", type=str, default=None, help="write the merged estimates to this file")
+    parser.add_argument("--results", dest="results", type=str, default=None, help="write the spectra and correlations to this npz file")
+    args = parser.parse_args()
+
+    merged = NoiseSpectrum.Load(args.files[0])
+    for f in args.files[1:]:
+        merged.Merge(NoiseSpectrum.Load(f))
+    if args.save:
+        merged.Save(args.save)
+    results = merged.Results()
+    print(Summary(results))
+    if args.results:
+        SaveResults(results, args.results)
+    PlotSpectra(results, args.outdir)
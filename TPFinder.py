@@ -0,0 +1,82 @@
+"""
+Description: Software trigger primitive finder for the (time x channel) ADC arrays of WIBEth fragments, used to check the TPs made in firmware against the raw waveforms.
+Pedestal subtraction, thresholding and finding runs of samples over threshold are done for all channels at once with numpy.
+"""
+import numpy as np
+
+
+def Pedestals(adc : np.ndarray, stride : int = 1) -> np.ndarray:
+    """ Pedestal of each channel, the median ADC of the record.
+
+    Args:
+        adc (np.ndarray): ADCs, (time x channel)
+        stride (int, optional): only use every stride'th sample, quicker for long records. Defaults to 1.
+
+    Returns:
+        np.ndarray: pedestal of each channel (rounded to an integer, like the firmware)
+    """
+    samples = np.ascontiguousarray(adc[::stride].T) # partitioning contiguous rows is much quicker than np.median along the time axis
+    n = samples.shape[1]
+    samples = np.partition(samples, n // 2, axis=1)
+    upper = samples[:, n // 2].astype(np.float64)
+    lower = samples[:, :n // 2].max(axis=1) if n % 2 == 0 else upper # partitioning on one index is a lot quicker than two
+    return np.round((lower + upper) / 2).astype(np.int32)
+
+
+def FindTPs(adc : np.ndarray, timestamps : np.ndarray, channels : np.ndarray, planes : np.ndarray, threshold, pedestals : np.ndarray = None, det_id : int = 0) -> dict:
+    """ Find TPs (runs of consecutive samples above threshold) on every channel.
+
+    Args:
+        adc (np.ndarray): ADCs, (time x channel)
+        timestamps (np.ndarray): timestamp of each sample
+        channels (np.ndarray): offline channel of each column
+        planes (np.ndarray): plane of each column
+        threshold (int or np.ndarray): threshold above the pedestal in ADC, one value or one for each column
+        pedestals (np.ndarray, optional): pedestal of each column. Defaults to None (median of the record).
+        det_id (int, optional): detector id written to each TP. Defaults to 0.
+
+    Returns:
+        dict: columns of Decoders.TPColumns (time_peak and time_over_threshold in samples, like TP format v2) and plane, ordered by channel then time
+    """
+    adc = np.asarray(adc)
+    n_samples, n_channels = adc.shape
+    if pedestals is None:
+        pedestals = Pedestals(adc)
+
+    #* channels along the rows, so the samples of each channel are contiguous. A column of zeros is put in front of each row
+    #* (and one sample after the last) so runs never cross from one channel into the next, and every run has a rising and falling edge
+    width = n_samples + 1
+    signal = np.zeros(n_channels * width + 1, dtype=np.int32)
+    rows = signal[:-1].reshape(n_channels, width)
+    np.subtract(adc.T, np.asarray(pedestals, dtype=np.int32)[:, np.newaxis], out=rows[:, 1:], casting="unsafe")
+    over = np.zeros(len(signal), dtype=bool)
+    np.greater(rows[:, 1:], np.reshape(threshold, (-1, 1)), out=over[:-1].reshape(n_channels, width)[:, 1:])
+
+    edges = np.flatnonzero(over[1:] != over[:-1]) + 1
+    starts, ends = edges[0::2], edges[1::2]
+    lengths = ends - starts
+
+    #* reduce over the samples above threshold only, each run is a contiguous block of them
+    values = signal[over]
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    if len(starts):
+        peak = np.maximum.reduceat(values, first)
+        integral = np.add.reduceat(values, first, dtype=np.int64)
+        run = np.repeat(np.arange(len(starts)), lengths)
+        at_peak = np.flatnonzero(values == peak[run])
+        first_peak = at_peak[np.concatenate([[True], run[at_peak[1:]] != run[at_peak[:-1]]])] # first sample at the peak of each run
+    else:
+        peak = integral = first_peak = np.zeros(0, dtype=np.int64)
+
+    column = starts // width
+    sample = starts % width - 1
+    return {
+        "time_start" : np.asarray(timestamps, dtype=np.uint64)[sample],
+        "time_peak" : (first_peak - first).astype(np.uint16),
+        "time_over_threshold" : lengths.astype(np.uint16),
+        "channel" : np.asarray(channels, dtype=np.uint32)[column],
+        "adc_integral" : integral.astype(np.uint32),
+        "adc_peak" : peak.astype(np.uint16),
+        "det_id" : np.full(len(starts), det_id, dtype=np.uint8),
+        "plane" : np.asarray(planes, dtype=np.int8)[column],
+    }
@@ -0,0 +1,203 @@
+"""
+Description: Time and channel ranges of the TPs in a file, built once and stored in a sidecar file next to the record index.
+TPs in each fragment are split into fixed size blocks, so a query only reads and decodes the blocks which can contain TPs in the range asked for.
+"""
+import Decoders
+from RecordIndex import SidecarPath, FileKey
+
+import daqdataformats
+
+import os
+import numpy as np
+
+TP_INDEX_VERSION = 1 # bump if the layout of the index changes
+TPS_PER_BLOCK = 4096
+
+BLOCK_DTYPE = np.dtype([
+    ("fragment", "<i8"), # row in the record index
+    ("first", "<i8"), # index of the first TP in the fragment
+    ("n_tps", "<i8"),
+    ("time_min", "<u8"),
+    ("time_max", "<u8"),
+    ("channel_min", "<i8"),
+    ("channel_max", "<i8"),
+])
+
+
+class TPIndex:
+    """ Time and channel range of each block of TPs in a file.
+
+    Attributes:
+        filename (str): hdf5 file
+        blocks (np.ndarray): one row per block of TPS_PER_BLOCK TPs, sorted by fragment
+    """
+    def __init__(self, reader):
+        """
+        Args:
+            reader (Utilities.RawDataFile): open file, used to read the TPs if the index needs to be built
+        """
+        self.filename = reader.filename
+        self.sidecar = SidecarPath(self.filename, "tpindex")
+        if not self.Load():
+            self.Build(reader)
+            self.Save()
+
+
+    def Key(self) -> np.ndarray:
+        return np.append(FileKey(self.filename), [str(TP_INDEX_VERSION), str(TPS_PER_BLOCK)])
+
+
+    def Load(self) -> bool:
+        """ Load the index from the sidecar file.
+
+        Returns:
+            bool: True if the index was loaded, False if it doesn't exist or is out of date
+        """
+        if not os.path.isfile(self.sidecar):
+            return False
+        try:
+            with np.load(self.sidecar) as index:
+                if not np.array_equal(index["key"], self.Key()):
+                    return False
+                self.blocks = index["blocks"]
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+
+    def Save(self):
+        """ Write the index to the sidecar file.
+        """
+        os.makedirs(os.path.dirname(self.sidecar), exist_ok=True)
+        tmp = f"{self.sidecar}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, key = self.Key(), blocks = self.blocks)
+        os.replace(tmp, self.sidecar)
+
+
+    def Build(self, reader):
+        """ Read every TP in the file once and record the ranges of each block.
+
+        Args:
+            reader (Utilities.RawDataFile): open file
+        """
+        print(f"indexing TPs in {self.filename}")
+        blocks = []
+        tp_fragments = np.flatnonzero(reader.index.fragments["fragment_type"] == int(daqdataformats.FragmentType.kTriggerPrimitive))
+        for row in tp_fragments:
+            entry = reader.index.fragments[row]
+            fp = str(entry["path"])
+            tps = Decoders.DecodeTPPayload(reader.Payload(entry))
+            if tps is None:
+                tps = Decoders.DecodeTPs(reader.Fragment(fp))
+            n = len(tps["channel"])
+            if n == 0:
+                continue
+            first = np.arange(0, n, TPS_PER_BLOCK)
+            b = np.zeros(len(first), dtype=BLOCK_DTYPE)
+            b["fragment"] = row
+            b["first"] = first
+            b["n_tps"] = np.minimum(TPS_PER_BLOCK, n - first)
+            b["time_min"] = np.minimum.reduceat(tps["time_start"], first)
+            b["time_max"] = np.maximum.reduceat(tps["time_start"], first)
+            b["channel_min"] = np.minimum.reduceat(tps["channel"], first)
+            b["channel_max"] = np.maximum.reduceat(tps["channel"], first)
+            blocks.append(b)
+        self.blocks = np.concatenate(blocks) if blocks else np.zeros(0, dtype=BLOCK_DTYPE)
+
+
+    def Fragments(self) -> np.ndarray:
+        """ Ranges of each fragment, combined from its blocks.
+
+        Returns:
+            np.ndarray: fragment row, number of TPs, min/max time_start and channel
+        """
+        rows, starts = np.unique(self.blocks["fragment"], return_index=True)
+        summary = np.zeros(len(rows), dtype=[(n, BLOCK_DTYPE[n]) for n in BLOCK_DTYPE.names if n != "first"])
+        summary["fragment"] = rows
+        if len(rows):
+            summary["n_tps"] = np.add.reduceat(self.blocks["n_tps"], starts)
+            for name, reduce in [("time_min", np.minimum), ("time_max", np.maximum), ("channel_min", np.minimum), ("channel_max", np.maximum)]:
+                summary[name] = reduce.reduceat(self.blocks[name], starts)
+        return summary
+
+
+    def Match(self, blocks : np.ndarray, time_range : tuple = None, channel_range : tuple = None, plane_channels : np.ndarray = None) -> np.ndarray:
+        """ Which blocks can contain TPs in the ranges.
+
+        Args:
+            blocks (np.ndarray): blocks to check
+            time_range (tuple, optional): first and last time_start. Defaults to None (any).
+            channel_range (tuple, optional): first and last channel. Defaults to None (any).
+            plane_channels (np.ndarray, optional): cumulative count of channels in the selected planes, plane_channels[c] is the count below channel c. Defaults to None (any).
+
+        Returns:
+            np.ndarray: mask of blocks which may contain matches
+        """
+        mask = np.ones(len(blocks), dtype=bool)
+        if time_range is not None:
+            mask &= (blocks["time_max"] >= time_range[0]) & (blocks["time_min"] <= time_range[1])
+        if channel_range is not None:
+            mask &= (blocks["channel_max"] >= channel_range[0]) & (blocks["channel_min"] <= channel_range[1])
+        if plane_channels is not None:
+            high = np.clip(blocks["channel_max"] + 1, 0, len(plane_channels) - 1)
+            low = np.clip(blocks["channel_min"], 0, len(plane_channels) - 1)
+            mask &= plane_channels[high] > plane_channels[low]
+        return mask
+
+
+    def Select(self, reader, rid, time_range : tuple = None, channel_range : tuple = None, planes : list = None):
+        """ Decode the TPs of a record which are in the ranges, reading only the blocks which can contain them.
+
+        Args:
+            reader (Utilities.RawDataFile): open file
+            rid (tuple): record id
+            time_range (tuple, optional): first and last time_start. Defaults to None (any).
+            channel_range (tuple, optional): first and last channel. Defaults to None (any).
+            planes (list, optional): planes to keep (0, 1, 2 for u, v, z). Defaults to None (any).
+
+        Yields:
+            tuple: fragment path, record index entry, TP columns (only the TPs which match)
+        """
+        plane_channels = None
+        if planes is not None:
+            plane_channels = np.concatenate([[0], np.cumsum(np.isin(reader.cmap.plane, planes))])
+
+        rows = reader.index.FragmentRows(rid)
+        first, last = np.searchsorted(self.blocks["fragment"], [rows.start, rows.stop])
+        blocks = self.blocks[first:last]
+        blocks = blocks[self.Match(blocks, time_range, channel_range, plane_channels) & np.isin(blocks["fragment"], reader.FragmentRows(rid))]
+        if len(blocks) == 0:
+            return
+
+        version = Decoders.TPVersion()
+        item_size = Decoders.TP_DTYPES[version].itemsize if version is not None else None
+        for row in np.unique(blocks["fragment"]):
+            entry = reader.index.fragments[row]
+            fp = str(entry["path"])
+            selected = blocks[blocks["fragment"] == row]
+
+            #* merge consecutive blocks, so each run of them is one read
+            breaks = np.flatnonzero(selected["first"][1:] != selected["first"][:-1] + selected["n_tps"][:-1]) + 1
+            parts = []
+            for run in np.split(selected, breaks):
+                start, stop = int(run["first"][0]), int(run["first"][-1] + run["n_tps"][-1])
+                tps = None
+                if item_size is not None:
+                    payload = reader.PayloadRange(entry, start * item_size, stop * item_size)
+                    with reader.metrics.Timer("decode"):
+                        tps = Decoders.UnpackTPs(payload, version)
+                if tps is None:
+                    tps = {k : v[start:stop] for k, v in Decoders.DecodeTPs(reader.Fragment(fp)).items()}
+                parts.append(tps)
+            tps = {k : np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+            mask = np.ones(len(tps["channel"]), dtype=bool)
+            if time_range is not None:
+                mask &= (tps["time_start"] >= time_range[0]) & (tps["time_start"] <= time_range[1])
+            if channel_range is not None:
+                mask &= (tps["channel"] >= channel_range[0]) & (tps["channel"] <= channel_range[1])
+            if planes is not None:
+                mask &= np.isin(reader.cmap.Planes(tps["channel"]), planes)
+            if np.any(mask):
+                yield fp, entry, {k : v[mask] for k, v in tps.items()}
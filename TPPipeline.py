@@ -0,0 +1,514 @@
+"""
+Description: Single pass analysis of TP stream files. Each fragment is decoded once and handed to every consumer asked for
+(histograms, scatter plots, animation, TP source coverage, TP store/csv export, printing and debug logging), so any number of outputs
+costs one decode of the file. Only the TP fields the consumers need are unpacked.
+"""
+import Utilities
+import Decoders
+import Histograms
+import TPStore
+import DecodeCache
+
+import trgdataformats
+
+import os
+import matplotlib.pyplot as plt
+import pandas as pd
+import numpy as np
+from rich import print
+
+ALL_COLUMNS = frozenset(Decoders.TPColumns() + ["plane"])
+SAMPLES_TABLE = TPStore.TPTableDtype("samples") # consumers get TP times in samples (see TPPipeline.Run)
+
+
+def LogTPData(debug, tp, version : int = None):
+    """ Log some tp data
+
+    Args:
+        debug (bool): should we log
+        trigger primitive (daqdataformats.fragment): trigger primitive
+        version (int, optional): TP format version, picks which fields are printed. Defaults to None (any field the TP has).
+    """
+    if debug:
+        if version in Decoders.TP_ATTRIBUTES:
+            fields = Decoders.TP_ATTRIBUTES[version]
+        else:
+            fields = [f for f in dict.fromkeys(sum(Decoders.TP_ATTRIBUTES.values(), [])) if hasattr(tp, f)]
+        for f in fields:
+            print(f"{f}: {getattr(tp, f)}")
+        print(f"size: {tp.sizeof()}")
+
+
+class Consumer:
+    """ Something made from the TPs of a file. Override the methods which are needed.
+
+    Attributes:
+        name (str): timer name in the metrics
+        columns (frozenset): TP fields used (plane is looked up from the channel map), a consumer which only uses channel lets the pipeline skip unpacking the rest
+    """
+    name = "consumer"
+    columns = ALL_COLUMNS
+
+    def Record(self, rid):
+        """ Called before the fragments of a record.
+        """
+        pass
+
+
+    def Fragment(self, rid, fp : str, entry : np.ndarray, tps : dict):
+        """ Called for each fragment.
+
+        Args:
+            rid (tuple): record id
+            fp (str): fragment path
+            entry (np.ndarray): record index entry of the fragment
+            tps (dict): TP columns, at least the ones in columns, with time_peak and time_over_threshold in samples (Decoders.TPTimesInSamples)
+        """
+        pass
+
+
+    def EndRecord(self, rid):
+        """ Called after the fragments of a record.
+        """
+        pass
+
+
+    def Finish(self):
+        """ Called once every record has been read, write outputs here.
+        """
+        pass
+
+
+    def Close(self):
+        """ Called when the pipeline is closed, even if it stopped early. Release files here.
+        """
+        pass
+
+
+class TPPipeline:
+    """ Decodes each fragment of the records being studied once and hands the TPs to every consumer. Use as a context manager.
+
+    Attributes:
+        reader (Utilities.RawDataFile): open file
+        consumers (list): consumers
+        cache (DecodeCache.DecodeCache): decoded fragments from earlier runs, None to always decode
+        columns (frozenset): TP fields any of the consumers use
+    """
+    def __init__(self, reader : Utilities.RawDataFile, consumers : list, cache : DecodeCache.DecodeCache = None):
+        self.reader = reader
+        self.consumers = list(consumers)
+        self.cache = cache
+        self.columns = frozenset().union(*[c.columns for c in self.consumers])
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def Decode(self, rid):
+        """ Decode the TPs of each fragment in a record, straight from the file where possible.
+            Fragments in the decode cache aren't read at all.
+
+        Args:
+            rid (tuple): record id
+
+        Yields:
+            tuple: fragment path, record index entry, TP columns
+        """
+        channels_only = self.columns <= {"channel", "plane"}
+        cached = [None] * len(self.reader.Entries(rid))
+        if self.cache is not None:
+            decoder = "tp_channels" if channels_only else "tp"
+            keys = [self.cache.Key(self.reader, rid, entry, decoder) for entry in self.reader.Entries(rid)]
+            with self.reader.metrics.Timer("cache"):
+                cached = [self.cache.Get(key) for key in keys]
+            if all(tps is not None for tps in cached):
+                for entry, tps in zip(self.reader.Entries(rid), cached):
+                    yield str(entry["path"]), entry, tps
+                return
+
+        for i, (fp, entry, payload) in enumerate(self.reader.Payloads(rid)):
+            tps = cached[i]
+            if tps is None:
+                with self.reader.metrics.Timer("decode"):
+                    if channels_only:
+                        channels = Decoders.TPChannels(payload)
+                        tps = None if channels is None else {"channel" : channels}
+                    else:
+                        tps = Decoders.DecodeTPPayload(payload)
+                    if tps is None:
+                        tps = Decoders.DecodeTPs(self.reader.Fragment(fp))
+                if self.cache is not None:
+                    with self.reader.metrics.Timer("cache"):
+                        self.cache.Put(keys[i], tps)
+            yield fp, entry, tps
+
+
+    def Run(self, select = None):
+        """ Read every record and call the consumers, then finish them.
+
+        Args:
+            select (callable, optional): function of the record id which yields (fragment path, record index entry, TP columns), e.g. a TP index query. Defaults to None (Decode).
+        """
+        metrics = self.reader.metrics
+        cmap = self.reader.cmap
+        select = select or self.Decode
+        version = Decoders.TPVersion()
+        for rid in self.reader.toStudy:
+            metrics.Count("records")
+            for c in self.consumers:
+                c.Record(rid)
+            for fp, entry, tps in select(rid):
+                metrics.Count("tps", len(tps["channel"]))
+                tps = Decoders.TPTimesInSamples(tps, version) # so every output has the same units, whatever the TP format
+                if "plane" in self.columns:
+                    with metrics.Timer("channel_map"):
+                        tps["plane"] = cmap.Planes(tps["channel"])
+                    if metrics.enabled:
+                        metrics.Count("unknown_channels", np.count_nonzero(tps["plane"] < 0))
+                for c in self.consumers:
+                    with metrics.Timer(c.name):
+                        c.Fragment(rid, fp, entry, tps)
+                metrics.Progress()
+            for c in self.consumers:
+                c.EndRecord(rid)
+
+        for c in self.consumers:
+            with metrics.Timer(c.name):
+                c.Finish()
+
+
+    def Close(self):
+        for c in self.consumers:
+            c.Close()
+
+
+class Printer(Consumer):
+    """ Print the fragments of each record and the element names each TP source covers.
+    """
+    name = "print"
+    columns = frozenset(["channel"])
+
+    def __init__(self, reader : Utilities.RawDataFile, per_record : bool = False):
+        """
+        Args:
+            reader (Utilities.RawDataFile): open file
+            per_record (bool, optional): print the element names of every source after each record, rather than as each fragment is read. Defaults to False.
+        """
+        self.reader = reader
+        self.per_record = per_record
+        self.sources = {} # source id -> channels, of this record only
+
+
+    def Record(self, rid):
+        print(self.reader.FragmentPaths(rid))
+        self.sources = {}
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        source_id = int(entry["element_id"])
+        with self.reader.metrics.Timer("channel_map"):
+            element_id = self.reader.cmap.ElementNames(np.unique(tps["channel"]))
+        if self.per_record:
+            self.sources[source_id] = element_id
+            return
+        print(source_id)
+        print(f"number of TPs in fragment: {len(tps['channel'])}")
+        print(f"TP input source ID: {source_id}")
+        print(f"Element names: {np.unique(element_id)}")
+
+
+    def EndRecord(self, rid):
+        if self.per_record:
+            print(f"record id: {rid}")
+            for source_id, element_id in self.sources.items():
+                print(f"TP input source ID: {source_id}")
+                print(f"Element names: {np.unique(element_id)}")
+
+
+class DebugLogger(Consumer):
+    """ Print the header of each fragment and every TP, read with the hdf5libs and trgdataformats bindings.
+    """
+    name = "debug"
+    columns = frozenset(["channel"])
+
+    def __init__(self, reader : Utilities.RawDataFile):
+        self.reader = reader
+        self.version = Decoders.TPVersion()
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        fragment = self.reader.Fragment(fp)
+        Utilities.LogFragmentData(True, fp, fragment)
+        tp_size = trgdataformats.TriggerPrimitive.sizeof() # get size of TP packet in bytes
+        for i in range(len(tps["channel"])):
+            LogTPData(True, trgdataformats.TriggerPrimitive(fragment.get_data(i*tp_size)), self.version) # get TP data from pointer in fragment
+
+
+class HistogramFiller(Consumer):
+    """ TP validation histograms, saved and plotted at the end.
+    """
+    name = "histograms"
+
+    def __init__(self, cmap, outdir : str):
+        """
+        Args:
+            cmap (ChannelMaps.ChannelMap): channel map
+            outdir (str): output directory
+        """
+        self.hists = Histograms.TPHistograms(cmap)
+        self.outdir = outdir
+        self.origin = None # first timestamp of the file, time_start is binned relative to it
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        if self.origin is None and len(tps["time_start"]) > 0:
+            self.origin = int(tps["time_start"].min())
+        Histograms.FillTPHistograms(self.hists, tps, self.origin or 0)
+
+
+    def Finish(self):
+        os.makedirs(self.outdir, exist_ok=True)
+        self.hists.Save(f"{self.outdir}/histograms.npz") # can be merged with other runs using Histograms.py
+        Histograms.PlotHistograms(self.hists, self.outdir)
+
+
+class SliceAnimator(Consumer):
+    """ Gif of channel vs peak time of each time slice (fragment), binned as each slice is read.
+    """
+    name = "animation"
+    columns = frozenset(["channel", "time_start", "time_peak"]) # time_start to get the peak time of version 1 TPs in samples
+
+    def __init__(self, cmap, outdir : str, bins : tuple = (100, 100), workers : int = 1):
+        """
+        Args:
+            cmap (ChannelMaps.ChannelMap): channel map
+            outdir (str): output directory
+            bins (tuple, optional): about how many channel and peak time bins. Defaults to (100, 100).
+            workers (int, optional): processes drawing the frames. Defaults to 1.
+        """
+        self.slices = Histograms.TPSliceHistograms(cmap, bins)
+        self.outdir = outdir
+        self.workers = workers
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        self.slices.AddSlices([f"Time slice : {len(self.slices)}"])
+        self.slices.Fill(len(self.slices) - 1, tps["channel"], tps["time_peak"])
+
+
+    def Finish(self):
+        os.makedirs(self.outdir, exist_ok=True)
+        Histograms.SaveAnimation(self.slices, f"{self.outdir}/anim.gif", ("channel", "peak time"), self.workers)
+
+
+class ScatterCollector(Consumer):
+    """ Scatter plots of channel vs peak time in each plane, of the first time slice.
+    """
+    name = "scatter"
+
+    def __init__(self, outdir : str):
+        self.outdir = outdir
+        self.data = None
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        if self.data is None:
+            self.data = TPStore.DataFrame(TPStore.Compact(tps, rid[0], int(entry["element_id"]), SAMPLES_TABLE))
+
+
+    def Finish(self):
+        if self.data is None:
+            return
+        os.makedirs(self.outdir, exist_ok=True)
+        planes = Utilities.SortDataByPlane(self.data)
+        for p in planes:
+            plt.figure()
+            plt.scatter(planes[p]["channel"], planes[p]["time_peak"], c=planes[p]["adc_integral"], s=5)
+            cbar = plt.colorbar()
+            cbar.set_label("ADC integral")
+            plt.xlabel("channel")
+            plt.ylabel("peak time (samples)")
+            plt.title(f"Plane : {p}")
+            plt.tight_layout()
+            plt.savefig(f"{self.outdir}/scatter_{p}.png", dpi=400)
+            plt.close()
+
+
+class SourceCoverage(Consumer):
+    """ Channels and element names each TP source covers over all the records, and the records where they changed.
+
+    Attributes:
+        table (pd.DataFrame): one row per source id, made by Finish
+        changes (pd.DataFrame): records where the element names of a source changed, made by Finish
+    """
+    name = "coverage"
+    columns = frozenset(["channel"])
+
+    def __init__(self, reader : Utilities.RawDataFile, outdir : str = None):
+        """
+        Args:
+            reader (Utilities.RawDataFile): open file
+            outdir (str, optional): write the tables as csv files to this directory. Defaults to None.
+        """
+        self.reader = reader
+        self.outdir = outdir
+        self.channels = {} # source id -> unique channels seen
+        self.n_tps = {} # source id -> number of TPs
+        self.n_records = {} # source id -> number of records with a fragment from this source
+        self.current = {} # source id -> element names in the last record it appeared in
+        self.rows = []
+        self.seen = np.zeros(len(reader.cmap.plane), dtype=bool) # reused to find the unique channels, quicker than sorting them
+        self.table = None
+        self.changes = None
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        cmap = self.reader.cmap
+        metrics = self.reader.metrics
+        source_id = int(entry["element_id"])
+        tp_channels = tps["channel"]
+        if len(tp_channels) and int(tp_channels.max()) >= len(self.seen):
+            self.seen = np.zeros(int(tp_channels.max()) + 1, dtype=bool)
+        self.seen[tp_channels] = True
+        unique = np.flatnonzero(self.seen)
+        self.seen[unique] = False
+        with metrics.Timer("channel_map"):
+            ids = np.unique(cmap.Elements(unique)) # unique element ids first, comparing strings is slow
+            elements = tuple(sorted(np.append(cmap.element_names, "")[ids])) # -1 (unknown) -> ""
+        if metrics.enabled and "plane" not in tps:
+            metrics.Count("unknown_channels", np.count_nonzero(cmap.Planes(unique) < 0))
+
+        if source_id in self.current and self.current[source_id] != elements:
+            self.rows.append({"record" : rid[0], "sequence" : rid[1], "source_id" : source_id, "before" : " ".join(self.current[source_id]), "after" : " ".join(elements)})
+        self.current[source_id] = elements
+        self.channels[source_id] = np.union1d(self.channels.get(source_id, unique[:0]), unique)
+        self.n_tps[source_id] = self.n_tps.get(source_id, 0) + len(tp_channels)
+        self.n_records[source_id] = self.n_records.get(source_id, 0) + 1
+
+
+    def Finish(self):
+        cmap = self.reader.cmap
+        table = []
+        for source_id in sorted(self.channels):
+            c = self.channels[source_id]
+            table.append({
+                "source_id" : source_id,
+                "element_names" : " ".join(np.unique(cmap.ElementNames(c))),
+                "n_channels" : len(c),
+                "channel_min" : c.min() if len(c) else -1,
+                "channel_max" : c.max() if len(c) else -1,
+                "n_tps" : self.n_tps[source_id],
+                "n_records" : self.n_records[source_id],
+            })
+        self.table = pd.DataFrame(table)
+        self.changes = pd.DataFrame(self.rows, columns=["record", "sequence", "source_id", "before", "after"])
+
+        with pd.option_context("display.max_rows", None, "display.max_colwidth", None, "display.width", None):
+            print(self.table)
+            if len(self.changes):
+                print(f"element names covered by a TP source changed in {self.changes['record'].nunique()} records:")
+                print(self.changes)
+            else:
+                print("element names covered by each TP source are the same in every record")
+        if self.outdir:
+            os.makedirs(self.outdir, exist_ok=True)
+            self.table.to_csv(f"{self.outdir}/tp_source_coverage.csv", index=False)
+            self.changes.to_csv(f"{self.outdir}/tp_source_coverage_changes.csv", index=False)
+
+
+class StoreWriter(Consumer):
+    """ Write every TP to a TP store (see TPStore.py).
+    """
+    name = "write"
+
+    def __init__(self, filename : str, mode : str = "w"):
+        self.store = TPStore.TPStore(filename, mode, time_unit = "samples")
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        self.store.Append(rid, TPStore.Compact(tps, rid[0], int(entry["element_id"]), SAMPLES_TABLE), "samples")
+
+
+    def Finish(self):
+        self.store.Close()
+
+
+    def Close(self):
+        self.store.Close()
+
+
+class CSVWriter(Consumer):
+    """ Write every TP to a csv file, one row per TP with the TP store columns.
+    """
+    name = "write_csv"
+
+    def __init__(self, filename : str):
+        self.file = open(filename, "w")
+        self.header = True
+
+
+    def Fragment(self, rid, fp, entry, tps):
+        TPStore.DataFrame(TPStore.Compact(tps, rid[0], int(entry["element_id"]), SAMPLES_TABLE)).to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+
+    def Finish(self):
+        self.Close()
+
+
+    def Close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def AddArguments(parser, per_record : bool = False):
+    """ Add the options which choose the consumers to a command line parser.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+        per_record (bool, optional): element names are printed after each record by default. Defaults to False.
+    """
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="print record and TP information")
+    parser.add_argument("-p", "--plot", dest="plot", type=str, nargs="+", default=[], choices=["validation", "gif", "scatter"], help="create plots of TP data, any number of them are made from one pass over the file")
+    parser.add_argument("--gif-bins", dest="gif_bins", type=int, nargs=2, default=[100, 100], metavar=("CHANNEL", "TIME"), help="number of channel and peak time bins of the gif, each time slice is binned as it is read")
+    parser.add_argument("--gif-workers", dest="gif_workers", type=int, default=1, help="processes drawing the frames of the gif")
+    parser.add_argument("--coverage", dest="coverage", action="store_true", help="tabulate the channels and element names covered by each TP source over all records")
+    parser.add_argument("--store", dest="store", type=str, default=None, help="write every TP read to this TP store (hdf5, see TPStore.py)")
+    parser.add_argument("--csv", dest="csv", type=str, default=None, help="write every TP read to this csv file")
+    parser.add_argument("-q", "--quiet", dest="quiet", action="store_true", help="don't print the element names of each " + ("record" if per_record else "fragment"))
+    parser.set_defaults(per_record=per_record)
+
+
+def FromArguments(reader : Utilities.RawDataFile, args) -> TPPipeline:
+    """ Make the pipeline asked for with the options added by AddArguments (and DecodeCache.AddArguments).
+
+    Args:
+        reader (Utilities.RawDataFile): open file
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        TPPipeline: pipeline
+    """
+    consumers = []
+    if not args.quiet:
+        consumers.append(Printer(reader, args.per_record))
+    if args.debug:
+        consumers.append(DebugLogger(reader))
+    if "validation" in args.plot:
+        consumers.append(HistogramFiller(reader.cmap, args.outdir))
+    if "gif" in args.plot:
+        consumers.append(SliceAnimator(reader.cmap, args.outdir, args.gif_bins, args.gif_workers))
+    if "scatter" in args.plot:
+        consumers.append(ScatterCollector(args.outdir))
+    if args.coverage:
+        consumers.append(SourceCoverage(reader, args.outdir))
+    if args.store:
+        consumers.append(StoreWriter(args.store))
+    if args.csv:
+        consumers.append(CSVWriter(args.csv))
+    return TPPipeline(reader, consumers, DecodeCache.FromArguments(args, reader.metrics))
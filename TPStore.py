@@ -0,0 +1,287 @@
+"""
+Description: Compact TP tables and an appendable hdf5 store for them, so TP streams longer than fit in memory can be kept and analysed.
+Each TP is a row of a numpy structured array with the narrowest type each field fits in. The store is partitioned by record,
+and can be read back, or aggregated by plane, channel or source id, a chunk at a time. Run as a script to summarise a store.
+"""
+import Decoders
+
+import argparse
+import h5py
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = 2 # bump if the layout of the store changes
+CHUNK_ROWS = 2**16 # rows per hdf5 chunk, and rows buffered before they are written
+TIME_UNITS = ("samples", "ticks") # units of time_peak and time_over_threshold, see TimeUnit
+
+RECORD_DTYPE = np.dtype([
+    ("record", "<u4"), # same as the TP table
+    ("sequence", "<u2"),
+    ("first", "<u8"), # first row of the record in the table
+    ("n_tps", "<u8"),
+])
+
+
+def TimeUnit(version : int = None) -> str:
+    """ Unit of time_peak and time_over_threshold of decoded TPs. Version 1 TPs have an absolute time_peak and count time over threshold
+        in timestamp ticks, version 2 TPs (and TPs found by TPFinder) count both in samples, time_peak from time_start.
+
+    Args:
+        version (int, optional): TP format version. Defaults to None (Decoders.TPVersion()).
+
+    Returns:
+        str: ticks or samples
+    """
+    if version is None:
+        version = Decoders.TPVersion()
+    return "ticks" if version == 1 else "samples"
+
+
+def TPTableDtype(time_unit : str = None) -> np.dtype:
+    """ Row of a TP table, 33 bytes for times in samples (compared to 8 bytes per field in an int64 DataFrame).
+
+    Args:
+        time_unit (str, optional): unit of time_peak and time_over_threshold, ticks needs wider fields. Defaults to None (TimeUnit()).
+
+    Returns:
+        np.dtype: table row
+    """
+    if time_unit is None:
+        time_unit = TimeUnit()
+    if time_unit not in TIME_UNITS:
+        raise Exception(f"unknown time unit {time_unit}, expected one of {TIME_UNITS}")
+    wide = time_unit == "ticks"
+    return np.dtype([
+        ("record", "<u4"),
+        ("source_id", "<u4"),
+        ("time_start", "<u8"),
+        ("time_peak", "<u8" if wide else "<u2"),
+        ("time_over_threshold", "<u4" if wide else "<u2"),
+        ("channel", "<u4"),
+        ("adc_integral", "<u4"),
+        ("adc_peak", "<u2"),
+        ("det_id", "<u2"),
+        ("plane", "i1"),
+    ])
+
+
+def Compact(tps : dict, record : int = 0, source_id : int = 0, dtype : np.dtype = None) -> np.ndarray:
+    """ Pack decoded TP columns into a compact table.
+
+    Args:
+        tps (dict): TP columns (from the Decoders or TPFinder), with plane
+        record (int, optional): record number. Defaults to 0.
+        source_id (int, optional): source id of the fragment. Defaults to 0.
+        dtype (np.dtype, optional): table row. Defaults to None (TPTableDtype()).
+
+    Returns:
+        np.ndarray: table
+    """
+    table = np.empty(len(tps["channel"]), dtype=dtype or TPTableDtype())
+    table["record"] = record
+    table["source_id"] = source_id
+    for name in table.dtype.names[2:]:
+        table[name] = tps[name]
+    return table
+
+
+class TPStore:
+    """ TP tables in an hdf5 file, one row per TP with the rows of each record kept together. Use as a context manager.
+
+    Datasets:
+        tps (TP): TPTableDtype table
+        records (record): RECORD_DTYPE, where the rows of each record are
+
+    Attributes:
+        time_unit (str): unit of time_peak and time_over_threshold (file attribute time_unit), every TP in the store has the same unit
+    """
+    def __init__(self, filename : str, mode : str = "r", compression : str = "gzip", compression_opts : int = 1, time_unit : str = None):
+        """
+        Args:
+            filename (str): store file
+            mode (str, optional): r to read, w to write a new store, a to add to an existing one. Defaults to "r".
+            compression (str, optional): hdf5 compression filter. Defaults to "gzip".
+            compression_opts (int, optional): compression level. Defaults to 1.
+            time_unit (str, optional): unit of the times of the TPs which will be added, must match an existing store. Defaults to None (TimeUnit() for a new store).
+        """
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        self._buffer = []
+        self._buffered = 0
+        self._records = [] # records added since the last flush
+        if "tps" not in self.file:
+            if mode == "r":
+                raise Exception(f"{filename} is not a TP store")
+            options = {"compression" : compression, "compression_opts" : compression_opts, "shuffle" : True} if compression else {}
+            self.file.attrs["store_version"] = STORE_VERSION
+            self.file.attrs["time_unit"] = time_unit or TimeUnit()
+            self.file.create_dataset("tps", shape = (0,), maxshape = (None,), chunks = (CHUNK_ROWS,), dtype = TPTableDtype(self.file.attrs["time_unit"]), **options)
+            self.file.create_dataset("records", shape = (0,), maxshape = (None,), chunks = (1024,), dtype = RECORD_DTYPE)
+        self.dtype = self.file["tps"].dtype
+        if "time_unit" in self.file.attrs:
+            self.time_unit = str(self.file.attrs["time_unit"])
+        else:
+            self.time_unit = "ticks" if self.dtype["time_peak"].itemsize == 8 else "samples" # stores from before the unit was recorded
+        if time_unit is not None and time_unit != self.time_unit:
+            raise Exception(f"{filename} holds TP times in {self.time_unit}, not {time_unit}")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def __len__(self):
+        return len(self.file["tps"]) + self._buffered
+
+
+    def Close(self):
+        """ Write anything buffered and close the file.
+        """
+        if self.file is not None:
+            if self.file.mode != "r":
+                self.Flush()
+            self.file.close()
+            self.file = None
+
+
+    def Append(self, rid, table : np.ndarray, time_unit : str):
+        """ Add TPs of a record. Everything added for a record must be added before the next record.
+
+        Args:
+            rid (tuple): record id (record number, sequence number)
+            table (np.ndarray): TPs, made with Compact
+            time_unit (str): unit of time_peak and time_over_threshold in table, must be the unit of the store
+        """
+        if time_unit != self.time_unit:
+            raise Exception(f"can't add TPs with times in {time_unit} to {self.filename}, which holds times in {self.time_unit}")
+        first = len(self)
+        if self._records and tuple(self._records[-1][:2]) == tuple(rid):
+            self._records[-1][3] += len(table)
+        elif not self._records and len(self.file["records"]) and tuple(self.file["records"][-1][["record", "sequence"]]) == tuple(rid):
+            self._records.append(list(self.file["records"][-1]))
+            self._records[-1][3] += len(table)
+            self.file["records"].resize(len(self.file["records"]) - 1, axis = 0) # rewritten on the next flush
+        else:
+            self._records.append([rid[0], rid[1], first, len(table)])
+        self._buffer.append(np.asarray(table, dtype = self.dtype))
+        self._buffered += len(table)
+        if self._buffered >= CHUNK_ROWS:
+            self.Flush()
+
+
+    def Flush(self):
+        """ Write the buffered TPs to the file.
+        """
+        for name, data in [("tps", np.concatenate(self._buffer) if self._buffer else np.zeros(0, self.dtype)), ("records", np.array([tuple(r) for r in self._records], dtype = RECORD_DTYPE))]:
+            n = len(self.file[name])
+            self.file[name].resize(n + len(data), axis = 0)
+            self.file[name][n:] = data
+        self._buffer = []
+        self._buffered = 0
+        self._records = []
+
+
+    def Records(self) -> np.ndarray:
+        """ Records in the store and where their TPs are.
+
+        Returns:
+            np.ndarray: RECORD_DTYPE table
+        """
+        return self.file["records"][:]
+
+
+    def Record(self, rid) -> np.ndarray:
+        """ Read the TPs of one record.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            np.ndarray: TPs
+        """
+        records = self.Records()
+        i = np.flatnonzero((records["record"] == rid[0]) & (records["sequence"] == rid[1]))
+        if len(i) == 0:
+            raise Exception(f"record {rid} is not in {self.filename}")
+        return self.file["tps"][records["first"][i[0]] : records["first"][i[0]] + records["n_tps"][i[0]]]
+
+
+    def Chunks(self, rows : int = 16 * CHUNK_ROWS, columns : list = None):
+        """ Read the TPs a block of rows at a time.
+
+        Args:
+            rows (int, optional): rows per block, sets the memory used. Defaults to 16 * CHUNK_ROWS.
+            columns (list, optional): only read these fields. Defaults to None (all).
+
+        Yields:
+            np.ndarray: TPs
+        """
+        dataset = self.file["tps"]
+        if columns is not None:
+            dataset = dataset.fields(list(columns))
+        for first in range(0, len(self.file["tps"]), rows):
+            yield dataset[first : first + rows]
+
+
+    def GroupBy(self, keys, columns : list = None, rows : int = 16 * CHUNK_ROWS) -> pd.DataFrame:
+        """ Count, mean, standard deviation, min and max of columns for each group, computed a chunk at a time.
+
+        Args:
+            keys (str or list): fields to group by e.g. plane, channel or source_id
+            columns (list, optional): fields to aggregate. Defaults to None (adc_peak, adc_integral and time_over_threshold).
+            rows (int, optional): rows read at once. Defaults to 16 * CHUNK_ROWS.
+
+        Returns:
+            pd.DataFrame: one row per group, columns (field, statistic)
+        """
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        columns = columns or ["adc_peak", "adc_integral", "time_over_threshold"]
+        partials = []
+        for chunk in self.Chunks(rows, keys + columns):
+            grouped = DataFrame(chunk).groupby(keys)[columns]
+            n = grouped.count()
+            partials.append(pd.concat({"count" : n, "mean" : grouped.mean(), "m2" : grouped.var(ddof = 0) * n, "min" : grouped.min(), "max" : grouped.max()}, axis = 1))
+        if len(partials) == 0:
+            return pd.DataFrame()
+
+        #* combine the chunks with the parallel form of Welford's algorithm, like Pedestals.PedestalEstimator
+        partials = pd.concat(partials)
+        n = partials["count"].groupby(level = keys).sum()
+        mean = (partials["mean"] * partials["count"]).groupby(level = keys).sum() / n
+        m2 = (partials["m2"] + partials["count"] * (partials["mean"] - mean.reindex(partials.index))**2).groupby(level = keys).sum()
+        std = np.sqrt(m2 / (n - 1).where(n > 1))
+        result = pd.concat({"count" : n, "mean" : mean, "std" : std, "min" : partials["min"].groupby(level = keys).min(), "max" : partials["max"].groupby(level = keys).max()}, axis = 1)
+        return result.swaplevel(axis = 1).reindex(columns = pd.MultiIndex.from_product([columns, ["count", "mean", "std", "min", "max"]]))
+
+
+def DataFrame(table : np.ndarray) -> pd.DataFrame:
+    """ DataFrame of a TP table, the columns keep their compact types.
+
+    Args:
+        table (np.ndarray): TPs
+
+    Returns:
+        pd.DataFrame: TPs
+    """
+    return pd.DataFrame({name : table[name] for name in table.dtype.names})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise a TP store, a chunk at a time")
+    parser.add_argument(dest="file", type=str, help="TP store.")
+    parser.add_argument("-g", "--group-by", dest="group_by", type=str, nargs="+", default=["plane"], choices=["plane", "channel", "source_id", "record", "det_id"], help="fields to group by")
+    parser.add_argument("--columns", dest="columns", type=str, nargs="+", default=None, help="fields to aggregate (default adc_peak adc_integral time_over_threshold)")
+    parser.add_argument("--csv", dest="csv", type=str, default=None, help="write the summary to this csv file")
+    args = parser.parse_args()
+
+    with TPStore(args.file) as store:
+        print(f"{len(store)} TPs in {len(store.Records())} records, {store.dtype.itemsize} bytes per TP, times in {store.time_unit}")
+        summary = store.GroupBy(args.group_by, args.columns)
+    with pd.option_context("display.max_rows", 50, "display.width", None):
+        print(summary)
+    if args.csv:
+        summary.to_csv(args.csv)
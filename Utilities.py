@@ -5,37 +5,340 @@ Author: Shyam Bhuller
 
 Description: Utility functions
 """
+from ChannelMaps import ChannelMap
+from Metrics import Metrics
+from RecordIndex import RecordIndex
+from Decoders import FRAGMENT_HEADER_DTYPE
+from Prefetch import Prefetcher
+
 from hdf5libs import HDF5RawDataFile
-import detchannelmaps
+import daqdataformats
 
 import pandas as pd
+import numpy as np
 import h5py
 import re
+import os
+import threading
+
+SUBSYSTEMS = {"Unknown" : 0, "DetectorReadout" : 1, "HwSignalsInterface" : 2, "Trigger" : 3, "TRBuilder" : 4} # daqdataformats SourceID::Subsystem
+
+class RawDataFile:
+    """ Reader for a DAQ hdf5 file which hands out records and their fragments one at a time.
+        Use as a context manager so the file is closed as soon as we are done with it.
+
+    Attributes:
+        filename (str): hdf5 file
+        recordsToStudy (str): record mask
+        h5_file (HDF5RawDataFile): data file class, None once closed
+        index (RecordIndex): records and fragments in the file
+        cmap (ChannelMap): channel map lookup tables
+        attributes (dict): file attributes
+        toStudy (list): record ids to process
+        fragmentFilter (dict): subsystems, fragment types and source ids of the fragments to read, None for any
+        metrics (Metrics): timers and counters for reading the file
+        prefetcher (Prefetcher): reads the next records in the background, None unless Prefetch is called
+    """
+    def __init__(self, filename : str, recordsToStudy : str, channelMap : str = 'VDColdboxChannelMap', verbose : bool = True, metrics : Metrics = None, fragmentFilter : dict = None):
+        """
+        Args:
+            filename (str): hdf5file
+            recordsToStudy (str): record mask
+            channelMap (str, optional): channel map name. Defaults to 'VDColdboxChannelMap'.
+            verbose (bool, optional): print file attributes and the records selected. Defaults to True.
+            metrics (Metrics, optional): where to record read times and sizes. Defaults to None (disabled).
+            fragmentFilter (dict, optional): only read fragments with these "subsystem", "fragment_type" and "source_id" values (lists of ints),
+                made with FragmentFilter. Defaults to None (all fragments).
+        """
+        self.filename = filename
+        self.fragmentFilter = fragmentFilter or {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.recordsToStudy = recordsToStudy
+        self.cmap = ChannelMap(channelMap)
+
+        #* get attributes using h5py, hdf5libs doesn't expose them so read them once and close the handle straight away
+        with h5py.File(filename, 'r') as h5py_file:
+            self.attributes = dict(h5py_file.attrs.items())
+        if verbose:
+            for attr in self.attributes.items():
+                print("File Attribute ", attr[0], " = ", attr[1])
+
+        self.h5_file = HDF5RawDataFile(filename)
+        with self.metrics.Timer("index"):
+            self.index = RecordIndex(filename, self.h5_file)
+        self._mmap = None # view of the whole file, for fragments stored contiguously
+        self._h5py_file = None # for fragments which are chunked or compressed
+        self._fd = None # file descriptor used by the prefetch threads, which read copies of the payloads
+        self._lock = threading.Lock() # the HDF5 library isn't thread safe, only one thread at a time can use it
+        self.prefetcher = None
+        records = self.index.RecordIDs()
+        if verbose: print("Number of records: %d" % len(records))
+        self.toStudy = ParseRecordMap(recordsToStudy, records, verbose)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def __iter__(self):
+        return self.Records()
+
+
+    def Close(self):
+        """ Release the file handles.
+        """
+        self.cmap.Flush()
+        if self.prefetcher is not None:
+            self.prefetcher.Close()
+            self.prefetcher = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.h5_file = None
+        self._mmap = None
+        if self._h5py_file is not None:
+            self._h5py_file.close()
+            self._h5py_file = None
+
+
+    def _Selected(self, entries : np.ndarray) -> np.ndarray:
+        """ Which fragments pass the fragment filter, only the header information in the index is used.
+        """
+        mask = np.ones(len(entries), dtype=bool)
+        for field, name in [("subsystem", "subsystem"), ("fragment_type", "fragment_type"), ("source_id", "element_id")]:
+            if self.fragmentFilter.get(field):
+                mask &= np.isin(entries[name], self.fragmentFilter[field])
+        return mask
+
+
+    def Entries(self, rid) -> np.ndarray:
+        """ Record index entries of the fragments in a record which pass the fragment filter.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            np.ndarray: rows of the record index
+        """
+        entries = self.index.Fragments(rid)
+        return entries[self._Selected(entries)] if self.fragmentFilter else entries
+
+
+    def Prefetch(self, depth : int = 2, maxBytes : int = 512 * 2**20, workers : int = 1, fragments : bool = False, perRecord : int = None):
+        """ Read the selected records ahead in background threads, Payloads (or Fragments) then hands them out without waiting for the disk.
+            Only helps if the records are processed in order, in this process.
+
+        Args:
+            depth (int, optional): records to read ahead. Defaults to 2.
+            maxBytes (int, optional): memory limit of the records read ahead. Defaults to 512 MiB.
+            workers (int, optional): reading threads. Defaults to 1.
+            fragments (bool, optional): read ahead for Fragments instead of Payloads. Defaults to False.
+            perRecord (int, optional): only read ahead the first perRecord fragments of each record. Defaults to None (all).
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.Close()
+        self.prefetcher = Prefetcher(self, depth, maxBytes, workers, fragments, perRecord)
+
+
+    def FragmentRows(self, rid) -> np.ndarray:
+        """ Positions in the record index of the fragments in a record which pass the fragment filter.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            np.ndarray: row numbers
+        """
+        rows = self.index.FragmentRows(rid)
+        rows = np.arange(rows.start, rows.stop)
+        return rows[self._Selected(self.index.fragments[rows])] if self.fragmentFilter else rows
+
+
+    def FragmentPaths(self, rid) -> list:
+        """ Paths to the fragments in a record which pass the fragment filter.
+
+        Args:
+            rid (tuple): record id
+
+        Returns:
+            list: fragment dataset paths
+        """
+        return [str(p) for p in self.Entries(rid)["path"]]
+
+
+    def Fragments(self, rid):
+        """ Read the fragments in a record, one at a time.
+
+        Args:
+            rid (tuple): record id
+
+        Yields:
+            tuple: fragment path, fragment
+        """
+        paths = self.FragmentPaths(rid)
+        prefetched = self.prefetcher.Get(rid, fragments = True) if self.prefetcher is not None else None
+        for fp, _, fragment in prefetched or []:
+            self.metrics.Count("fragments")
+            self.metrics.Count("bytes_read", fragment.get_size())
+            yield fp, fragment
+        for fp in paths[len(prefetched or []):]:
+            self.metrics.Count("fragments")
+            yield fp, self.Fragment(fp)
+
+
+    def Fragment(self, fp : str):
+        """ Read a single fragment.
+
+        Args:
+            fp (str): fragment path
+
+        Returns:
+            daqdataformats.fragment: fragment
+        """
+        with self.metrics.Timer("get_frag"):
+            fragment = self._ReadFragment(fp)
+        self.metrics.Count("bytes_read", fragment.get_size())
+        return fragment
+
+
+    def _ReadFragment(self, fp : str):
+        with self._lock:
+            return self.h5_file.get_frag(fp)
+
 
-def OpenFile(filename : str, recordsToStudy : str, channelMap : str = 'VDColdboxChannelMap'):
-    """Open file and get a list of records/slices to process and the channel map.
+    def Payload(self, entry : np.ndarray) -> np.ndarray:
+        """ Get the payload of a fragment (everything after the header) without making a Fragment.
+            Contiguous datasets are memory mapped, so nothing is copied and only the pages touched are read.
+            Anything else is read into a new array.
+
+        Args:
+            entry (np.ndarray): row of the record index for this fragment
+
+        Returns:
+            np.ndarray: read-only payload bytes
+        """
+        self.metrics.Count("bytes_read", entry["payload_size"])
+        with self.metrics.Timer("read"):
+            return self._Payload(entry)
+
+
+    def _Payload(self, entry : np.ndarray) -> np.ndarray:
+        header_size = FRAGMENT_HEADER_DTYPE.itemsize
+        start = int(entry["offset"])
+        if start >= 0:
+            if self._mmap is None:
+                self._mmap = np.memmap(self.filename, dtype=np.uint8, mode="r")
+            return self._mmap[start + header_size : start + header_size + int(entry["payload_size"])]
+
+        return self._ReadPayload(entry) # chunked or compressed, read into a new array so payloads which are kept stay valid
+
+
+    def _Dataset(self, entry : np.ndarray) -> h5py.Dataset:
+        """ h5py dataset of a fragment, hold self._lock while using it.
+        """
+        if self._h5py_file is None:
+            self._h5py_file = h5py.File(self.filename, "r")
+        return self._h5py_file[str(entry["path"])]
+
+
+    def _ReadPayload(self, entry : np.ndarray) -> np.ndarray:
+        """ Read the payload of a fragment into a new array, so it stays valid after later reads. Safe to call from the prefetch threads.
+        """
+        header_size = FRAGMENT_HEADER_DTYPE.itemsize
+        start = int(entry["offset"])
+        size = int(entry["payload_size"])
+        if start >= 0:
+            #* pread doesn't hold the GIL while waiting for the disk, so decoding carries on in the main thread
+            if self._fd is None:
+                with self._lock:
+                    if self._fd is None: self._fd = os.open(self.filename, os.O_RDONLY)
+            data = os.pread(self._fd, size, start + header_size)
+            if len(data) != size:
+                raise Exception(f"short read of {entry['path']}: {len(data)} of {size} bytes")
+            return np.frombuffer(data, dtype=np.uint8) # read-only, like the other payloads
+
+        with self._lock:
+            dataset = self._Dataset(entry)
+            data = np.empty(dataset.shape[0], dtype=dataset.dtype)
+            dataset.read_direct(data)
+        payload = data[header_size:].view(np.uint8)
+        payload.flags.writeable = False
+        return payload
+
+
+    def PayloadRange(self, entry : np.ndarray, start : int, stop : int) -> np.ndarray:
+        """ Get part of the payload of a fragment, only the bytes asked for are read (for chunked datasets, only the chunks containing them).
+
+        Args:
+            entry (np.ndarray): row of the record index for this fragment
+            start (int): first byte of the payload
+            stop (int): byte after the last one
+
+        Returns:
+            np.ndarray: read-only payload bytes
+        """
+        header_size = FRAGMENT_HEADER_DTYPE.itemsize
+        stop = min(int(stop), int(entry["payload_size"]))
+        self.metrics.Count("bytes_read", max(0, stop - start))
+        with self.metrics.Timer("read"):
+            offset = int(entry["offset"])
+            if offset >= 0:
+                if self._mmap is None:
+                    self._mmap = np.memmap(self.filename, dtype=np.uint8, mode="r")
+                return self._mmap[offset + header_size + start : offset + header_size + stop]
+            with self._lock:
+                payload = self._Dataset(entry)[header_size + start : header_size + stop].view(np.uint8)
+            payload.flags.writeable = False
+            return payload
+
+
+    def Payloads(self, rid):
+        """ Get the payloads of the fragments in a record, one at a time.
+
+        Args:
+            rid (tuple): record id
+
+        Yields:
+            tuple: fragment path, record index entry, payload
+        """
+        entries = self.Entries(rid)
+        prefetched = self.prefetcher.Get(rid) if self.prefetcher is not None else None
+        for fp, entry, payload in prefetched or []:
+            self.metrics.Count("fragments")
+            self.metrics.Count("bytes_read", entry["payload_size"])
+            yield fp, entry, payload
+        for entry in entries[len(prefetched or []):]:
+            self.metrics.Count("fragments")
+            yield str(entry["path"]), entry, self.Payload(entry)
+
+
+    def Records(self):
+        """ Go through the selected records, nothing is read until the fragments are asked for.
+
+        Yields:
+            tuple: record id, fragment generator
+        """
+        for rid in self.toStudy:
+            yield rid, self.Fragments(rid)
+
+
+def OpenFile(filename : str, recordsToStudy : str, channelMap : str = 'VDColdboxChannelMap', metrics : Metrics = None, fragmentFilter : dict = None) -> RawDataFile:
+    """Open file and get the records/slices to process and the channel map.
 
     Args:
         filename (str): hdf5file
         recordsToStudy (str): record mask
+        metrics (Metrics, optional): timers and counters. Defaults to None (disabled).
+        fragmentFilter (dict, optional): which fragments to read, see FragmentFilter. Defaults to None (all).
 
     Returns:
-        tuple: data file class, channel map, record list
+        RawDataFile: reader, which yields records and fragments
     """
-    h5_file = HDF5RawDataFile(filename)
-    cmap = detchannelmaps.make_tpc_map(channelMap)
-
-    #* get attributes using h5py
-    h5py_file = h5py.File(filename, 'r')
-    for attr in h5py_file.attrs.items():
-        print("File Attribute ", attr[0], " = ", attr[1])
-
-    records = h5_file.get_all_record_ids()
-    print("Number of records: %d" % len(records))
-    selectedRecords = ParseRecordMap(recordsToStudy)
-    toStudy = [records[selectedRecords[i]] for i in range(len(selectedRecords))]
-
-    return h5_file, cmap, toStudy
+    return RawDataFile(filename, recordsToStudy, channelMap, metrics = metrics, fragmentFilter = fragmentFilter)
 
 
 def LogFragmentData(debug, fragment_path, fragment):
@@ -75,23 +378,111 @@ def SortDataByPlane(data : pd.DataFrame) -> dict:
     return {"u": uPlane, "v": vPlane, "z": zPlane}
 
 
-def ParseRecordMap(string : str):
-    """ Break down a record map into a list of records to study
+def _ParseIntegers(string : str) -> list:
+    """ Comma separated integers and inclusive ranges e.g. "1,4-6" -> [1, 4, 5, 6].
+    """
+    values = []
+    for token in string.replace(" ", "").split(","):
+        if re.fullmatch(r"\d+-\d+", token):
+            first, last = map(int, token.split("-"))
+            values.extend(range(first, last + 1))
+        elif re.fullmatch(r"-?\d+", token):
+            values.append(int(token))
+        elif token:
+            raise Exception(f"can't parse '{token}', expected integers or ranges e.g. 1,4-6")
+    return values
+
+
+def ParseRecordMap(string : str, records : list, verbose : bool = True) -> list:
+    """ Select records with a comma separated list of:
+            all or *    every record
+            N           record at position N in the file, negative counts from the end (-1 is the last record)
+            A-B         positions A to B (inclusive), A- goes to the end
+            A:B:S       python style slice of positions, any part can be left out e.g. ::10 is every 10th record
+            rN          every record (any sequence number) with record number N, rN.S for sequence number S
+            rA-rB       record numbers A to B (inclusive), rA- goes to the end
 
     Args:
         string (str): record map
+        records (list): (record number, sequence number) of each record in the file
+        verbose (bool, optional): print the records. Defaults to True.
 
     Returns:
-        list: list of record numbers
+        list: record ids, in the order they were asked for (without repeats)
+    """
+    n = len(records)
+    positions = []
+    for token in str(string).replace(" ", "").split(","):
+        if token == "":
+            continue
+        elif token.lower() in ["all", "*"]:
+            positions.extend(range(n))
+        elif re.fullmatch(r"-?\d+", token):
+            i = int(token)
+            if not -n <= i < n:
+                raise Exception(f"record {i} is out of range, the file has {n} records")
+            positions.append(i % n)
+        elif re.fullmatch(r"\d+-\d*", token):
+            first, last = token.split("-")
+            last = int(last) if last else n - 1
+            if last >= n: print(f"records {token} go past the end of the file ({n} records)")
+            positions.extend(range(int(first), min(last, n - 1) + 1))
+        elif re.fullmatch(r"-?\d*:-?\d*(:-?\d*)?", token):
+            positions.extend(range(n)[slice(*[int(p) if p else None for p in token.split(":")])])
+        elif re.fullmatch(r"r\d+(\.\d+)?", token):
+            number, _, sequence = token[1:].partition(".")
+            positions.extend(i for i, r in enumerate(records) if r[0] == int(number) and (not sequence or r[1] == int(sequence)))
+        elif re.fullmatch(r"r\d+-(r?\d+)?", token):
+            first, last = token[1:].split("-")
+            last = int(last.lstrip("r")) if last else None
+            positions.extend(i for i, r in enumerate(records) if r[0] >= int(first) and (last is None or r[0] <= last))
+        else:
+            raise Exception(f"can't parse record selection '{token}'")
+
+    selected = [records[i] for i in dict.fromkeys(positions)] # remove repeats, keeping the order
+    if verbose:
+        preview = ", ".join(f"{r[0]}.{r[1]}" for r in selected[:10])
+        print(f"selected {len(selected)} of {n} records: {preview}{', ...' if len(selected) > 10 else ''}")
+    return selected
+
+
+def FragmentFilter(subsystems : str = None, fragmentTypes : str = None, sourceIDs : str = None) -> dict:
+    """ Make a fragment filter for RawDataFile, the fragments are selected using the record index, so the others are never read.
+
+    Args:
+        subsystems (str, optional): comma separated subsystem names (e.g. DetectorReadout) or numbers. Defaults to None (any).
+        fragmentTypes (str, optional): comma separated fragment type names (e.g. WIBEth or kWIBEth) or numbers. Defaults to None (any).
+        sourceIDs (str, optional): comma separated source ids or ranges e.g. 0-3,10. Defaults to None (any).
+
+    Returns:
+        dict: filter
+    """
+    def Codes(string, names):
+        codes = []
+        for token in string.replace(" ", "").split(","):
+            if re.fullmatch(r"\d+", token):
+                codes.append(int(token))
+            elif token.removeprefix("k") in names:
+                codes.append(int(names[token.removeprefix("k")]))
+            elif token:
+                raise Exception(f"unknown value '{token}', choose from {', '.join(names)}")
+        return codes
+
+    fragment_types = {name.removeprefix("k") : value for name, value in daqdataformats.FragmentType.__members__.items()}
+    return {
+        "subsystem" : Codes(subsystems, SUBSYSTEMS) if subsystems else None,
+        "fragment_type" : Codes(fragmentTypes, fragment_types) if fragmentTypes else None,
+        "source_id" : _ParseIntegers(sourceIDs) if sourceIDs else None,
+    }
+
+
+def AddFragmentFilterArguments(parser, fragmentType : str = None):
+    """ Add the options which select fragments to a command line parser.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+        fragmentType (str, optional): default fragment type. Defaults to None (any).
     """
-    records = []
-    if not re.search("[a-zA-Z]", string):
-        strs = string.split(",")
-        for s in strs:
-            r = list(map(int, s.split("-")))
-            if len(r) == 1:
-                records.extend(r)
-            else:
-                records.extend(range(r[0], r[-1]+1))
-    print(records)
-    return records
+    parser.add_argument("--subsystem", dest="subsystem", type=str, default=None, help="only read fragments from these subsystems (comma separated names or numbers e.g. DetectorReadout,Trigger)")
+    parser.add_argument("--fragment-type", dest="fragment_type", type=str, default=fragmentType, help="only read fragments of these types (comma separated names or numbers e.g. WIBEth,TriggerPrimitive)")
+    parser.add_argument("--source-id", dest="source_id", type=str, default=None, help="only read fragments with these source ids (comma separated ids or ranges e.g. 0-3,10)")
@@ -0,0 +1,125 @@
+"""
+Description: Binary output for decoded waveforms. Records are appended to chunked, compressed hdf5 datasets as they are decoded.
+"""
+import h5py
+import numpy as np
+
+
+class WaveformWriter:
+    """ Write waveforms of each record to one hdf5 file per run.
+
+    Datasets:
+        adc (record, time, channel): ADC values, records with fewer samples are padded with 0
+        n_samples (record): number of samples in each record
+        timestamps (record, time): timestamp of each sample
+        channel (record, channel): offline channel numbers
+        plane (record, channel): plane of each channel
+        record (record): record number
+    """
+    def __init__(self, filename : str, run_number : int, compression : str = "gzip", compression_opts : int = 4):
+        """
+        Args:
+            filename (str): output file
+            run_number (int): run number, stored as a file attribute
+            compression (str, optional): hdf5 compression filter. Defaults to "gzip".
+            compression_opts (int, optional): compression level. Defaults to 4.
+        """
+        self.filename = filename
+        self.compression = {"compression" : compression, "compression_opts" : compression_opts, "shuffle" : True} if compression else {}
+        self.file = h5py.File(filename, "w")
+        self.file.attrs["run_number"] = run_number
+        self.n_records = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+    def Close(self):
+        """ Close the file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    def _CreateDatasets(self, adc : np.ndarray, timestamps : np.ndarray, channels : np.ndarray, planes : np.ndarray):
+        n_samples, n_channels = adc.shape
+        self.file.create_dataset("adc", shape = (0, n_samples, n_channels), maxshape = (None, None, n_channels), chunks = (1, n_samples, n_channels), dtype = adc.dtype, **self.compression)
+        self.file.create_dataset("n_samples", shape = (0,), maxshape = (None,), chunks = (1024,), dtype = np.int64)
+        self.file.create_dataset("timestamps", shape = (0, n_samples), maxshape = (None, None), chunks = (1, n_samples), dtype = timestamps.dtype, **self.compression)
+        self.file.create_dataset("channel", shape = (0, n_channels), maxshape = (None, n_channels), chunks = (1, n_channels), dtype = np.int64)
+        self.file.create_dataset("plane", shape = (0, n_channels), maxshape = (None, n_channels), chunks = (1, n_channels), dtype = np.int8)
+        self.file.create_dataset("record", shape = (0,), maxshape = (None,), chunks = (1024,), dtype = np.int64)
+
+
+    def Append(self, record : int, adc : np.ndarray, timestamps : np.ndarray, channels : np.ndarray, planes : np.ndarray):
+        """ Add a record to the file.
+
+        Args:
+            record (int): record number
+            adc (np.ndarray): ADCs, shape (time, channel)
+            timestamps (np.ndarray): timestamp of each sample
+            channels (np.ndarray): offline channel of each column
+            planes (np.ndarray): plane of each column
+        """
+        adc = np.asarray(adc)
+        timestamps = np.asarray(timestamps)
+        if self.n_records == 0:
+            self._CreateDatasets(adc, timestamps, channels, planes)
+
+        n_samples = adc.shape[0]
+        i = self.n_records
+        for name in ["adc", "n_samples", "timestamps", "channel", "plane", "record"]:
+            self.file[name].resize(i + 1, axis = 0)
+        if n_samples > self.file["adc"].shape[1]:
+            self.file["adc"].resize(n_samples, axis = 1)
+            self.file["timestamps"].resize(n_samples, axis = 1)
+
+        self.file["adc"][i, :n_samples] = adc
+        self.file["n_samples"][i] = n_samples
+        self.file["timestamps"][i, :n_samples] = timestamps
+        self.file["channel"][i] = channels
+        self.file["plane"][i] = planes
+        self.file["record"][i] = record
+        self.n_records += 1
+
+
+def LArSoftWaveforms(filename : str) -> np.ndarray:
+    """ Convert a waveform file to the layout used in LArSoft simulation studies,
+        one row per channel: run number, channel, plane, then the ADCs of every record one after the other.
+        Records are read one at a time, so only the output has to fit in memory.
+
+    Args:
+        filename (str): file written by WaveformWriter
+
+    Returns:
+        np.ndarray: waveforms, shape (channel, 3 + records * time)
+    """
+    with h5py.File(filename, "r") as f:
+        run_number = f.attrs["run_number"]
+        adc = f["adc"] # (record, time, channel), read a record at a time
+        n_samples = f["n_samples"][:]
+        channels = f["channel"][:]
+        planes = f["plane"][:]
+
+        #* put the columns of each record in channel order, so every record lines up
+        order = np.argsort(channels, axis = 1)
+        channels = np.take_along_axis(channels, order, axis = 1)
+        if np.any(channels != channels[0]):
+            raise Exception("records don't contain the same channels, can't build continuous waveforms")
+        planes = np.take_along_axis(planes, order, axis = 1)[0]
+
+        waveforms = np.empty((len(planes), 3 + n_samples.sum()), dtype = np.result_type(np.asarray(run_number), channels, adc.dtype))
+        waveforms[:, 0] = run_number
+        waveforms[:, 1] = channels[0]
+        waveforms[:, 2] = planes
+        start = 3
+        for i, n in enumerate(n_samples):
+            waveforms[:, start:start + n] = adc[i, :n][:, order[i]].T # shorter records are padded in the file, only take their samples
+            start += n
+    return waveforms
@@ -0,0 +1,286 @@
+"""
+Description: Pure python stand-ins for the DUNE-DAQ python bindings (hdf5libs, daqdataformats, trgdataformats, fddetdataformats,
+detchannelmaps, rawdatautils), just enough of them to run the readers on synthetic files outside the DAQ environment.
+The accessors follow the bit layouts of the real formats, so the bulk decoders are checked against an independent implementation.
+WIBEthFrame is simplified: a 32 byte header (det, crate, slot, stream ids and timestamp) followed by 64 samples x 64 channels of 14 bit ADCs.
+"""
+import sys
+import types
+import struct
+import enum
+import h5py
+import numpy as np
+
+TICKS_PER_SAMPLE = 32 # 62.5 MHz clock, 2 MHz sampling
+
+
+class FragmentType(enum.IntEnum):
+    kUnknown = 0
+    kProtoWIB = 1
+    kWIB = 2
+    kDAPHNE = 3
+    kTDE_AMC = 4
+    kFW_TriggerPrimitive = 5
+    kTriggerPrimitive = 6
+    kTriggerActivity = 7
+    kTriggerCandidate = 8
+    kHardwareSignal = 9
+    kPACMAN = 10
+    kMPD = 11
+    kWIBEth = 12
+
+
+class _Pointer:
+    """ Stands in for the void* returned by Fragment.get_data.
+    """
+    def __init__(self, buffer : bytes, offset : int):
+        self.buffer = buffer
+        self.offset = offset
+
+
+class SourceID:
+    def __init__(self, subsystem : int, id : int):
+        self.subsystem = subsystem
+        self.id = id
+
+
+class FragmentHeader:
+    #* marker, version, size, trigger number, trigger timestamp, window begin, window end, run number, error bits, fragment type,
+    # sequence number, detector id, source id version, subsystem, element id
+    _format = "<IIQQQQQIIIHHHHI"
+
+    def __init__(self, buffer : bytes):
+        values = struct.unpack_from(self._format, buffer)
+        (self.fragment_header_marker, self.version, self.size, self.trigger_number, self.trigger_timestamp, self.window_begin, self.window_end,
+         self.run_number, self.error_bits, self.fragment_type, self.sequence_number, self.detector_id, _, subsystem, element) = values
+        self.element_id = SourceID(subsystem, element)
+
+    @classmethod
+    def sizeof(cls) -> int:
+        return struct.calcsize(cls._format)
+
+
+class Fragment:
+    def __init__(self, buffer : bytes):
+        self._buffer = buffer
+        self._header = FragmentHeader(buffer)
+
+    def get_header(self): return self._header
+    def get_size(self): return self._header.size
+    def get_data_size(self): return self._header.size - FragmentHeader.sizeof()
+    def get_run_number(self): return self._header.run_number
+    def get_trigger_number(self): return self._header.trigger_number
+    def get_trigger_timestamp(self): return self._header.trigger_timestamp
+    def get_window_begin(self): return self._header.window_begin
+    def get_window_end(self): return self._header.window_end
+    def get_fragment_type(self): return FragmentType(self._header.fragment_type)
+    def get_fragment_type_code(self): return self._header.fragment_type
+    def get_element_id(self): return self._header.element_id
+    def get_data(self, offset : int = 0): return _Pointer(self._buffer, FragmentHeader.sizeof() + offset)
+    def get_data_bytes(self, offset : int = 0): return self._buffer[FragmentHeader.sizeof() + offset : self._header.size]
+
+
+class HDF5RawDataFile:
+    """ Records are the groups at the top of the file, fragments are the datasets in their RawData group.
+    """
+    def __init__(self, filename : str):
+        self._file = h5py.File(filename, "r")
+
+    def get_all_record_ids(self) -> list:
+        ids = []
+        for name in self._file:
+            number, sequence = name.replace("TriggerRecord", "").replace("TimeSlice", "").split(".")
+            ids.append((int(number), int(sequence)))
+        return sorted(ids)
+
+    def _group(self, rid) -> str:
+        for prefix in ["TriggerRecord", "TimeSlice"]:
+            name = f"{prefix}{rid[0]:05d}.{rid[1]:04d}"
+            if name in self._file:
+                return name
+        raise KeyError(rid)
+
+    def get_fragment_dataset_paths(self, rid) -> list:
+        group = self._group(rid)
+        return [f"/{group}/RawData/{d}" for d in self._file[group]["RawData"]]
+
+    def get_frag(self, path : str) -> Fragment:
+        return Fragment(self._file[path][()].tobytes())
+
+
+class TriggerPrimitive:
+    """ Version 2 layout: three 64 bit words of bit fields.
+    """
+    s_trigger_primitive_version = 2
+
+    def __init__(self, pointer : _Pointer):
+        word0, self.time_start, word2 = struct.unpack_from("<QQQ", pointer.buffer, pointer.offset)
+        self.version = word0 & 0xFF
+        self.flag = (word0 >> 8) & 0xFF
+        self.detid = (word0 >> 16) & 0xFF
+        self.channel = (word0 >> 24) & 0xFFFFFF
+        self.samples_over_threshold = (word0 >> 48) & 0xFFFF
+        self.samples_to_peak = word2 & 0xFFFF
+        self.adc_integral = (word2 >> 16) & 0xFFFFFFFF
+        self.adc_peak = (word2 >> 48) & 0xFFFF
+
+    @staticmethod
+    def sizeof() -> int:
+        return 24
+
+
+def _BitFields(word : int, fields : list) -> dict:
+    values = {}
+    for name, bits in fields:
+        values[name] = word & ((1 << bits) - 1)
+        word >>= bits
+    return values
+
+
+class WIBFrame:
+    """ ProtoDUNE-SP WIB frame: 4 word header, 4 COLDATA blocks of a 4 word header and 8 segments of 3 words.
+    """
+    _segment_fields = [
+        [("adc0ch0_1", 8), ("adc1ch0_1", 8), ("adc0ch0_2", 4), ("adc0ch1_1", 4), ("adc1ch0_2", 4), ("adc1ch1_1", 4)],
+        [("adc0ch1_2", 8), ("adc1ch1_2", 8), ("adc0ch2_1", 8), ("adc1ch2_1", 8)],
+        [("adc0ch2_2", 4), ("adc0ch3_1", 4), ("adc1ch2_2", 4), ("adc1ch3_1", 4), ("adc0ch3_2", 8), ("adc1ch3_2", 8)],
+    ]
+
+    def __init__(self, pointer : _Pointer):
+        self._words = struct.unpack_from("<116I", pointer.buffer, pointer.offset)
+
+    @staticmethod
+    def sizeof() -> int:
+        return 464
+
+    def get_header(self):
+        header = _BitFields(self._words[0], [("sof", 8), ("version", 5), ("fiber_no", 3), ("crate_no", 5), ("slot_no", 3)])
+        return types.SimpleNamespace(**header)
+
+    def get_timestamp(self) -> int:
+        word3 = _BitFields(self._words[3], [("timestamp_2", 16), ("wib_counter_1", 15), ("z", 1)])
+        timestamp = self._words[2] | (word3["timestamp_2"] << 32)
+        if not word3["z"]:
+            timestamp |= word3["wib_counter_1"] << 48
+        return timestamp
+
+    def get_channel(self, ch : int) -> int:
+        block, adc, c = ch // 64, (ch % 64) // 8, ch % 8
+        first = 4 + block * 28 + 4 + ((adc // 2) * 2 + c // 4) * 3
+        fields = {}
+        for word, spec in zip(self._words[first:first + 3], self._segment_fields):
+            fields.update(_BitFields(word, spec))
+        name = f"adc{adc % 2}ch{c % 4}"
+        low_bits = 8 if c % 4 in [0, 2] else 4
+        return fields[f"{name}_1"] | (fields[f"{name}_2"] << low_bits)
+
+
+class WIB2Frame:
+    """ WIB2 frame: 4 word header, 112 words of 14 bit ADCs packed back to back, 2 word trailer.
+    """
+    def __init__(self, pointer : _Pointer):
+        self._words = struct.unpack_from("<118I", pointer.buffer, pointer.offset)
+
+    @staticmethod
+    def sizeof() -> int:
+        return 472
+
+    def get_header(self):
+        header = _BitFields(self._words[0], [("start_frame", 8), ("crate", 8), ("frame_version", 4), ("slot", 3), ("link", 3)])
+        return types.SimpleNamespace(**header)
+
+    def get_timestamp(self) -> int:
+        return self._words[2] | (self._words[3] << 32)
+
+    def get_adc(self, i : int) -> int:
+        adc_words = self._words[4:116]
+        word_index = 14 * i // 32
+        first_bit_position = (14 * i) % 32
+        bits_from_first_word = min(14, 32 - first_bit_position)
+        adc = adc_words[word_index] >> first_bit_position
+        if bits_from_first_word < 14:
+            adc |= adc_words[word_index + 1] << bits_from_first_word
+        return adc & 0x3FFF
+
+
+class WIBEthFrame:
+    _header_format = "<HHHHQ16x" # det, crate, slot, stream, timestamp
+
+    def __init__(self, pointer : _Pointer):
+        det, crate, slot, stream, self._timestamp = struct.unpack_from(self._header_format, pointer.buffer, pointer.offset)
+        self._header = types.SimpleNamespace(det_id = det, crate_id = crate, slot_id = slot, stream_id = stream, crate_no = crate, slot_no = slot, fiber_no = stream)
+
+    @staticmethod
+    def sizeof() -> int:
+        return 7200
+
+    def get_daqheader(self):
+        return self._header
+
+    def get_timestamp(self) -> int:
+        return self._timestamp
+
+
+def _WIBEthFrames(fragment : Fragment) -> np.ndarray:
+    payload = np.frombuffer(fragment.get_data_bytes(), dtype=np.uint8)
+    n_frames = len(payload) // WIBEthFrame.sizeof()
+    return payload[:n_frames * WIBEthFrame.sizeof()].reshape(n_frames, WIBEthFrame.sizeof())
+
+
+def np_array_adc(fragment : Fragment) -> np.ndarray:
+    """ ADCs of a WIBEth fragment, shape (time, 64 channels).
+    """
+    frames = _WIBEthFrames(fragment)
+    bits = np.unpackbits(frames[:, 32:], axis=1, bitorder="little").reshape(len(frames), 64 * 64, 14)
+    adc = (bits.astype(np.uint16) << np.arange(14, dtype=np.uint16)).sum(axis=2, dtype=np.uint16)
+    return adc.reshape(len(frames) * 64, 64)
+
+
+def np_array_timestamp(fragment : Fragment) -> np.ndarray:
+    """ Timestamp of each time sample in a WIBEth fragment.
+    """
+    frames = _WIBEthFrames(fragment)
+    start = np.ascontiguousarray(frames[:, 8:16]).view("<u8")[:, 0]
+    return (start[:, np.newaxis] + TICKS_PER_SAMPLE * np.arange(64, dtype=np.uint64)).ravel()
+
+
+class TPCChannelMap:
+    """ ProtoDUNE-HD like map: 2560 channels per APA, 800 u, 800 v and 960 z channels.
+    """
+    def __init__(self, n_apa : int = 4):
+        self.n_channels = 2560 * n_apa
+
+    def _check(self, channel : int):
+        if channel < 0 or channel >= self.n_channels:
+            raise RuntimeError(f"unknown offline channel {channel}")
+
+    def get_plane_from_offline_channel(self, channel : int) -> int:
+        self._check(channel)
+        return min((channel % 2560) // 800, 2)
+
+    def get_element_name_from_offline_channel(self, channel : int) -> str:
+        self._check(channel)
+        return f"APA{channel // 2560}"
+
+    def get_offline_channel_from_det_crate_slot_stream_chan(self, det : int, crate : int, slot : int, stream : int, chan : int) -> int:
+        return ((crate * 5 + slot) * 4 + stream % 4) * 64 % self.n_channels + chan
+
+    def get_offline_channel_from_crate_slot_fiber_chan(self, crate : int, slot : int, fiber : int, chan : int) -> int:
+        return ((crate * 5 + slot) * 2 + fiber) * 256 % self.n_channels + chan
+
+
+def Install():
+    """ Register the stand-ins in sys.modules, so `import hdf5libs` etc. pick them up.
+    """
+    modules = {
+        "hdf5libs" : {"HDF5RawDataFile" : HDF5RawDataFile},
+        "daqdataformats" : {"FragmentType" : FragmentType, "Fragment" : Fragment, "FragmentHeader" : FragmentHeader},
+        "trgdataformats" : {"TriggerPrimitive" : TriggerPrimitive},
+        "fddetdataformats" : {"WIBFrame" : WIBFrame, "WIB2Frame" : WIB2Frame, "WIBEthFrame" : WIBEthFrame},
+        "detchannelmaps" : {"make_tpc_map" : lambda name : TPCChannelMap()},
+        "rawdatautils.unpack.wibeth" : {"np_array_adc" : np_array_adc, "np_array_timestamp" : np_array_timestamp},
+    }
+    for name, attributes in modules.items():
+        sys.modules[name] = types.SimpleNamespace(__name__ = name, **attributes)
+    sys.modules["rawdatautils.unpack"] = types.SimpleNamespace(wibeth = sys.modules["rawdatautils.unpack.wibeth"])
+    sys.modules["rawdatautils"] = types.SimpleNamespace(unpack = sys.modules["rawdatautils.unpack"])
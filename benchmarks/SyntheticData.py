@@ -0,0 +1,162 @@
+"""
+Description: Write synthetic DAQ hdf5 files (TP stream, WIB, WIB2 and WIBEth) laid out like the real ones:
+one group per record, containing a RawData group with one dataset per fragment (fragment header followed by the payload).
+"""
+import StandIns
+
+import h5py
+import numpy as np
+
+HEADER_DTYPE = np.dtype([
+    ("fragment_header_marker", "<u4"), ("version", "<u4"), ("size", "<u8"), ("trigger_number", "<u8"), ("trigger_timestamp", "<u8"),
+    ("window_begin", "<u8"), ("window_end", "<u8"), ("run_number", "<u4"), ("error_bits", "<u4"), ("fragment_type", "<u4"),
+    ("sequence_number", "<u2"), ("detector_id", "<u2"), ("source_id_version", "<u2"), ("subsystem", "<u2"), ("element_id", "<u4"),
+])
+START_TIME = 110_000_000_000_000_000 # roughly what DUNE timestamps look like at the moment
+RUN_NUMBER = 12345
+LAYOUTS = { # h5py storage options of the fragment datasets
+    "contiguous" : {},
+    "chunked" : {"chunks" : True},
+    "gzip" : {"chunks" : True, "compression" : "gzip", "compression_opts" : 4},
+}
+
+
+def FragmentBytes(payload : np.ndarray, fragment_type : int, record : int, element_id : int, window : tuple, subsystem : int = 1) -> np.ndarray:
+    """ Put a fragment header in front of a payload.
+
+    Args:
+        payload (np.ndarray): payload bytes
+        fragment_type (int): fragment type code
+        record (int): record number
+        element_id (int): source id
+        window (tuple): window begin and end
+
+    Returns:
+        np.ndarray: fragment bytes, as signed chars like the DAQ writes them
+    """
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["fragment_header_marker"] = 0x11112222
+    header["version"] = 5
+    header["size"] = HEADER_DTYPE.itemsize + len(payload)
+    header["trigger_number"] = record
+    header["trigger_timestamp"] = window[0]
+    header["window_begin"], header["window_end"] = window
+    header["run_number"] = RUN_NUMBER
+    header["fragment_type"] = fragment_type
+    header["source_id_version"] = 2
+    header["subsystem"] = subsystem
+    header["element_id"] = element_id
+    return np.concatenate([header.view(np.uint8), payload.view(np.uint8)]).view(np.int8)
+
+
+def Pack14(adc : np.ndarray) -> np.ndarray:
+    """ Pack 14 bit values back to back, least significant bit first.
+
+    Args:
+        adc (np.ndarray): values, packed along the last axis
+
+    Returns:
+        np.ndarray: packed bytes
+    """
+    bits = (adc[..., np.newaxis] >> np.arange(14, dtype=adc.dtype)) & 1
+    bits = bits.reshape(*adc.shape[:-1], adc.shape[-1] * 14).astype(np.uint8)
+    return np.packbits(bits, axis=-1, bitorder="little")
+
+
+def Waveforms(rng : np.random.Generator, shape : tuple, pedestal : int = 900, noise : float = 4) -> np.ndarray:
+    """ Pedestal plus gaussian noise, with the occasional pulse.
+    """
+    adc = rng.normal(pedestal, noise, shape)
+    n_pulses = max(1, shape[0] * shape[1] // 5000)
+    t = rng.integers(0, shape[0] - 20, n_pulses)
+    c = rng.integers(0, shape[1], n_pulses)
+    for i in range(20):
+        adc[t + i, c] += 200 * np.exp(-0.5 * ((i - 6) / 2.5)**2)
+    return np.clip(adc, 0, 2**14 - 1).astype(np.uint16)
+
+
+def TPPayload(rng : np.random.Generator, n_tps : int, window : tuple, channels : int) -> np.ndarray:
+    """ Version 2 TPs, sorted by time_start.
+    """
+    time_start = np.sort(rng.integers(window[0], window[1], n_tps, dtype=np.uint64))
+    word0 = (np.uint64(2)
+        | (np.uint64(3) << np.uint64(16))
+        | (rng.integers(0, channels, n_tps).astype(np.uint64) << np.uint64(24))
+        | (rng.integers(1, 40, n_tps).astype(np.uint64) << np.uint64(48)))
+    word2 = (rng.integers(0, 20, n_tps).astype(np.uint64)
+        | (rng.integers(100, 20000, n_tps).astype(np.uint64) << np.uint64(16))
+        | (rng.integers(20, 1000, n_tps).astype(np.uint64) << np.uint64(48)))
+    return np.stack([word0, time_start, word2], axis=1).ravel().view(np.uint8)
+
+
+def WIBPayload(rng : np.random.Generator, frontend : str, n_frames : int, start : int, crate : int, slot : int, fiber : int) -> np.ndarray:
+    """ Pre ethernet WIB frames, one frame per 32 ticks.
+    """
+    timestamps = start + StandIns.TICKS_PER_SAMPLE * np.arange(n_frames, dtype=np.uint64)
+    if frontend == "wib":
+        frames = np.zeros((n_frames, 118), dtype="<u4")
+        frames[:, 0] = 0x3C | (crate << 8) | (slot << 20) | (fiber << 23)
+        frames[:, 2] = timestamps & np.uint64(0xFFFFFFFF)
+        frames[:, 3] = timestamps >> np.uint64(32)
+        adc = Pack14(Waveforms(rng, (n_frames, 256)))
+        frames.view(np.uint8).reshape(n_frames, 472)[:, 16:464] = adc
+    else:
+        frames = rng.integers(0, 2**32, (n_frames, 116), dtype=np.uint64).astype("<u4") # any bit pattern is a valid set of 12 bit samples
+        frames[:, 0] = 0xBC | (fiber << 13) | (crate << 16) | (slot << 21)
+        frames[:, 1] = 0
+        frames[:, 2] = timestamps & np.uint64(0xFFFFFFFF)
+        frames[:, 3] = ((timestamps >> np.uint64(32)) & np.uint64(0xFFFF)) | np.uint64(1 << 31) # z = 1, no wib counter
+    return frames.view(np.uint8).ravel()
+
+
+def WIBEthPayload(rng : np.random.Generator, n_frames : int, start : int, crate : int, slot : int, stream : int) -> np.ndarray:
+    """ WIBEth frames in the stand-in layout, 64 time samples per frame.
+    """
+    frames = np.zeros((n_frames, 7200), dtype=np.uint8)
+    header = np.zeros(n_frames, dtype=[("det", "<u2"), ("crate", "<u2"), ("slot", "<u2"), ("stream", "<u2"), ("timestamp", "<u8"), ("pad", "V16")])
+    header["det"], header["crate"], header["slot"], header["stream"] = 3, crate, slot, stream
+    header["timestamp"] = start + 64 * StandIns.TICKS_PER_SAMPLE * np.arange(n_frames, dtype=np.uint64)
+    frames[:, :32] = header.view(np.uint8).reshape(n_frames, 32)
+    frames[:, 32:] = Pack14(Waveforms(rng, (n_frames * 64, 64)).reshape(n_frames, 64 * 64))
+    return frames.ravel()
+
+
+def WriteFile(filename : str, kind : str, n_records : int, n_sources : int, size : int, seed : int = 0, layout : str = "contiguous"):
+    """ Write a synthetic file.
+
+    Args:
+        filename (str): output file
+        kind (str): tpstream, proto_wib, wib or wibeth
+        n_records (int): number of records
+        n_sources (int): fragments per record
+        size (int): TPs per fragment (tpstream) or frames per fragment
+        seed (int, optional): random seed. Defaults to 0.
+        layout (str, optional): how the fragment datasets are stored, contiguous, chunked or gzip (chunked and compressed),
+            the readers memory map contiguous datasets and read the others through HDF5. Defaults to "contiguous".
+    """
+    rng = np.random.default_rng(seed)
+    channels = StandIns.TPCChannelMap().n_channels
+    record_length = size * StandIns.TICKS_PER_SAMPLE * (64 if kind == "wibeth" else 1)
+    if kind == "tpstream":
+        record_length = 2**20
+    prefix = "TimeSlice" if kind == "tpstream" else "TriggerRecord"
+    storage = LAYOUTS[layout]
+
+    with h5py.File(filename, "w") as f:
+        f.attrs["run_number"] = RUN_NUMBER
+        f.attrs["record_type"] = prefix
+        for r in range(n_records):
+            start = START_TIME + r * record_length
+            window = (start, start + record_length)
+            group = f.create_group(f"{prefix}{r:05d}.0000/RawData")
+            for s in range(n_sources):
+                crate, slot, link = s // 10, (s // 2) % 5, s % 2
+                if kind == "tpstream":
+                    payload, fragment_type, name = TPPayload(rng, size, window, channels), StandIns.FragmentType.kTriggerPrimitive, f"Trigger_Primitive_{s:08x}"
+                elif kind == "wibeth":
+                    payload, fragment_type, name = WIBEthPayload(rng, size, start, crate, slot, link), StandIns.FragmentType.kWIBEth, f"Detector_Readout_{s:08x}_WIBEth"
+                else:
+                    payload = WIBPayload(rng, kind, size, start, crate, slot, link)
+                    fragment_type = StandIns.FragmentType.kWIB if kind == "wib" else StandIns.FragmentType.kProtoWIB
+                    name = f"Detector_Readout_{s:08x}_WIB"
+                group.create_dataset(name, data=FragmentBytes(payload, int(fragment_type), r, s, window), **storage)
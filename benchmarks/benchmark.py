@@ -0,0 +1,252 @@
+"""
+Description: Benchmark the readers on synthetic files. The DUNE-DAQ bindings are replaced by the stand-ins in StandIns.py,
+so this runs anywhere numpy, h5py and pandas are installed. Each stage runs in its own process so peak memory can be measured,
+and the results are written to a json file which can be compared against an earlier run with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository modules
+
+import StandIns
+StandIns.Install()
+
+import SyntheticData
+#* imported here rather than in the stages, so the import time (pandas etc.) isn't counted in the stage timings
+import Utilities
+import Decoders
+import Writers
+import TPFinder
+import RecordIndex
+import ChannelMaps
+
+import fddetdataformats
+import rawdatautils
+
+import numpy as np
+
+
+def TPDecode(filename : str, outdir : str, args) -> dict:
+    """ What readTPStream/check_tp_input_source do per fragment: get the payload, decode the TPs and look up the planes.
+    """
+    counts = {"tps" : 0, "bytes" : 0}
+    with Utilities.RawDataFile(filename, f"0-{args.records - 1}", args.channel_map, verbose = False) as reader:
+        for rid in reader.toStudy:
+            for _, _, payload in reader.Payloads(rid):
+                tps = Decoders.DecodeTPPayload(payload)
+                reader.cmap.Planes(tps["channel"])
+                counts["tps"] += len(tps["channel"])
+                counts["bytes"] += len(payload)
+    return counts
+
+
+def TPDecodePerObject(filename : str, outdir : str, args) -> dict:
+    """ The old way of decoding TPs, one TriggerPrimitive at a time, as a baseline.
+    """
+    counts = {"tps" : 0, "bytes" : 0}
+    with Utilities.RawDataFile(filename, f"0-{args.records - 1}", args.channel_map, verbose = False) as reader:
+        for rid in reader.toStudy:
+            for _, fragment in reader.Fragments(rid):
+                tps = Decoders.DecodeTPsPerObject(fragment)
+                reader.cmap.Planes(tps["channel"])
+                counts["tps"] += len(tps["channel"])
+                counts["bytes"] += fragment.get_data_size()
+    return counts
+
+
+def WIBDecode(filename : str, outdir : str, args, frontend : str) -> dict:
+    """ What readTR does: decode the WIB frames of each fragment and map the channels.
+    """
+    counts = {"frames" : 0, "bytes" : 0}
+    with Utilities.RawDataFile(filename, f"0-{args.records - 1}", args.channel_map, verbose = False) as reader:
+        for rid in reader.toStudy:
+            for _, fragment in reader.Fragments(rid):
+                adc, _ = Decoders.DecodeWIBFrames(fragment, frontend)
+                counts["frames"] += len(adc)
+                counts["bytes"] += fragment.get_data_size()
+    return counts
+
+
+def WIBEthWrite(filename : str, outdir : str, args) -> dict:
+    """ What writeRawData does, without the event displays: unpack the WIBEth ADCs and write them to the waveform file.
+    """
+    counts = {"frames" : 0, "bytes" : 0}
+    with Utilities.RawDataFile(filename, f"0-{args.records - 1}", args.channel_map, verbose = False) as reader:
+        with Writers.WaveformWriter(f"{outdir}/waveforms.hdf5", reader.attributes["run_number"]) as writer:
+            for rid in reader.toStudy:
+                for _, fragment in reader.Fragments(rid):
+                    header = fddetdataformats.WIBEthFrame(fragment.get_data()).get_daqheader()
+                    channels = reader.cmap.OfflineChannels(header.det_id, header.crate_id, header.slot_id, header.stream_id, 64)
+                    adc = rawdatautils.unpack.wibeth.np_array_adc(fragment)
+                    timestamps = rawdatautils.unpack.wibeth.np_array_timestamp(fragment)
+                    writer.Append(rid[0], adc, timestamps, channels, reader.cmap.Planes(channels))
+                    counts["frames"] += len(adc) // 64
+                    counts["bytes"] += fragment.get_data_size()
+    return counts
+
+
+def TPFinding(filename : str, outdir : str, args) -> dict:
+    """ writeRawData --find-tps: unpack the WIBEth ADCs and find TPs in them.
+    """
+    counts = {"frames" : 0, "tps" : 0, "bytes" : 0}
+    with Utilities.RawDataFile(filename, f"0-{args.records - 1}", args.channel_map, verbose = False) as reader:
+        for rid in reader.toStudy:
+            for _, fragment in reader.Fragments(rid):
+                header = fddetdataformats.WIBEthFrame(fragment.get_data()).get_daqheader()
+                channels = reader.cmap.OfflineChannels(header.det_id, header.crate_id, header.slot_id, header.stream_id, 64)
+                adc = rawdatautils.unpack.wibeth.np_array_adc(fragment)
+                timestamps = rawdatautils.unpack.wibeth.np_array_timestamp(fragment)
+                tps = TPFinder.FindTPs(adc, timestamps, channels, reader.cmap.Planes(channels), 60)
+                counts["frames"] += len(adc) // 64
+                counts["tps"] += len(tps["channel"])
+                counts["bytes"] += fragment.get_data_size()
+    return counts
+
+
+def IndexBuild(filename : str, outdir : str, args) -> dict:
+    """ Scan the fragment headers and write the sidecar index.
+    """
+    os.remove(RecordIndex.SidecarPath(filename))
+    index = RecordIndex.RecordIndex(filename)
+    return {"fragments" : len(index.fragments), "bytes" : os.path.getsize(filename)}
+
+
+#* stage name : file kind, function, extra arguments
+STAGES = {
+    "index_build" : ("tpstream", IndexBuild, ()),
+    "tp_decode" : ("tpstream", TPDecode, ()),
+    "tp_decode_per_object" : ("tpstream", TPDecodePerObject, ()),
+    "proto_wib_decode" : ("proto_wib", WIBDecode, ("proto_wib",)),
+    "wib2_decode" : ("wib", WIBDecode, ("wib",)),
+    "wibeth_write" : ("wibeth", WIBEthWrite, ()),
+    "tp_finder" : ("wibeth", TPFinding, ()),
+}
+
+
+def RunStage(name : str, filename : str, outdir : str, args) -> dict:
+    """ Run a stage and measure it, called in a fresh process.
+
+    Returns:
+        dict: counts, wall time, rates and peak resident memory
+    """
+    _, function, extra = STAGES[name]
+    start = time.perf_counter()
+    counts = function(filename, outdir, args, *extra)
+    wall = time.perf_counter() - start
+    result = {"wall_time_s" : wall, **counts}
+    for key, rate in [("tps", "tps_per_s"), ("frames", "frames_per_s"), ("fragments", "fragments_per_s")]:
+        if key in counts:
+            result[rate] = counts[key] / wall
+    result["mb_per_s"] = counts["bytes"] / 1E6 / wall
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on linux
+    return result
+
+
+def _StageWorker(queue, name, filename, outdir, args):
+    try:
+        queue.put(RunStage(name, filename, outdir, args))
+    except Exception as e:
+        queue.put({"error" : repr(e)})
+
+
+def GitCommit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def Compare(results : dict, reference : str):
+    """ Print how the rates changed with respect to an earlier run.
+
+    Args:
+        results (dict): results of this run
+        reference (str): json file from an earlier run
+    """
+    with open(reference) as f:
+        old = json.load(f)
+    print(f"compared to {reference} (commit {old.get('commit', '?')}):")
+    for name, stage in results["stages"].items():
+        if name not in old["stages"] or "error" in stage or "error" in old["stages"][name]:
+            continue
+        ratios = [f"{key} x{stage[key] / old['stages'][name][key]:.2f}" for key in ["wall_time_s", "mb_per_s", "peak_rss_mb"] if old["stages"][name].get(key)]
+        print(f"  {name:<22} " + ", ".join(ratios))
+
+
+def main(args):
+    os.environ["RAWDATAANALYSIS_CACHE"] = os.path.join(args.workdir, "cache") # keep the channel map cache out of the users cache
+    os.makedirs(args.workdir, exist_ok = True)
+    stages = args.stages if args.stages else [s for s in STAGES if s != "tp_decode_per_object"]
+
+    sizes = {"tpstream" : args.tps, "proto_wib" : args.frames, "wib" : args.frames, "wibeth" : max(1, args.frames // 64)}
+    files = {}
+    for name in stages:
+        kind = STAGES[name][0]
+        if kind not in files:
+            files[kind] = f"{args.workdir}/{kind}.hdf5"
+            print(f"writing {files[kind]}")
+            SyntheticData.WriteFile(files[kind], kind, args.records, args.sources, sizes[kind], layout = args.layout)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {
+        "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit" : GitCommit(),
+        "python" : platform.python_version(),
+        "numpy" : np.__version__,
+        "machine" : platform.machine(),
+        "config" : {"records" : args.records, "sources" : args.sources, "layout" : args.layout, **{f"{k}_size" : v for k, v in sizes.items()}},
+        "stages" : {},
+    }
+    #* build the channel map tables and the sidecar indices up front, so the stages only time what they are named after
+    ChannelMaps.ChannelMap(args.channel_map)
+    for f in files.values():
+        RecordIndex.RecordIndex(f)
+
+    for name in stages:
+        queue = ctx.Queue()
+        p = ctx.Process(target = _StageWorker, args = (queue, name, files[STAGES[name][0]], args.workdir, args))
+        p.start()
+        result = queue.get()
+        p.join()
+        results["stages"][name] = result
+        print(f"{name:<22} " + ", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent = 2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        Compare(results, args.compare)
+    if not args.keep:
+        shutil.rmtree(args.workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the readers on synthetic data", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-r", "--records", dest="records", type=int, default=10, help="records per file")
+    parser.add_argument("-s", "--sources", dest="sources", type=int, default=10, help="fragments per record")
+    parser.add_argument("--tps", dest="tps", type=int, default=20000, help="TPs per fragment")
+    parser.add_argument("--frames", dest="frames", type=int, default=2000, help="WIB frames per fragment (WIBEth fragments get 1/64 of this, each frame holds 64 samples)")
+    parser.add_argument("--layout", dest="layout", type=str, default="contiguous", choices=list(SyntheticData.LAYOUTS), help="storage of the fragment datasets, chunked and gzip are read through HDF5 rather than memory mapped")
+    parser.add_argument("--stages", dest="stages", type=str, nargs="+", default=None, choices=list(STAGES), help="stages to run, defaults to all but tp_decode_per_object")
+    parser.add_argument("-m", "--channel-map", dest="channel_map", type=str, default="PD2HDChannelMap", help="channel map name passed to the stand-in")
+    parser.add_argument("-w", "--work-directory", dest="workdir", type=str, default=None, help="where the synthetic files are written, defaults to a temporary directory")
+    parser.add_argument("-k", "--keep", dest="keep", action="store_true", help="keep the synthetic files")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="results file, defaults to benchmarks/results/<date>-<commit>.json")
+    parser.add_argument("-c", "--compare", dest="compare", type=str, default=None, help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if args.workdir is None:
+        args.workdir = tempfile.mkdtemp(prefix="rda-benchmark-")
+    if args.output is None:
+        args.output = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{GitCommit() or 'unknown'}.json")
+    main(args)
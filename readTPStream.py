@@ -6,168 +6,42 @@ Author: Shyam Bhuller
 Description: Plots data from TP stream files from VD coldbox runs
 """
 import Utilities
+import Metrics
+import TPIndex
+import Prefetch
+import TPPipeline
+import DecodeCache
 
-import trgdataformats
-from hdf5libs import HDF5RawDataFile
-import daqdataformats
-import detchannelmaps
-
-import os
 import argparse
-import h5py
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import pandas as pd
-import numpy as np
-from rich import print
-
-def LogTPData(debug, tp):
-    """ Log some tp data
-
-    Args:
-        debug (bool): should we log
-        trigger primitive (daqdataformats.fragment): trigger primitive
-    """
-    if debug:
-        print(f"version: {tp.version}")
-        print(f"time_start: {tp.time_start}")
-        print(f"time_peak: {tp.time_peak}")
-        print(f"time_over_threshold: {tp.time_over_threshold}")
-        print(f"channel: {tp.channel}")
-        print(f"adc_integral: {tp.adc_integral}")
-        print(f"adc_peak: {tp.adc_peak}")
-        print(f"det_id: {tp.detid}")
-        print(f"type: {tp.type}")
-        print(f"algorithm: {tp.algorithm}")
-        print(f"flag: {tp.flag}")
-        print(f"size: {tp.sizeof()}")
-
-
-def TPDataFrame() -> dict:
-    """ Headers for DataFrame
-
-    Returns:
-        dictionary: headers
-    """
-    return {
-        "time_start" : [],
-        "time_peak" : [],
-        "time_over_threshold" : [],
-        "channel" : [],
-        "adc_integral" : [],
-        "adc_peak" : [],
-        "det_id" : [],
-        "plane" : [],
-    }
-
 
 def main(args):
-    h5_file, cmap, toStudy = Utilities.OpenFile(args.file, args.records, args.channelMap)
-
-    TPData = []
-    for rid in toStudy:
-        timeSlice = TPDataFrame() # create a blank data frame
-
-        print(h5_file.get_fragment_dataset_paths(rid))
-        fragments = {}
-        for fp in h5_file.get_fragment_dataset_paths(rid):
-            fragment = h5_file.get_frag(fp)
-            header = fragment.get_header()
-            print(header.element_id.id)
-            Utilities.LogFragmentData(args.debug, fp, fragment)
-
-            #* get number of TPs in fragment
-            tp_size = trgdataformats.TriggerPrimitive.sizeof() # get size of TP packet in bytes
-            n_frames = (fragment.get_size()-fragment.get_header().sizeof())//tp_size # number of TP packets is the  fragment data size / tp size
-            print(f"number of TPs in fragment: {n_frames}")
-
-            #* iterate through each TP in the fragment and retrieve various information
-            # TODO make code more efficient by plotting/binning data as TPs or fragments are parsed
-            for i in range(n_frames):
-                tp = trgdataformats.TriggerPrimitive(fragment.get_data(i*tp_size)) # get TP data from pointer in fragment
-                LogTPData(args.debug, tp)
-                timeSlice["time_start"].append(tp.time_start)
-                timeSlice["time_peak"].append(tp.samples_to_peak)
-                timeSlice["time_over_threshold"].append(tp.samples_over_threshold)
-                timeSlice["channel"].append(tp.channel)
-                try:
-                    timeSlice["plane"].append(cmap.get_plane_from_offline_channel(tp.channel))
-                except:
-                    print(f"couldn't identify plane from offline channel {tp.channel}")
-                    timeSlice["plane"].append(-1)
-                timeSlice["adc_integral"].append(tp.adc_integral)
-                timeSlice["adc_peak"].append(tp.adc_peak)
-                timeSlice["det_id"].append(tp.detid)
-            TPData.append(pd.DataFrame(timeSlice))
-            fragments[header.element_id.id] = pd.DataFrame(timeSlice)
-
-    for k, v in fragments.items():
-        print(f"TP input source ID: {k}")
-        element_id = [cmap.get_element_name_from_offline_channel(c) for c in np.unique(v["channel"])]
-        print(f"Element names: {np.unique(element_id)}")
-        # for k2, v2 in v.items():
-        #     print(f"{k2}, : {np.unique(v2)}")
-
-    exit()
-
-
-    # TODO decide whether plotting a gif of all Timeslices is worth it    
-    def animate(i):
-        im = plt.hist2d(TPData[i]["channel"], TPData[i]["time_peak"], bins=100)
-        plt.xlabel("channel")
-        plt.ylabel("peak time")
-        plt.title(f"Time sice :{i}")
-        return im
-
-    if args.plot:
-        os.makedirs(args.outdir, exist_ok=True)
-    if args.plot == "gif":
-        fig = plt.figure()
-        ax = plt.axes()
-        im = plt.hist2d(TPData[0]["channel"], TPData[0]["time_peak"], bins=100, norm=matplotlib.colors.LogNorm())
-        plt.colorbar()
-        anim = animation.FuncAnimation(fig, animate, frames=len(TPData))
-        anim.save(f"{args.outdir}/anim.gif")
-
-    if args.plot == "scatter" and args.records != -1:
-        planes = Utilities.SortDataByPlane(TPData[0])
-
-        for p in planes:
-            plt.figure()
-            plt.scatter(planes[p]["channel"], planes[p]["time_peak"], c=planes[p]["adc_integral"], s=5)
-            cbar = plt.colorbar()
-            cbar.set_label("ADC integral")
-            plt.xlabel("channel")
-            plt.ylabel("peak time")
-            plt.title(f"Plane : {p}")
-            plt.tight_layout()
-            plt.savefig(f"{args.outdir}/scatter_{p}.png", dpi=400)
-            plt.close()
-
-    if args.plot == "validation":        
-        data = pd.DataFrame(TPDataFrame())
-        for d in TPData:
-            data = pd.concat((data, d))
-
-        for key in data:
-            print(f"Plotting {key}")
-            plt.figure()
-            plt.hist(data[key], 40, histtype="step")
-            plt.xlabel(key)
-            plt.yscale("log")
-            plt.tight_layout()
-            plt.savefig(f"{args.outdir}/{key}.png")
-            plt.close()
+    metrics = Metrics.FromArguments(args)
+    with Utilities.OpenFile(args.file, args.records, args.channelMap, metrics, Utilities.FragmentFilter(args.subsystem, args.fragment_type, args.source_id)) as reader, TPPipeline.FromArguments(reader, args) as pipeline:
+        select = None
+        if args.time_range is not None or args.channel_range is not None or args.plane is not None:
+            with metrics.Timer("tp_index"):
+                tp_index = TPIndex.TPIndex(reader)
+            planes = [["u", "v", "z"].index(p) for p in args.plane] if args.plane else None
+            select = lambda rid : tp_index.Select(reader, rid, args.time_range, args.channel_range, planes) # only fragments with TPs in the ranges
+        else:
+            Prefetch.FromArguments(reader, args) # queries only read parts of fragments, so there is nothing to read ahead
+        pipeline.Run(select)
+    metrics.Report(args.metrics, args.metrics_format)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test script to plot some TPStream quantities")
     parser.add_argument(dest="file", type=str, help="file to open.")
-    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot")
+    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot, e.g. 0-5, all, ::10, -1 or r120-r130 (see Utilities.ParseRecordMap)")
     parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory to store plots")
-    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="print record and TP information")
-    parser.add_argument("-p", "--plot", dest="plot", choices=["validation", "gif", "scatter"], help="create plots of TP data")
     parser.add_argument("-c", "--channel-map", dest="channelMap", choices=["VDColdboxChannelMap", "ProtoDUNESP1ChannelMap", "PD2HDChannelMap", "HDColdboxChannelMap", "PD2VDTPCChannelMap"], help="channel maps for ProtoDUNE")
+    parser.add_argument("--time-range", dest="time_range", type=int, nargs=2, default=None, metavar=("START", "END"), help="only TPs with time_start in this range (inclusive), uses the TP index of the file so only fragments which can contain them are read")
+    parser.add_argument("--channel-range", dest="channel_range", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"), help="only TPs on these offline channels (inclusive)")
+    parser.add_argument("--plane", dest="plane", type=str, nargs="+", choices=["u", "v", "z"], default=None, help="only TPs on these planes")
+    TPPipeline.AddArguments(parser)
+    Utilities.AddFragmentFilterArguments(parser, "TriggerPrimitive")
+    Prefetch.AddArguments(parser)
+    DecodeCache.AddArguments(parser)
+    Metrics.AddArguments(parser)
     args = parser.parse_args()
     main(args)
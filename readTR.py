@@ -7,6 +7,9 @@ Description: Plots data from TP stream files from VD coldbox runs.
 Works for daq runs prior to WIB ethernet readout.
 """
 import Utilities
+import Decoders
+import Metrics
+import Prefetch
 
 import fddetdataformats
 
@@ -14,19 +17,6 @@ import argparse
 import matplotlib.pyplot as plt
 import numpy as np
 
-def TRDataFrame():
-    """ Headers for DataFrame
-
-    Returns:
-        dictionary: headers
-    """
-    return {
-        "timestamp" : [],
-        "adc" : [],
-        "channel" : [],
-        "plane" : [],
-    }
-
 def GetWibHeader(type, header):
     df = {
         "crate" : -1,
@@ -46,9 +36,7 @@ def GetWibHeader(type, header):
     return df
 
 def main(args):
-    h5_file, cmap, toStudy = Utilities.OpenFile(args.file, args.records, args.channelMap)
-
-    WIBData = []
+    WIBData = None # only the first record is plotted
 
     if args.frontend == "wib":
         wibFrame = fddetdataformats.WIB2Frame
@@ -60,60 +48,67 @@ def main(args):
     wibFrameSize = wibFrame.sizeof()
     print(f"wib frame size: {wibFrameSize}")
 
-    for rid in toStudy:
-        trigger_record = TRDataFrame() # create a blank data frame
-
-        fragment_path = h5_file.get_fragment_dataset_paths(rid)[0] # get the path to the data
-        fragment = h5_file.get_frag(fragment_path)
-        Utilities.LogFragmentData(args.debug, fragment_path, fragment)
-        n_frames = (fragment.get_size()-fragment.get_header().sizeof())//wibFrameSize # number of WIb frames is the  fragment data size / tp size
-        if args.debug: print(f"number of WIB frames in fragment: {n_frames}")
-
-        frame = wibFrame(fragment.get_data())
-        header = GetWibHeader(args.frontend, frame.get_header())
-
-        if args.debug: print(f'crate: {header["crate"]}, slot: {header["slot"]}, fibre: {header["fiber"]}')
-        channels = [cmap.get_offline_channel_from_crate_slot_fiber_chan(header["crate"], header["slot"], header["fiber"], c) for c in range(256)]
-        planes = [cmap.get_plane_from_offline_channel(c) for c in channels]
-        if args.debug: print(channels)
-
-        for i in range(n_frames):
-            wib = wibFrame(fragment.get_data(i*wibFrameSize))
-            trigger_record["timestamp"].extend([wib.get_timestamp() for c in range(256)]) #-tr_ts
-            if args.frontend == "proto_wib":
-                trigger_record["adc"].extend([wib.get_channel(c) for c in range(256)])
-            if args.frontend == "wib":
-                trigger_record["adc"].extend([wib.get_adc(c) for c in range(256)])
-            trigger_record["channel"].extend(channels)
-            trigger_record["plane"].extend(planes)
-        WIBData.append(trigger_record)
-
-    x_range = [min(WIBData[0]["channel"]), max(WIBData[0]["channel"])]
-    x_size = x_range[1]-x_range[0]+1
-    x = np.linspace(x_range[0], x_range[1], x_size)
-
-    y_range = [min(WIBData[0]["timestamp"]), max(WIBData[0]["timestamp"])]
-    y_size = y_range[1]-y_range[0]+1
-    y = np.linspace(y_range[0], y_range[1], y_size)
-
-    print((x_size, y_size))
-
-    grid = np.meshgrid(x, y)
-    adcmap = np.array(WIBData[0]["adc"])
-    adcmap.reshape((y_size-1, x_size-1))
-    #print(adcmap)
-
-    plt.pcolor(WIBData[0]["channel"], WIBData[0]["timestamp"], WIBData[0]["adc"], bins=100)
-    plt.savefig(f"test.png", dpi=400)
+    metrics = Metrics.FromArguments(args)
+    fragment_type = args.fragment_type or {"wib" : "WIB", "proto_wib" : "ProtoWIB"}[args.frontend] # so the first fragment is a WIB one
+    fragmentFilter = Utilities.FragmentFilter(args.subsystem, fragment_type, args.source_id)
+    with Utilities.OpenFile(args.file, args.records, args.channelMap, metrics, fragmentFilter) as reader:
+        cmap = reader.cmap
+        Prefetch.FromArguments(reader, args, fragments = True, per_record = 1) # only the first fragment of each record is used
+        for rid, fragments in reader:
+            metrics.Count("records")
+            fragment_path, fragment = next(fragments, (None, None)) # get the data
+            if fragment is None:
+                print(f"record {rid[0]} has no {fragment_type} fragments")
+                continue
+            Utilities.LogFragmentData(args.debug, fragment_path, fragment)
+            n_frames = (fragment.get_size()-fragment.get_header().sizeof())//wibFrameSize # number of WIb frames is the  fragment data size / tp size
+            if args.debug: print(f"number of WIB frames in fragment: {n_frames}")
+
+            frame = wibFrame(fragment.get_data())
+            header = GetWibHeader(args.frontend, frame.get_header())
+
+            if args.debug: print(f'crate: {header["crate"]}, slot: {header["slot"]}, fibre: {header["fiber"]}')
+            with metrics.Timer("channel_map"):
+                channels = cmap.OfflineChannelsFromFiber(header["crate"], header["slot"], header["fiber"], 256)
+                planes = cmap.Planes(channels)
+            if metrics.enabled:
+                metrics.Count("unknown_channels", np.count_nonzero(planes < 0))
+            if args.debug: print(channels)
+
+            #* unpack every frame at once, adc is (frames x 256) and each column corresponds to an entry in channels
+            with metrics.Timer("decode"):
+                adc, timestamps = Decoders.DecodeWIBFrames(fragment, args.frontend)
+            metrics.Count("frames", len(adc))
+            metrics.Progress()
+            if WIBData is None:
+                WIBData = {"timestamp" : timestamps, "adc" : adc, "channel" : channels, "plane" : planes}
+
+    if WIBData is None:
+        raise Exception(f"no {fragment_type} fragments in the records selected, check the front end type (-f) and fragment filters")
+
+    #* ADC map of the first record, with channels in offline channel order
+    order = np.argsort(WIBData["channel"])
+
+    with metrics.Timer("plot"):
+        plt.figure()
+        plt.imshow(WIBData["adc"][:, order], aspect="auto", origin="lower", interpolation="none")
+        plt.colorbar(label="ADC")
+        plt.xlabel("channel index")
+        plt.ylabel("frame")
+        plt.savefig("test.png", dpi=400)
+    metrics.Report(args.metrics, args.metrics_format)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test script to plot some TPStream quantities")
     parser.add_argument(dest="file", type=str, help="file to open.")
-    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot")
+    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot, e.g. 0-5, all, ::10, -1 or r120-r130 (see Utilities.ParseRecordMap)")
     parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="plot", help="output file directory to store plots")
     parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="print record and TP information")
     parser.add_argument("-p", "--plot", dest="plot", choices=["validation", "gif", "scatter"], help="create plots of TP data")
     parser.add_argument("-f", "--frontend", dest="frontend", choices=["proto_wib", "wib"], default="proto_wib", help="front end type")
     parser.add_argument("-c", "--channel-map", dest="channelMap", choices=["VDColdboxChannelMap", "ProtoDUNESP1ChannelMap", "PD2HDChannelMap", "HDColdboxChannelMap"], help="channel maps for ProtoDUNE")
+    Utilities.AddFragmentFilterArguments(parser)
+    Prefetch.AddArguments(parser)
+    Metrics.AddArguments(parser)
     args = parser.parse_args()
     main(args)
@@ -6,109 +6,235 @@ Author: Shyam Bhuller
 Description: Reads a Trigger record and writes ADC and channels to file. Used in offline analysis of TPs
 """
 import Utilities
+import Parallel
+import Writers
+import Metrics
+import EventDisplay
+import Pedestals
+import Spectra
+import Prefetch
+import DecodeCache
+import TPFinder
+import TPStore
 import fddetdataformats
 import rawdatautils
 
+import os
+import contextlib
 import argparse
 import numpy as np
-import h5py
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import matplotlib
 
 
-def TRDataFrame():
-    """ Headers for DataFrame
+def DecodeRecord(reader : Utilities.RawDataFile, rid, args) -> dict:
+    """ Read the first fragment of a trigger record and unpack the ADCs.
+
+    Args:
+        reader (Utilities.RawDataFile): open file
+        rid (tuple): record id
+        args (argparse.Namespace): command line arguments
 
     Returns:
-        dictionary: headers
+        dict: ADCs (time x channel), timestamps, offline channels and planes of each column, detector id and source id
     """
-    return {
-        "adc" : [],
-        "channel" : [],
-        "timestamp" : [],
-        "plane": [],
-    }
+    wibFrameSize = fddetdataformats.WIBEthFrame.sizeof()
+    cmap = reader.cmap
 
+    fragment_path, fragment = next(reader.Fragments(rid), (None, None)) # get the data
+    if fragment is None:
+        raise Exception(f"no fragments in record {rid[0]} pass the fragment selection")
+    Utilities.LogFragmentData(args.debug, fragment_path, fragment)
+    n_frames = (fragment.get_size()-fragment.get_header().sizeof())//wibFrameSize # number of WIb frames is the  fragment data size / tp size
+    if args.debug: print(f"number of WIB frames in fragment: {n_frames}")
 
-def main(args):
-    h5_file, cmap, toStudy = Utilities.OpenFile(args.file, args.records, args.channel_map)
-    
-    #* collect run number
-    with h5py.File(args.file, 'r') as h5py_file:
-        run_number = h5py_file.attrs["run_number"]
+    wibFrame = fddetdataformats.WIBEthFrame(fragment.get_data()) # get frame (bit that has ADCs)
+    wibHeader = wibFrame.get_daqheader() # get offline channel number from this
 
-    wibFrameSize = fddetdataformats.WIBEthFrame.sizeof()
-    print(f"wib frame size: {wibFrameSize}")
-
-    #* crawl through records and store data
-    WIBData = []
-    for rid in toStudy:
-        fragment_path = h5_file.get_fragment_dataset_paths(rid)[0] # get the path to the data
-        fragment = h5_file.get_frag(fragment_path)
-        Utilities.LogFragmentData(args.debug, fragment_path, fragment)
-        n_frames = (fragment.get_size()-fragment.get_header().sizeof())//wibFrameSize # number of WIb frames is the  fragment data size / tp size
-        if args.debug: print(f"number of WIB frames in fragment: {n_frames}")
-
-        wibFrame = fddetdataformats.WIBEthFrame(fragment.get_data()) # get frame (bit that has ADCs)
-        wibHeader = wibFrame.get_daqheader() # get offline channel number from this
-        wibTimestamp = wibFrame.get_timestamp()
-        if args.debug: print(f"crate: {wibHeader.crate_no}, slot: {wibHeader.slot_no}, fibre: {wibHeader.fiber_no}")
-
-        channels = [cmap.get_offline_channel_from_det_crate_slot_stream_chan(wibHeader.det_id, wibHeader.crate_id, wibHeader.slot_id, wibHeader.stream_id, c) for c in range(64)]
-        plane = [cmap.get_plane_from_offline_channel(c) for c in channels]
+    metrics = reader.metrics
+    with metrics.Timer("channel_map"):
+        channels = cmap.OfflineChannels(wibHeader.det_id, wibHeader.crate_id, wibHeader.slot_id, wibHeader.stream_id, 64)
+        plane = cmap.Planes(channels)
+    with metrics.Timer("decode"):
         adc = rawdatautils.unpack.wibeth.np_array_adc(fragment)
         timestamps = rawdatautils.unpack.wibeth.np_array_timestamp(fragment)
-        if args.debug: print(channels)
+    return {"adc" : adc, "timestamps" : timestamps, "channels" : channels, "planes" : plane, "det_id" : wibHeader.det_id, "source_id" : fragment.get_element_id().id}
+
+
+def SetupProcess(reader : Utilities.RawDataFile, args) -> tuple:
+    """ Per process state for ProcessRecord, made once in each process which runs records (see Parallel.MapRecords).
+
+    Args:
+        reader (Utilities.RawDataFile): open file
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        tuple: decode cache of this process (None if it isn't used)
+    """
+    return (DecodeCache.FromArguments(args, reader.metrics) if not args.debug else None,) # with --debug the fragment has to be read to print it
+
+
+def ProcessRecord(reader : Utilities.RawDataFile, rid, args, cache : DecodeCache.DecodeCache = None) -> tuple:
+    """ Unpack a trigger record and write out the event display (and ADCs, if writing csv files), optionally finding TPs in the waveforms.
+
+    Args:
+        reader (Utilities.RawDataFile): open file
+        rid (tuple): record id
+        args (argparse.Namespace): command line arguments
+        cache (DecodeCache.DecodeCache, optional): decoded records from earlier runs. Defaults to None (always decode).
+
+    Returns:
+        tuple: files written, decoded record (None if it isn't needed in the main process), TPs found in software (None unless --find-tps)
+    """
+    metrics = reader.metrics
+    record = None
+    if cache is not None:
+        entries = reader.Entries(rid)
+        if len(entries) == 0:
+            raise Exception(f"no fragments in record {rid[0]} pass the fragment selection")
+        key = cache.Key(reader, rid, entries[0], "wibeth")
+        with metrics.Timer("cache"):
+            record = cache.Get(key)
+    if record is None:
+        record = DecodeRecord(reader, rid, args)
+        if cache is not None:
+            with metrics.Timer("cache"):
+                cache.Put(key, record)
+    adc, timestamps, channels, plane = record["adc"], record["timestamps"], record["channels"], record["planes"]
+    metrics.Count("frames", len(timestamps))
+    if args.debug: print(channels)
 
+    tps = None
+    if args.find_tps:
+        with metrics.Timer("tp_finder"):
+            tps = TPStore.Compact(TPFinder.FindTPs(adc, timestamps, channels, plane, args.tp_threshold, det_id = int(record["det_id"])), rid[0], int(record["source_id"]))
+        metrics.Count("tps", len(tps))
+
+    outputs = []
+    if args.workers <= 1:
+        print(pd.DataFrame(data=np.vstack([plane, adc[:4]]), columns=channels, index=["plane", *timestamps[:4]])) # first few rows, the whole record is only put in a DataFrame for csv files
+    if DrawRecord(rid, args) and args.evd_workers == 0:
+        with metrics.Timer("plot"):
+            outputs.append(EventDisplay.Render(adc, f"{args.outdir}/evd_tr_{rid[0]}.png", f"record {rid[0]}", args.evd_pool, args.evd_pool_mode, args.evd_dpi))
+
+    if args.format == "csv":
         df = pd.DataFrame(data=np.vstack([plane, adc]), columns=channels, index=["plane", *timestamps])
-        print(df.head(n=5))
-        plt.figure()
-        sns.heatmap(df[1:] - df[1:].mean(), cmap="seismic")
-        plt.savefig(f"evd_tr_{rid[0]}.png", dpi=400)
-        df.to_csv(f"tr_{rid[0]}.csv")
-        
+        df.to_csv(f"{args.outdir}/tr_{rid[0]}.csv")
+        outputs.append(f"{args.outdir}/tr_{rid[0]}.csv")
+        if not ((DrawRecord(rid, args) and args.evd_workers > 0) or args.pedestals or args.spectra):
+            return outputs, None, tps
+    return outputs, {"adc" : adc, "timestamps" : timestamps, "channels" : channels, "planes" : plane}, tps
+
+
+def DrawRecord(rid, args) -> bool:
+    """ Should an event display be made for this record.
+
+    Args:
+        rid (tuple): record id
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        bool: True if the record is drawn
+    """
+    return args.evd_every > 0 and rid[0] % args.evd_every == 0
+
+
+def main(args):
+    wibFrameSize = fddetdataformats.WIBEthFrame.sizeof()
+    print(f"wib frame size: {wibFrameSize}")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    metrics = Metrics.FromArguments(args) # only records handled in this process are timed, the workers aren't instrumented
+    with Utilities.OpenFile(args.file, args.records, args.channel_map, metrics, Utilities.FragmentFilter(args.subsystem, args.fragment_type, args.source_id)) as reader:
+        run_number = reader.attributes["run_number"] #* collect run number
+        outfile = f"{args.outdir}/{args.outfile}-{run_number}.hdf5"
+        if args.workers <= 1:
+            Prefetch.FromArguments(reader, args, fragments = True, per_record = 1) # only the first fragment of each record is used
+
+        #* crawl through records, writing each one out as soon as it is read
+        failed = 0
+        writer = Writers.WaveformWriter(outfile, run_number) if args.format == "hdf5" else contextlib.nullcontext()
+        renderer = EventDisplay.BackgroundRenderer(args.evd_workers) if args.evd_workers > 0 and args.evd_every > 0 else contextlib.nullcontext()
+        pedestals = Pedestals.PedestalEstimator(args.robust) if args.pedestals else None
+        spectra = Spectra.NoiseSpectrum(args.fft_length) if args.spectra else None
+        tp_file = f"{args.outdir}/{args.outfile}-{run_number}-tps.hdf5"
+        tp_store = TPStore.TPStore(tp_file, "w", time_unit = "samples") if args.find_tps else contextlib.nullcontext()
+        with writer as writer, renderer as renderer, tp_store as tp_store:
+            for rid, result, error in Parallel.MapRecords(ProcessRecord, reader, args.workers, args, setup = SetupProcess):
+                if error is not None:
+                    failed += 1
+                    print(f"record {rid[0]} failed:\n{error}")
+                    continue
+                metrics.Count("records")
+                outputs, data, tps = result
+                if renderer is not None and DrawRecord(rid, args):
+                    renderer.Submit(data["adc"], f"{args.outdir}/evd_tr_{rid[0]}.png", f"record {rid[0]}", args.evd_pool, args.evd_pool_mode, args.evd_dpi)
+                    outputs.append(f"{args.outdir}/evd_tr_{rid[0]}.png")
+                if writer is not None:
+                    with metrics.Timer("write"):
+                        writer.Append(rid[0], **data)
+                    outputs.append(outfile)
+                if pedestals is not None:
+                    with metrics.Timer("pedestals"):
+                        pedestals.Update(data["adc"], data["channels"], data["planes"])
+                if spectra is not None:
+                    with metrics.Timer("spectra"):
+                        spectra.Update(data["adc"], data["channels"], data["planes"])
+                if tps is not None:
+                    with metrics.Timer("write"):
+                        tp_store.Append(rid, tps, "samples") # TPFinder times are in samples
+                    outputs.append(tp_file)
+                print(f"record {rid[0]}: wrote {', '.join(outputs)}")
+                metrics.Progress()
+        if failed: print(f"{failed} out of {len(reader.toStudy)} records failed")
+        if pedestals is not None:
+            pedestals.Save(f"{args.outdir}/{args.outfile}-{run_number}-pedestals.npz") # can be merged with other files using Pedestals.py
+            print(pedestals.Results())
+        if spectra is not None:
+            spectra.Save(f"{args.outdir}/{args.outfile}-{run_number}-spectra.npz") # can be merged with other files using Spectra.py
+            results = spectra.Results()
+            Spectra.SaveResults(results, f"{args.outdir}/{args.outfile}-{run_number}-spectra-results.npz")
+            Spectra.PlotSpectra(results, args.outdir)
+            print(Spectra.Summary(results))
+
     #* convert to raw data waveform for LArSoft sumulation studies
-    # # get all channel ids
-    # channels = []
-    # for i in range(len(WIBData)):
-    #     channels.extend(WIBData[i]["channel"])
-    # print(f"total number of rows: {len(channels)}")
-    
-    # # get unique channels i.e. number of rows in output data
-    # uniqueChannels = np.unique(channels)
-    # print(f"number of unique channel numbers: {len(uniqueChannels)}")
-    
-    # totalSteps = len(uniqueChannels) + len(channels)
-    # counter = 0
-    # # add run number, channel and plane id to each row
-    # adc = [[run_number, uniqueChannels[i], cmap.get_plane_from_offline_channel(uniqueChannels[i])] for i in range(len(uniqueChannels))]
-    
-    # # add ADCs from all records along each column
-    # for i in range(len(uniqueChannels)):
-    #     for j in range(len(WIBData)):
-    #         index = WIBData[j]["channel"].index(uniqueChannels[i])
-    #         adc[i].append(WIBData[j]["adc"][index])            
-    #         counter += 1
-    #         print(f"percentage converted: {(100 * counter / totalSteps):.2f}", end='\r')
-    # data = np.array(adc)
-
-    
-    # quick preview
-    # print(data)
-    # if args.debug:
-    #     with np.printoptions(threshold=5):
-    #         print(data)
-    
-    # np.save(f"{args.outdir}{args.outfile}-{run_number}.npy", data) # save to file
+    if args.larsoft:
+        if args.format != "hdf5":
+            raise Exception("LArSoft waveforms are made from the hdf5 output, use --format hdf5")
+        data = Writers.LArSoftWaveforms(outfile)
+        if args.debug:
+            with np.printoptions(threshold=5):
+                print(data)
+        np.save(f"{args.outdir}/{args.outfile}-{run_number}.npy", data) # save to file
+    metrics.Report(args.metrics, args.metrics_format)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script to extract ADC values from a TR")
     parser.add_argument(dest="file", type=str, help="file to open.")
-    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot")
+    parser.add_argument("-r", "--records", dest="records", type=str, default="0", help="trigger record/s to plot, e.g. 0-5, all, ::10, -1 or r120-r130 (see Utilities.ParseRecordMap)")
     parser.add_argument("-o", "--out-directory", dest="outdir", type=str, default="./", help="output file directory to store plots")
     parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="print record and TP information")
     parser.add_argument("-f", "--out-file", dest="outfile", type=str, default="test-waveform", help="output file name")
+    parser.add_argument("--format", dest="format", choices=["hdf5", "csv"], default="hdf5", help="output format, one compressed hdf5 file per run or a csv file per record")
+    parser.add_argument("--larsoft", dest="larsoft", action="store_true", help="also write waveforms in the layout used for LArSoft simulation studies (.npy)")
+    parser.add_argument("-j", "--workers", dest="workers", type=int, default=1, help="number of processes used to process records in parallel")
     parser.add_argument("-c", "--channel-map", dest="channel_map", choices=["VDColdboxChannelMap", "ProtoDUNESP1ChannelMap", "PD2HDChannelMap", "HDColdboxChannelMap", "PD2VDTPCChannelMap"], help="channel maps for ProtoDUNE")
+    parser.add_argument("--pedestals", dest="pedestals", action="store_true", help="estimate the pedestal and noise of each channel over all records")
+    parser.add_argument("--spectra", dest="spectra", action="store_true", help="average the noise power spectrum of each channel over all records, with per plane and coherent noise summaries")
+    parser.add_argument("--fft-length", dest="fft_length", type=int, default=1024, help="samples in each FFT segment of --spectra, sets the frequency resolution")
+    parser.add_argument("--robust", dest="robust", action="store_true", help="also estimate the median and MAD of each channel (with --pedestals)")
+    parser.add_argument("--evd-every", dest="evd_every", type=int, default=1, help="draw the event display of every Nth record (by record number), 0 to turn them off")
+    parser.add_argument("--evd-pool", dest="evd_pool", type=int, nargs=2, default=[1, 1], metavar=("TIME", "CHANNEL"), help="downsample the event display by combining blocks of time x channel samples")
+    parser.add_argument("--evd-pool-mode", dest="evd_pool_mode", choices=["max", "mean"], default="max", help="how samples are combined when downsampling")
+    parser.add_argument("--evd-dpi", dest="evd_dpi", type=int, default=150, help="resolution of the event displays")
+    parser.add_argument("--evd-workers", dest="evd_workers", type=int, default=0, help="draw event displays in this many background processes, 0 draws them while processing the record")
+    parser.add_argument("--find-tps", dest="find_tps", action="store_true", help="find TPs in the waveforms in software, written to the TP store <outdir>/<outfile>-<run>-tps.hdf5")
+    parser.add_argument("--tp-threshold", dest="tp_threshold", type=int, default=60, help="threshold above the pedestal (ADC) of the software TP finder")
+    Utilities.AddFragmentFilterArguments(parser, "WIBEth")
+    Prefetch.AddArguments(parser)
+    DecodeCache.AddArguments(parser)
+    Metrics.AddArguments(parser)
     args = parser.parse_args()
+    matplotlib.use("Agg")
     main(args)